@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'aipodcast')
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 ** 3
+# entries touched more recently than this are not evicted, another render may be using them
+DEFAULT_EVICT_MIN_AGE = 3600
+
+
+class AssetCache:
+    '''
+    A content-addressed file cache shared by every episode and by concurrent processes.
+    Keys are hashes of the input content plus the transform parameters, see make_key.
+    The cached files are the index: the first use of an entry in a process touches its file, so modification times
+    order the entries from least to most recently used. Nothing is evicted while rendering, evict() brings the cache back
+    under max_bytes once a render is done (VideoCrafter.create, EpisodePipeline.run and batch_render after every batch).
+    '''
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes or DEFAULT_CACHE_MAX_BYTES
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        # keys looked up or committed by this process, never evicted by it
+        self._pinned_keys = set()
+        self._content_hashes = {}
+
+    @staticmethod
+    def make_key(namespace, source, **params):
+        '''source is a content hash (or a url for downloads), params are the transform parameters.'''
+        key_data = json.dumps({'namespace': namespace, 'source': source, 'params': params}, sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if memo_key in self._content_hashes:
+                return self._content_hashes[memo_key]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        with self._lock:
+            self._content_hashes[memo_key] = sha.hexdigest()
+        return self._content_hashes[memo_key]
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def lookup(self, key, ext=''):
+        '''Returns the cached path for key, or None. Counts a hit or a miss.'''
+        path = self._path(key, ext)
+        with self._lock:
+            if os.path.exists(path):
+                if key not in self._pinned_keys:
+                    # touched once per process, touching again would change the mtime content_hash memoizes on
+                    try:
+                        os.utime(path)
+                    except OSError:
+                        pass
+                    self._pinned_keys.add(key)
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def temp_path(self, key, ext=''):
+        '''A unique path for a producer to write to, the extension is kept so ffmpeg can infer the format.'''
+        directory = os.path.join(self.cache_dir, key[:2])
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp{ext}")
+
+    def commit(self, key, ext, temp_path):
+        '''Moves a finished temp file into place.'''
+        path = self._path(key, ext)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._pinned_keys.add(key)
+        return path
+
+    def fetch(self, key, ext, producer):
+        '''Returns the cached path for key, calling producer(temp_path) to create it on a miss.'''
+        path = self.lookup(key, ext)
+        if path is not None:
+            return path
+        temp_path = self.temp_path(key, ext)
+        try:
+            producer(temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.commit(key, ext, temp_path)
+
+    def _iter_files(self):
+        '''Yields (path, name, os.stat_result) of every file in the cache, files removed meanwhile are skipped.'''
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    yield path, name, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def total_bytes(self):
+        return sum(stat.st_size for _, name, stat in self._iter_files() if '.tmp' not in name)
+
+    def evict(self, min_age=DEFAULT_EVICT_MIN_AGE):
+        '''
+        Removes the least recently used entries until the cache is at most max_bytes, returns the bytes freed.
+        Entries used by this process or touched in the last min_age seconds are kept, another process may be rendering
+        with them, and so are files that cannot be removed while open (memory-mapped files on Windows).
+        Temp files older than min_age, left by producers that died, are removed too.
+        '''
+        now = time.time()
+        entries = []
+        total_bytes = 0
+        freed_bytes = 0
+        for path, name, stat in self._iter_files():
+            recent = now - stat.st_mtime < min_age
+            if '.tmp' in name:
+                if not recent and self._remove(path):
+                    freed_bytes += stat.st_size
+                continue
+            total_bytes += stat.st_size
+            if not recent and name.split('.')[0] not in self._pinned_keys:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if self._remove(path):
+                total_bytes -= size
+                freed_bytes += size
+        if total_bytes > self.max_bytes:
+            print(f"Asset cache is {total_bytes} bytes, over its {self.max_bytes} bytes budget, the remaining entries are recent or in use")
+        return freed_bytes
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another process meanwhile
+            pass
+        except OSError as e:
+            print(f"Asset cache entry {path} is in use, not evicted: {e}")
+            return False
+        return True
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_bytes': self.total_bytes(),
+            'max_bytes': self.max_bytes,
+        }
+
+
+def test_AssetCache():
+    '''
+    Commits never evict, evict() removes the least recently used entries down to the budget, skipping entries touched
+    recently or that cannot be removed, and temp files of dead producers.
+    '''
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_dir = os.path.join(temp_dir, 'cache')
+        cache = AssetCache(cache_dir, max_bytes=2500)
+        source_path = os.path.join(temp_dir, 'source.bin')
+        with open(source_path, 'wb') as f:
+            f.write(b'x' * 100)
+        source_hash = cache.content_hash(source_path)
+
+        def producer(temp_path):
+            with open(temp_path, 'wb') as f:
+                f.write(b'y' * 1000)
+
+        keys = [AssetCache.make_key('stretch', source_hash, atempo=atempo) for atempo in (1.1, 1.2, 1.3, 1.4)]
+        first_path = cache.fetch(keys[0], '.mp3', producer)
+        assert cache.fetch(keys[0], '.mp3', producer) == first_path
+        assert (cache.hits, cache.misses) == (1, 1)
+        paths = [first_path] + [cache.fetch(key, '.mp3', producer) for key in keys[1:]]
+        assert all(os.path.exists(path) for path in paths) and cache.total_bytes() == 4000
+
+        # a new run: recently touched entries are kept
+        cache = AssetCache(cache_dir, max_bytes=2500)
+        assert cache.evict() == 0 and cache.total_bytes() == 4000
+        now = time.time()
+        for age, path in zip((4000, 3900, 3800, 0), paths):
+            os.utime(path, (now - age, now - age))
+        stale_temp_path = cache.temp_path(keys[0], '.mp3')
+        producer(stale_temp_path)
+        os.utime(stale_temp_path, (now - 4000, now - 4000))
+        live_temp_path = cache.temp_path(keys[1], '.mp3')
+        producer(live_temp_path)
+        # the oldest entry is in use (a PermissionError on Windows), the next oldest ones go instead
+        remove = os.remove
+
+        def remove_unless_in_use(path):
+            if path == paths[0]:
+                raise PermissionError(13, 'The process cannot access the file because it is being used by another process', path)
+            remove(path)
+        os.remove = remove_unless_in_use
+        try:
+            assert cache.evict() == 3000
+        finally:
+            os.remove = remove
+        assert [os.path.exists(path) for path in paths] == [True, False, False, True]
+        assert not os.path.exists(stale_temp_path) and os.path.exists(live_temp_path)
+        assert cache.lookup(keys[1], '.mp3') is None and cache.lookup(keys[3], '.mp3') == paths[3]
+        print('test_AssetCache passed', cache.stats())
+
+if __name__ == '__main__':
+    test_AssetCache()
@@ -0,0 +1,210 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ffmpeg_utils import decode_audio
+from time_stretch import wsola_time_stretch
+
+
+class AudioMixer:
+    '''
+    Sample-accurate mixer for a sequence of clips plus an optional BGM.
+    Every clip is decoded once to float32 PCM, the sample offsets are computed up front and each clip is
+    written into one preallocated buffer, with vectorized fades and pauses, then the BGM is added in one multiply-add.
+    The timing matches the moviepy graph of VideoCrafter._create_final_audio: a clip lasts the container duration
+    ffmpeg reports for its file, followed by int(pause * fps) samples of silence.
+
+    A clip is a dict with:
+        audio_path: None for silence
+        duration: length of a silent clip in seconds
+        pause_duration: silence appended after the clip
+        time_stretch: speed factor applied in memory with WSOLA, 1.0 for none
+    With a pcm_cache (see pcm_cache.PcmCache, same fps and nchannels) the clips and the BGM are read from its memory maps
+    instead of being decoded.
+    With loudness (see loudness.LoudnessNormalizer) every clip is scaled to the target loudness, the BGM too, and the BGM
+    is ducked under the clips, the gains being applied while mixing.
+    '''
+    def __init__(self, fps=44100, nchannels=2, clip_fade_duration=0.5, decode_workers=None, pcm_cache=None, loudness=None):
+        self.fps = fps
+        self.nchannels = nchannels
+        self.pcm_cache = pcm_cache
+        self.loudness = loudness
+        self.clip_fade_duration = clip_fade_duration
+        self.decode_workers = decode_workers or os.cpu_count() or 1
+        # (start_sample, audio_end_sample, end_sample) of every clip of the last mix
+        self.clip_offsets = []
+        # (start, end) seconds of the clips with audio, the BGM is ducked under them
+        self._speech_spans = []
+        self._buffer = None
+        self._n_mixed = 0
+
+    def decode_clip(self, clip):
+        '''Returns (samples, n_samples) where n_samples is the length the clip takes on the timeline, pause excluded.'''
+        if clip.get('audio_path') is None:
+            return None, int((clip.get('duration', 0) + clip.get('pause_duration', 0)) * self.fps)
+        samples, duration = self._load(clip['audio_path'])
+        if self.loudness is not None:
+            # analysed here, on the decode threads, add_clip then finds the gain cached
+            self.loudness.clip_gain(clip['audio_path'])
+        if clip.get('time_stretch', 1.0) != 1.0:
+            samples = wsola_time_stretch(samples, clip['time_stretch'], self.fps)
+            return samples, len(samples)
+        return samples, int(round(duration * self.fps))
+
+    def _load(self, audio_path):
+        if self.pcm_cache is not None:
+            return self.pcm_cache.load(audio_path)
+        return decode_audio(audio_path, self.fps, self.nchannels, with_duration=True)
+
+    def decode_clips(self, clips):
+        if not clips:
+            return []
+        # ffmpeg decodes in its own process, so threads are enough to decode in parallel
+        with ThreadPoolExecutor(max_workers=min(self.decode_workers, len(clips))) as executor:
+            return list(executor.map(self.decode_clip, clips))
+
+    def _fade_ramp(self, n_samples):
+        return (np.arange(n_samples, dtype=np.float32) / n_samples)[:, None]
+
+    def mix(self, clips, bgm_path=None, bgm_volume=1.0, bgm_fadeout_duration=0, decoded_clips=None):
+        '''Returns the mixed (samples, nchannels) float32 buffer.'''
+        if decoded_clips is None:
+            decoded_clips = self.decode_clips(clips)
+        total_samples = 0
+        for clip, (samples, n_samples) in zip(clips, decoded_clips):
+            total_samples += n_samples + (int(clip.get('pause_duration', 0) * self.fps) if samples is not None else 0)
+        self.begin_mix(total_samples)
+        for clip, decoded_clip in zip(clips, decoded_clips):
+            self.add_clip(clip, decoded_clip)
+        return self.end_mix(bgm_path, bgm_volume, bgm_fadeout_duration)
+
+    def begin_mix(self, expected_samples=0):
+        '''Starts an incremental mix, clips are then added in timeline order with add_clip, as they become ready.'''
+        self.clip_offsets = []
+        self._speech_spans = []
+        self._buffer = np.zeros((expected_samples, self.nchannels), dtype=np.float32)
+        self._n_mixed = 0
+
+    def add_clip(self, clip, decoded_clip):
+        '''Appends a clip decoded by decode_clip and its pause to the mix, returns its (start, audio_end, end) sample offsets.'''
+        samples, n_samples = decoded_clip
+        pause_samples = int(clip.get('pause_duration', 0) * self.fps) if samples is not None else 0
+        start_sample = self._n_mixed
+        audio_end_sample = start_sample + n_samples
+        end_sample = audio_end_sample + pause_samples
+        if end_sample > len(self._buffer):
+            # grows geometrically, so appending clip by clip stays linear
+            grown = np.zeros((max(end_sample, 2 * len(self._buffer)), self.nchannels), dtype=np.float32)
+            grown[:self._n_mixed] = self._buffer[:self._n_mixed]
+            self._buffer = grown
+        self.clip_offsets.append((start_sample, audio_end_sample, end_sample))
+        self._n_mixed = end_sample
+        if samples is None:
+            return self.clip_offsets[-1]
+
+        output = self._buffer
+        n_copied = min(len(samples), n_samples)
+        output[start_sample:start_sample + n_copied] = samples[:n_copied]
+        if self.loudness is not None:
+            output[start_sample:start_sample + n_copied] *= np.float32(self.loudness.clip_gain(clip['audio_path']))
+            self._speech_spans.append((start_sample / self.fps, audio_end_sample / self.fps))
+        # linear fade in and out over the clip's timeline length, like audio_fadein / audio_fadeout
+        fade_samples = int(self.clip_fade_duration * self.fps)
+        n_fade = min(fade_samples, n_samples)
+        if n_fade > 0:
+            ramp = self._fade_ramp(fade_samples)[:n_fade]
+            output[start_sample:start_sample + n_fade] *= ramp
+            output[audio_end_sample - n_fade:audio_end_sample] *= ramp[::-1][-n_fade:]
+        return self.clip_offsets[-1]
+
+    def end_mix(self, bgm_path=None, bgm_volume=1.0, bgm_fadeout_duration=0):
+        '''Adds the BGM under the clips added since begin_mix and returns the mixed buffer.'''
+        output = self._buffer[:self._n_mixed]
+        self._buffer = None
+        if bgm_path:
+            if self.loudness is None:
+                output += self.load_bgm(bgm_path, len(output), bgm_volume, bgm_fadeout_duration)
+            else:
+                bgm = self.load_bgm(bgm_path, len(output), self.loudness.bgm_gain(bgm_path, bgm_volume), bgm_fadeout_duration)
+                # the ducking gains are computed 10 seconds at a time, not for the whole timeline at once
+                chunk_samples = 10 * self.fps
+                for chunk_start in range(0, len(bgm), chunk_samples):
+                    chunk_end = min(chunk_start + chunk_samples, len(bgm))
+                    times = np.arange(chunk_start, chunk_end) / self.fps
+                    bgm[chunk_start:chunk_end] *= self.loudness.ducking_gains(times, self._speech_spans)[:, None]
+                output += bgm
+        np.clip(output, -1, 1, out=output)
+        return output
+
+    def load_bgm(self, bgm_path, n_samples, volume=1.0, fadeout_duration=0):
+        '''The BGM looped or cut to n_samples, scaled by volume, with a fade-out over its last fadeout_duration seconds.'''
+        bgm = self._load(bgm_path)[0]
+        if len(bgm) == 0:
+            return np.zeros((n_samples, self.nchannels), dtype=np.float32)
+        if len(bgm) < n_samples:
+            bgm = np.tile(bgm, (n_samples // len(bgm) + 1, 1))
+        bgm = bgm[:n_samples] * np.float32(volume)
+        fade_samples = min(int((fadeout_duration or 0) * self.fps), n_samples)
+        if fade_samples > 0:
+            bgm[n_samples - fade_samples:] *= self._fade_ramp(fade_samples)[::-1]
+        return bgm
+
+
+def test_AudioMixer():
+    '''Checks the mixer against the timing and fades of the moviepy clips it replaces, on synthetic audio.'''
+    import tempfile
+    from moviepy.editor import AudioFileClip
+    from ffmpeg_utils import run_ffmpeg
+    fps = 44100
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = []
+        for i, (frequency, duration) in enumerate([(300, 1.3), (500, 0.7), (700, 2.1)]):
+            paths.append(os.path.join(temp_dir, f'{i}.mp3'))
+            run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency={frequency}:duration={duration}', '-ac', 2, '-ar', fps, paths[-1]])
+        bgm_path = os.path.join(temp_dir, 'bgm.wav')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=100:duration=1', '-ac', 2, '-ar', fps, bgm_path])
+        clips = [{'audio_path': None, 'duration': 1, 'pause_duration': 0.3}] + [{'audio_path': path, 'pause_duration': 0.3} for path in paths]
+
+        mixer = AudioMixer(fps)
+        mixed = mixer.mix(clips)
+        # the same length as the concatenated moviepy clips, and every clip equals its moviepy rendering at its offset
+        expected_duration = 1.3 + sum(AudioFileClip(path).duration + 0.3 for path in paths)
+        assert abs(len(mixed) - expected_duration * fps) <= 2, (len(mixed), expected_duration * fps)
+        assert not mixed[:int(1.3 * fps)].any()
+        for path, (start_sample, audio_end_sample, end_sample) in zip(paths, mixer.clip_offsets[1:]):
+            # moviepy's reader snaps t to samples with float rounding and drifts by a sample here and there,
+            # so the reference is the ffmpeg decode with the audio_fadein / audio_fadeout gains of moviepy
+            samples, duration = decode_audio(path, fps, 2, with_duration=True)
+            t = np.arange(audio_end_sample - start_sample) / fps
+            gain = np.minimum(t / 0.5, 1) * np.minimum((duration - t) / 0.5, 1)
+            reference = np.zeros((len(t), 2), dtype=np.float32)
+            reference[:min(len(samples), len(t))] = samples[:len(t)]
+            assert np.abs(mixed[start_sample:audio_end_sample] - reference * gain[:, None]).max() < 1e-3
+            assert not mixed[audio_end_sample:end_sample].any()
+
+        # clips added one by one from an empty buffer give the same mix
+        mixer.begin_mix()
+        for clip in clips:
+            mixer.add_clip(clip, mixer.decode_clip(clip))
+        assert np.array_equal(mixer.end_mix(), mixed)
+
+        # the 1 second BGM is looped under the whole episode and faded out at the end
+        with_bgm = mixer.mix(clips, bgm_path, bgm_volume=0.5, bgm_fadeout_duration=2)
+        bgm = (with_bgm - mixed)[:int(1.3 * fps)]
+        assert np.abs(bgm[fps:int(1.3 * fps)] - bgm[:int(0.3 * fps)]).max() < 1e-6
+        assert np.abs(with_bgm[-1]).max() < 1e-3
+
+        # the loudness stage: the clips at the target loudness, the BGM 12 dB down under them, not over the silent clip
+        from asset_cache import AssetCache
+        from loudness import LoudnessAnalyzer, LoudnessNormalizer, integrated_loudness
+        loudness = LoudnessNormalizer(LoudnessAnalyzer(AssetCache(os.path.join(temp_dir, 'cache'))), target_lufs=-20, bgm_ducking_db=12)
+        mixer = AudioMixer(fps, loudness=loudness)
+        normalized = mixer.mix(clips)
+        start_sample, audio_end_sample, _ = mixer.clip_offsets[-1]
+        assert abs(integrated_loudness(normalized[start_sample + fps // 2:audio_end_sample - fps // 2], fps) - -20) < 0.3
+        ducked_bgm = mixer.mix(clips, bgm_path, bgm_volume=0.5) - normalized
+        level_ratio = np.abs(ducked_bgm[start_sample + fps // 2:audio_end_sample - fps // 2]).max() / np.abs(ducked_bgm[:fps]).max()
+        assert abs(20 * np.log10(level_ratio) - -12) < 0.1
+    print('test_AudioMixer passed')
+
+if __name__ == '__main__':
+    test_AudioMixer()
@@ -0,0 +1,158 @@
+import math
+import numpy as np
+from moviepy.video.VideoClip import VideoClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+from asset_cache import AssetCache
+from ffmpeg_utils import iter_video_frames, probe_duration
+
+STORE_FORMATS = ('video', 'frames')
+# a raw frame store takes width * height * 3 bytes per frame, 6 MB at 1080p, so it only keeps a short loop by default
+DEFAULT_FRAMES_LOOP_SECONDS = 10
+
+
+def plan_loop(source_frames, loop_frames=None, crossfade_frames=0):
+    '''
+    Returns (loop_frames, crossfade_frames) of a loop cut from a source of source_frames frames:
+    the loop reads loop_frames + crossfade_frames source frames, loop_frames None takes the whole source.
+    '''
+    crossfade_frames = max(min(crossfade_frames, source_frames // 2), 0)
+    max_loop_frames = source_frames - crossfade_frames
+    if loop_frames is None or loop_frames > max_loop_frames:
+        loop_frames = max_loop_frames
+    return max(loop_frames, 1), crossfade_frames
+
+
+def iter_loop_frames(frames, loop_frames, crossfade_frames):
+    '''
+    Yields the loop_frames frames of a seamless loop out of a stream of loop_frames + crossfade_frames source frames.
+    The loop plays the source frames crossfade_frames to loop_frames - 1, then the source frames past them fading into
+    the first crossfade_frames source frames, so the last frame of the loop leads into its first one like the source does.
+    A source shorter than planned (an overestimated duration) holds its last frame.
+    '''
+    head = []
+    last_frame = None
+    frames_yielded = 0
+    for frame_index, frame in enumerate(frames):
+        if frame_index < crossfade_frames:
+            head.append(frame)
+            continue
+        if frame_index < loop_frames:
+            output_frame = frame
+        elif frame_index < loop_frames + crossfade_frames:
+            head_index = frame_index - loop_frames
+            weight = (head_index + 1) / (crossfade_frames + 1)
+            output_frame = np.rint((1 - weight) * frame.astype(np.float32) + weight * head[head_index]).astype(np.uint8)
+        else:
+            break
+        last_frame = output_frame
+        frames_yielded += 1
+        yield output_frame
+    for head_index in range(frames_yielded, loop_frames):
+        fadeout_index = head_index - (loop_frames - crossfade_frames)
+        if 0 <= fadeout_index < len(head):
+            yield head[fadeout_index]
+        else:
+            yield last_frame if last_frame is not None else head[-1]
+
+
+class BackgroundStore:
+    '''
+    Background videos decoded once at the render size and fps, kept as seamless loops in the shared asset cache,
+    keyed by the content hash of the source and the loop settings, so every episode reuses them.
+    A background of any length is served by looping: the loop point is hidden with a crossfade_seconds crossfade.
+
+    store_format:
+        'video': the loop encoded as H.264 with a key frame every second, compact and quick to seek
+        'frames': the raw RGB frames in a memory-mapped .npy file, no decoding at all, width * height * 3 bytes a frame
+    loop_seconds: length of the loop, default the whole source for 'video' and DEFAULT_FRAMES_LOOP_SECONDS for 'frames'
+    '''
+    def __init__(self, asset_cache, size, fps, store_format='video', loop_seconds=None, crossfade_seconds=1.0):
+        if store_format not in STORE_FORMATS:
+            raise ValueError(f"Unknown background store format {store_format}, use one of {STORE_FORMATS}")
+        self.asset_cache = asset_cache
+        self.size = tuple(size)
+        self.fps = fps
+        self.store_format = store_format
+        if loop_seconds is None and store_format == 'frames':
+            loop_seconds = DEFAULT_FRAMES_LOOP_SECONDS
+        self.loop_seconds = loop_seconds
+        self.crossfade_seconds = crossfade_seconds
+
+    def plan(self, video_path):
+        '''Returns (loop_frames, crossfade_frames) of the loop of video_path.'''
+        source_frames = int(probe_duration(video_path) * self.fps + 1e-6)
+        loop_frames = None if self.loop_seconds is None else int(round(self.loop_seconds * self.fps))
+        return plan_loop(source_frames, loop_frames, int(round(self.crossfade_seconds * self.fps)))
+
+    def fetch(self, video_path):
+        '''Returns (store_path, loop_frames), building the loop of video_path on a cache miss.'''
+        loop_frames, crossfade_frames = self.plan(video_path)
+        key = AssetCache.make_key('background', self.asset_cache.content_hash(video_path), size=list(self.size), fps=self.fps,
+                                  store_format=self.store_format, loop_frames=loop_frames, crossfade_frames=crossfade_frames)
+
+        def build_loop(temp_path):
+            print(f"Building the {loop_frames / self.fps:.1f}s background loop of {video_path} at {self.size[0]}x{self.size[1]}")
+            frames = iter_loop_frames(iter_video_frames(video_path, self.size, self.fps, loop_frames + crossfade_frames),
+                                      loop_frames, crossfade_frames)
+            if self.store_format == 'frames':
+                store = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(loop_frames, self.size[1], self.size[0], 3))
+                for frame_index, frame in enumerate(frames):
+                    store[frame_index] = frame
+                store.flush()
+                del store
+            else:
+                with FFMPEG_VideoWriter(temp_path, self.size, self.fps, codec='libx264', preset='veryfast',
+                                        ffmpeg_params=['-crf', '18', '-g', str(int(math.ceil(self.fps))), '-pix_fmt', 'yuv420p']) as writer:
+                    for frame in frames:
+                        writer.write_frame(frame)
+        store_path = self.asset_cache.fetch(key, '.npy' if self.store_format == 'frames' else '.mp4', build_loop)
+        return store_path, loop_frames
+
+    def clip(self, video_path, duration):
+        '''A clip of duration seconds playing the loop of video_path from its start, frame i is loop frame i % loop_frames.'''
+        store_path, loop_frames = self.fetch(video_path)
+        fps = self.fps
+
+        def loop_frame_index(t):
+            # the frame index rule of moviepy's readers, so a frame time maps to the same frame as in the source
+            return int(t * fps + 1e-5) % loop_frames
+        if self.store_format == 'frames':
+            frames = np.load(store_path, mmap_mode='r')
+            background_clip = VideoClip(lambda t: frames[loop_frame_index(t)])
+            background_clip.size = self.size
+        else:
+            source = VideoFileClip(store_path, audio=False)
+            background_clip = source.fl_time(lambda t: loop_frame_index(t) / fps, keep_duration=False)
+        return background_clip.set_duration(duration)
+
+
+def test_BackgroundStore():
+    '''The loop repeats exactly, its seam is no harder than a few frames of the source, a second store reuses the cache.'''
+    import os
+    import tempfile
+    from ffmpeg_utils import run_ffmpeg
+    fps = 10
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # 2 seconds whose brightness grows by 5 every frame, a hard cut back to the start would jump by 70
+        video_path = os.path.join(temp_dir, 'ramp.mp4')
+        run_ffmpeg(['-f', 'lavfi', '-i', f"nullsrc=s=96x54:r={fps}:d=2,geq=lum='16+5*N':cb=128:cr=128",
+                    '-vcodec', 'libx264', '-crf', 0, '-pix_fmt', 'yuv444p', video_path])
+        for store_format in STORE_FORMATS:
+            cache = AssetCache(os.path.join(temp_dir, 'cache'))
+            store = BackgroundStore(cache, (64, 36), fps, store_format, loop_seconds=1.5, crossfade_seconds=0.5)
+            assert store.plan(video_path) == (15, 5)
+            clip = store.clip(video_path, 10)
+            assert clip.size == (64, 36) and clip.duration == 10
+            brightness = [clip.get_frame(frame_index / fps).astype(np.float32).mean() for frame_index in range(31)]
+            assert all(abs(brightness[frame_index] - brightness[frame_index + 15]) < 1.5 for frame_index in range(16))
+            steps = np.abs(np.diff(brightness))
+            assert steps.max() < 12, steps
+            store_path, _ = store.fetch(video_path)
+            assert BackgroundStore(AssetCache(os.path.join(temp_dir, 'cache')), (64, 36), fps, store_format,
+                                   loop_seconds=1.5, crossfade_seconds=0.5).fetch(video_path)[0] == store_path
+            assert store_path.endswith('.npy' if store_format == 'frames' else '.mp4')
+    print('test_BackgroundStore passed')
+
+if __name__ == '__main__':
+    test_BackgroundStore()
@@ -0,0 +1,289 @@
+'''
+Prepares and renders every episode_N_data.json under a directory, like generate_podcast_video.ipynb does for one episode.
+Downloads run on a thread pool (I/O bound) and renders on a process pool (CPU bound), each with its own limit,
+so the next episodes download while the current ones render. The status of every episode is kept in a state file,
+an interrupted batch started again skips the finished episodes and renders prepared ones without downloading again.
+
+    python batch_render.py D:\\Study\\AIAgent\\AIPodcast\\output --io-workers 4 --cpu-workers 1
+    python batch_render.py output --pure-audio --options '{"encoder_profile": "speed"}'
+'''
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from asset_cache import AssetCache
+from podcast_data_preparation import PodcastDataPreparation
+from video_crafter import VideoCrafter
+
+EPISODE_FILE_PATTERN = re.compile(r'^episode_(\d+)_data\.json$')
+
+
+def find_episodes(episodes_dir):
+    '''Returns (episode_number, data_json_path) of every episode_N_data.json under episodes_dir, by episode number.'''
+    episodes = []
+    for root, _, files in os.walk(episodes_dir):
+        for name in files:
+            match = EPISODE_FILE_PATTERN.match(name)
+            if match:
+                episodes.append((int(match.group(1)), os.path.join(root, name)))
+    return sorted(episodes)
+
+
+def episode_output_dir(episode_number, data_json_path):
+    '''
+    The directory an episode renders into: the directory of its data file when it is the episode's own episode_N
+    directory, as the notebooks lay it out, otherwise an episode_N directory next to the data file, so episodes whose
+    data files share a directory do not overwrite each other's downloads, config and output.
+    '''
+    data_dir = os.path.dirname(data_json_path)
+    if os.path.basename(os.path.normpath(data_dir)) == f'episode_{episode_number}':
+        return data_dir
+    return os.path.join(data_dir, f'episode_{episode_number}')
+
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def render_episode_job(config):
+    '''Renders one prepared episode in a render worker process, returns the seconds it took.'''
+    time_start = time.time()
+    VideoCrafter(config).create()
+    return time.time() - time_start
+
+
+class BatchState:
+    '''
+    The persistent state of a batch, a JSON file mapping each episode, keyed by the path of its data file relative
+    to the episodes directory, to its entry:
+    status (pending, prepared, rendered or failed), the hash of its data file, config_path once prepared,
+    output_path, timings and the error of a failure. An episode whose data file changed starts over.
+    Every update is written to disk at once, with a rename so an interrupted write never corrupts the file.
+    '''
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self.episodes = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                self.episodes = json.load(f)['episodes']
+
+    def get(self, episode_key, data_json_path):
+        data_hash = _file_hash(data_json_path)
+        entry = self.episodes.get(episode_key)
+        if entry is None or entry['data_hash'] != data_hash:
+            self.update(episode_key, replace=True, status='pending', data_json_path=data_json_path, data_hash=data_hash)
+        return self.episodes[episode_key]
+
+    def update(self, episode_key, replace=False, **fields):
+        with self._lock:
+            entry = {} if replace else self.episodes.setdefault(episode_key, {})
+            entry.update(fields, updated_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+            self.episodes[episode_key] = entry
+            self.save()
+
+    def save(self):
+        temp_path = f'{self.state_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'episodes': self.episodes}, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, self.state_path)
+
+
+class BatchRenderer:
+    '''
+    Renders every episode under episodes_dir into its episode_output_dir.
+    io_workers episodes are prepared (downloaded) at once, cpu_workers rendered at once, in separate processes.
+    video_options are merged into every VideoCrafter config, e.g. {'encoder_profile': 'speed', 'segments': 4}.
+    Once the renders are done the asset cache is evicted down to its budget (cache_max_bytes of video_options).
+    '''
+    def __init__(self, episodes_dir, state_path=None, io_workers=4, cpu_workers=1, pure_audio=False, width=1920, height=1080,
+                 assets_dir=None, cache_dir=None, video_options=None):
+        self.episodes_dir = episodes_dir
+        self.state = BatchState(state_path or os.path.join(episodes_dir, 'batch_state.json'))
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.pure_audio = pure_audio
+        self.width = width
+        self.height = height
+        self.assets_dir = assets_dir
+        self.cache_dir = cache_dir
+        self.video_options = video_options or {}
+
+    def prepare_episode(self, data_json_path, output_dir):
+        '''Downloads the episode's audios into output_dir and saves its VideoCrafter config there, returns (config_path, config, seconds).'''
+        time_start = time.time()
+        preparation_kwargs = {'cache_dir': self.cache_dir}
+        if self.assets_dir:
+            preparation_kwargs['assets_dir'] = self.assets_dir
+        preparation = PodcastDataPreparation(data_json_path, output_dir, self.width, self.height, **preparation_kwargs)
+        try:
+            config = preparation.prepare_pure_audio_data() if self.pure_audio else preparation.prepare_data()
+        finally:
+            preparation.downloader.close()
+        config.update(self.video_options)
+        config_path = os.path.join(output_dir, 'pure_audio_info_config.json' if self.pure_audio else 'video_info_config.json')
+        temp_path = f'{config_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, config_path)
+        return config_path, config, time.time() - time_start
+
+    def _is_renderable(self, entry):
+        # prepared, or failed while rendering, with its config still on disk
+        resumable = entry['status'] == 'prepared' or (entry['status'] == 'failed' and entry.get('failed_stage') == 'render')
+        return resumable and os.path.exists(entry.get('config_path', ''))
+
+    def run(self):
+        '''Runs the batch, returns the summary dict also printed by print_summary.'''
+        time_start = time.time()
+        rendered, failed, skipped = [], [], []
+        # renders run in fresh processes, forking a process that has download threads running could copy held locks
+        process_context = multiprocessing.get_context('spawn')
+        with ThreadPoolExecutor(max_workers=self.io_workers) as io_pool, \
+                ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=process_context) as cpu_pool:
+            running = {}
+
+            def submit_render(episode_key, config):
+                print(f"Episode {episode_key}: rendering {config['output_path']}")
+                running[cpu_pool.submit(render_episode_job, config)] = ('render', episode_key)
+
+            for episode_number, data_json_path in find_episodes(self.episodes_dir):
+                episode_key = os.path.relpath(data_json_path, self.episodes_dir).replace(os.sep, '/')
+                entry = self.state.get(episode_key, data_json_path)
+                if entry['status'] == 'rendered' and os.path.exists(entry.get('output_path', '')):
+                    skipped.append(episode_key)
+                elif self._is_renderable(entry):
+                    with open(entry['config_path'], 'r', encoding='utf-8') as f:
+                        submit_render(episode_key, json.load(f))
+                else:
+                    output_dir = episode_output_dir(episode_number, data_json_path)
+                    running[io_pool.submit(self.prepare_episode, data_json_path, output_dir)] = ('prepare', episode_key)
+            print(f"Batch of {len(running) + len(skipped)} episodes: {len(skipped)} already rendered, {len(running)} to do")
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, episode_key = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Episode {episode_key}: {stage} failed: {e}")
+                        self.state.update(episode_key, status='failed', failed_stage=stage, error=f'{type(e).__name__}: {e}')
+                        failed.append(episode_key)
+                        continue
+                    if stage == 'prepare':
+                        config_path, config, prepare_seconds = result
+                        self.state.update(episode_key, status='prepared', config_path=config_path, output_path=config['output_path'],
+                                          prepare_seconds=round(prepare_seconds, 2), error=None)
+                        submit_render(episode_key, config)
+                    else:
+                        self.state.update(episode_key, status='rendered', render_seconds=round(result, 2), error=None)
+                        rendered.append(episode_key)
+
+        freed_bytes = AssetCache(self.cache_dir, self.video_options.get('cache_max_bytes')).evict()
+        summary = {'rendered': rendered, 'failed': failed, 'skipped': skipped, 'seconds': round(time.time() - time_start, 2),
+                   'cache_freed_bytes': freed_bytes}
+        summary['episodes_per_hour'] = round(len(rendered) / summary['seconds'] * 3600, 2) if summary['seconds'] > 0 else 0
+        print_summary(summary)
+        return summary
+
+
+def print_summary(summary):
+    print(f"Batch finished in {summary['seconds'] / 60:.1f} minutes: {len(summary['rendered'])} rendered, "
+          f"{len(summary['skipped'])} already rendered, {len(summary['failed'])} failed")
+    if summary['rendered']:
+        print(f"Throughput: {summary['episodes_per_hour']:.2f} episodes/hour")
+    if summary['cache_freed_bytes']:
+        print(f"Evicted {summary['cache_freed_bytes'] / 1024 ** 2:.1f} MB from the asset cache")
+    if summary['failed']:
+        print(f"Failed episodes: {', '.join(summary['failed'])}, run the batch again to retry them")
+
+
+def test_BatchRenderer():
+    '''
+    Two synthetic pure-audio episodes: a batch renders both, a second run skips them, a changed script is rendered again.
+    Two different episodes whose data files share a directory render into their own directories.
+    '''
+    import tempfile
+    from benchmark import SyntheticEpisode, serve_directory
+    with tempfile.TemporaryDirectory() as temp_dir:
+        episode = SyntheticEpisode(os.path.join(temp_dir, 'assets'), 4)
+        episode.build()
+        episodes_dir = os.path.join(temp_dir, 'output')
+        data_json_paths = []
+        with serve_directory(episode.clips_dir) as base_url:
+            for episode_number in (1, 2):
+                data_json_paths.append(os.path.join(episodes_dir, f'episode_{episode_number}', f'episode_{episode_number}_data.json'))
+                os.makedirs(os.path.dirname(data_json_paths[-1]))
+                episode.write_podcast_json(data_json_paths[-1], base_url)
+
+            def run_batch(episodes_dir=episodes_dir):
+                return BatchRenderer(episodes_dir, io_workers=2, cpu_workers=2, pure_audio=True, assets_dir=episode.assets_dir,
+                                     cache_dir=os.path.join(temp_dir, 'cache')).run()
+            keys = ['episode_1/episode_1_data.json', 'episode_2/episode_2_data.json']
+            summary = run_batch()
+            assert sorted(summary['rendered']) == keys and not summary['failed']
+            assert all(os.path.exists(os.path.join(os.path.dirname(path), 'output.mp3')) for path in data_json_paths)
+            summary = run_batch()
+            assert summary['rendered'] == [] and sorted(summary['skipped']) == keys
+
+            with open(data_json_paths[1], 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            data['result'].pop()
+            with open(data_json_paths[1], 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            summary = run_batch()
+            assert summary['rendered'] == keys[1:] and summary['skipped'] == keys[:1]
+
+            flat_dir = os.path.join(temp_dir, 'flat')
+            os.makedirs(flat_dir)
+            for episode_number in (3, 4):
+                data_json_path = os.path.join(flat_dir, f'episode_{episode_number}_data.json')
+                episode.write_podcast_json(data_json_path, base_url)
+            # episode 4 has one sentence less, so the two renders differ
+            with open(data_json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            data['result'].pop()
+            with open(data_json_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            summary = run_batch(flat_dir)
+            assert sorted(summary['rendered']) == ['episode_3_data.json', 'episode_4_data.json'] and not summary['failed']
+            configs = []
+            for episode_number in (3, 4):
+                with open(os.path.join(flat_dir, f'episode_{episode_number}', 'pure_audio_info_config.json'), 'r', encoding='utf-8') as f:
+                    configs.append(json.load(f))
+                assert configs[-1]['output_path'] == os.path.join(flat_dir, f'episode_{episode_number}', 'output.mp3')
+                assert os.path.exists(configs[-1]['output_path'])
+            assert len(configs[0]['clips']) == len(configs[1]['clips']) + 1
+            assert not os.path.exists(os.path.join(flat_dir, 'output.mp3'))
+    print('test_BatchRenderer passed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('episodes_dir', help='directory searched for episode_N_data.json files, each episode is rendered '
+                        'in its episode_N directory, created next to the file unless the file is already in it')
+    parser.add_argument('--state-file', help='default <episodes_dir>/batch_state.json')
+    parser.add_argument('--io-workers', type=int, default=4, help='episodes downloading at once')
+    parser.add_argument('--cpu-workers', type=int, default=1, help='episodes rendering at once, each render also uses several cores')
+    parser.add_argument('--pure-audio', action='store_true', help='render mp3 episodes instead of videos')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--assets-dir', help='BGM, background, cover and logo, default the PodcastDataPreparation default')
+    parser.add_argument('--cache-dir', help='shared asset cache, default ~/.cache/aipodcast')
+    parser.add_argument('--options', type=json.loads, default={}, help='JSON merged into every VideoCrafter config')
+    args = parser.parse_args()
+    BatchRenderer(args.episodes_dir, args.state_file, args.io_workers, args.cpu_workers, args.pure_audio, args.width, args.height,
+                  args.assets_dir, args.cache_dir, args.options).run()
+
+if __name__ == '__main__':
+    main()
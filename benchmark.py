@@ -0,0 +1,324 @@
+'''
+Offline benchmark of the podcast pipeline on synthetic episodes.
+Builds episodes of generated audio clips, key frames, BGM, background video and mixed Chinese/English subtitles,
+serves the clips from a local http server so the download stage runs too, and times every stage separately.
+
+    python benchmark.py --clips 10 100 1000 --modes pure_audio fast_video classic_video --output bench.json
+    python benchmark.py --clips 100 --modes fast_video libass_video
+    python benchmark.py --compare bench_before.json bench.json
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from PIL import Image, ImageDraw
+from ffmpeg_utils import run_ffmpeg, encode_audio
+from podcast_data_preparation import PodcastDataPreparation
+from subtitle_export import write_ass
+from subtitle_renderer import SubtitleRasterizer
+from video_crafter import VideoCrafter
+
+# libass_video is fast_video with the subtitles burnt in by the encoder (subtitle renderer 'libass')
+MODES = ['pure_audio', 'fast_video', 'classic_video', 'libass_video']
+STAGES = ['prepare', 'stretch', 'build', 'subtitle_layout', 'audio_mix', 'frame_composition', 'encode']
+
+CHINESE_PHRASES = ['大家好，我是一朵。', '今天我们聊一本书，', '书名就叫《自控力》。', '其实这本书我很早就读过了，', '原来如此。',
+                   '（恍然大悟）', '啊，我懂了，', '我们该做却总是拖延的事情，', '对吧？', '（笑）']
+ENGLISH_PHRASES = ['This is a test subtitle', 'willpower', 'the marshmallow test', 'OK', 'self-control is a muscle',
+                   'in other words', 'Kelly McGonigal', 'so what do we do?']
+
+
+class SyntheticEpisode:
+    '''
+    Generates the assets of an episode of n_clips clips in assets_dir, files already there are reused.
+    Clips are sine tones or noise of 1 to 2.5 seconds, mostly mp3 with some wav.
+    '''
+    def __init__(self, assets_dir, n_clips, width=640, height=360, seed=0):
+        self.assets_dir = assets_dir
+        self.clips_dir = os.path.join(assets_dir, 'clips')
+        self.n_clips = n_clips
+        self.width = width
+        self.height = height
+        self.random = random.Random(seed)
+        self.clip_names = []
+        self.clip_durations = []
+        self.sentences = []
+        self.key_frame_paths = []
+        for clip_index in range(n_clips):
+            extension = '.wav' if clip_index % 7 == 6 else '.mp3'
+            self.clip_names.append(f'clip_{clip_index:05d}{extension}')
+            self.clip_durations.append(round(self.random.uniform(1, 2.5), 2))
+            self.sentences.append(self._make_sentence())
+
+    def _make_sentence(self):
+        pieces = [self.random.choice(CHINESE_PHRASES if self.random.random() < 0.7 else ENGLISH_PHRASES)
+                  for _ in range(self.random.randint(1, 4))]
+        return ' '.join(pieces) if self.random.random() < 0.3 else ''.join(pieces)
+
+    def build(self):
+        os.makedirs(self.clips_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            list(executor.map(self._write_clip, range(self.n_clips)))
+        for image_index in range(8):
+            path = os.path.join(self.assets_dir, f'key_frame_{image_index}.png')
+            self.key_frame_paths.append(path)
+            if not os.path.exists(path):
+                self._write_key_frame(path, image_index)
+        self._write_logo(os.path.join(self.assets_dir, 'logo.png'))
+        self._write_key_frame(os.path.join(self.assets_dir, 'cover.png'), 99)
+        bgm_duration = int(sum(self.clip_durations) * 1.2 + 0.3 * self.n_clips + 30)
+        bgm_path = os.path.join(self.assets_dir, 'lounge_jazz.mp3')
+        if not os.path.exists(bgm_path) or _media_duration(bgm_path) < bgm_duration:
+            run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency=220:duration={bgm_duration}', '-f', 'lavfi', '-i', f'sine=frequency=330:duration={bgm_duration}',
+                        '-filter_complex', 'amix=inputs=2', '-ac', 2, '-ar', 44100, bgm_path])
+        background_path = os.path.join(self.assets_dir, 'raining_window_10min.mp4')
+        if not os.path.exists(background_path):
+            run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc=size={self.width}x{self.height}:rate=24:duration=10', '-pix_fmt', 'yuv420p', background_path])
+
+    def _write_clip(self, clip_index):
+        path = os.path.join(self.clips_dir, self.clip_names[clip_index])
+        if os.path.exists(path):
+            return
+        duration = self.clip_durations[clip_index]
+        if clip_index % 3 == 2:
+            source = f'anoisesrc=duration={duration}:amplitude=0.1:seed={clip_index}'
+        else:
+            source = f'sine=frequency={200 + clip_index % 50 * 10}:duration={duration}'
+        temp_path = path + '.tmp' + os.path.splitext(path)[1]
+        run_ffmpeg(['-f', 'lavfi', '-i', source, '-ac', 2, '-ar', 44100, temp_path])
+        os.replace(temp_path, path)
+
+    def _write_key_frame(self, path, image_index):
+        image = Image.new('RGB', (1280, 720))
+        draw = ImageDraw.Draw(image)
+        for y in range(0, 720, 8):
+            draw.rectangle([0, y, 1280, y + 8], fill=((y + image_index * 40) % 256, (image_index * 70) % 256, 255 - y % 256))
+        draw.ellipse([440, 160, 840, 560], fill=(255, 255, 255), outline=(0, 0, 0), width=10)
+        image.save(path)
+
+    def _write_logo(self, path):
+        if os.path.exists(path):
+            return
+        image = Image.new('RGBA', (400, 400), (0, 0, 0, 0))
+        ImageDraw.Draw(image).ellipse([20, 20, 380, 380], fill=(255, 140, 0, 255))
+        image.save(path)
+
+    def write_podcast_json(self, json_path, base_url):
+        result = [{'audio_url': f'{base_url}/{name}', 'character': 'boy' if clip_index % 2 == 0 else 'girl', 'sentence': sentence}
+                  for clip_index, (name, sentence) in enumerate(zip(self.clip_names, self.sentences))]
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({'result': result}, f, ensure_ascii=False)
+
+    def decorate_config(self, config):
+        '''Gives the body clips of a prepared config varied key frames and movements, like a real episode.'''
+        for clip_index, clip_config in enumerate(config['clips'][2:]):
+            if clip_index % 5 == 0:
+                clip_config['key_frame_path'] = self.key_frame_paths[clip_index // 5 % len(self.key_frame_paths)]
+                if clip_index % 15 == 5:
+                    clip_config['movement'] = {'type': 'zoom', 'start_resize_ratio': 1.0, 'end_resize_ratio': 1.2}
+                elif clip_index % 15 == 10:
+                    clip_config['movement'] = {'type': 'pan'}
+        return config
+
+
+def _media_duration(path):
+    from ffmpeg_utils import decode_audio
+    return decode_audio(path, with_duration=True)[1]
+
+
+@contextmanager
+def serve_directory(directory):
+    '''Serves directory over http on a free local port, yields the base url.'''
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - time_start
+
+
+def run_episode(episode, mode, work_dir, options=None):
+    '''Runs one mode on one synthetic episode with a cold asset cache, returns the result dict.'''
+    timer = StageTimer()
+    output_dir = os.path.join(work_dir, 'output')
+    cache_dir = os.path.join(work_dir, 'cache')
+    json_path = os.path.join(work_dir, 'podcast.json')
+    with serve_directory(episode.clips_dir) as base_url:
+        episode.write_podcast_json(json_path, base_url)
+        preparation = PodcastDataPreparation(json_path, output_dir, episode.width, episode.height, key_frame_path=episode.key_frame_paths[0],
+                                             cache_dir=cache_dir, assets_dir=episode.assets_dir)
+        with timer.stage('prepare'):
+            config = preparation.prepare_pure_audio_data() if mode == 'pure_audio' else preparation.prepare_data()
+        preparation.downloader.close()
+    if mode != 'pure_audio':
+        episode.decorate_config(config)
+        config['subtitle_config']['fontsize'] = max(int(episode.height / 20), 10)
+        if mode == 'libass_video':
+            config['subtitle_config']['renderer'] = 'libass'
+    config.update(options or {})
+    video_crafter = VideoCrafter(config)
+    with timer.stage('stretch'):
+        video_crafter.prepare_stretched_audios()
+
+    if mode == 'pure_audio':
+        with timer.stage('audio_mix'):
+            samples = video_crafter.mix_final_audio()
+        with timer.stage('encode'):
+            encode_audio(samples, 44100, video_crafter.output_path)
+        episode_duration = len(samples) / 44100
+    else:
+        timeline_layout = video_crafter.build_timeline_layout() if mode == 'classic_video' else None
+        with timer.stage('build'):
+            if mode in ('fast_video', 'libass_video'):
+                final_video = video_crafter.build_video_fast()
+                timeline_layout = video_crafter.clips_info_dicts
+            else:
+                final_video = video_crafter.build_video()
+        with timer.stage('subtitle_layout'):
+            subtitle_config = config['subtitle_config']
+            if mode == 'libass_video':
+                # libass lays the cues out in the encoder, the script is all that is prepared in python
+                write_ass(video_crafter.get_subtitle_cues(timeline_layout, subtitle_config), os.path.join(work_dir, 'subtitles.ass'),
+                          subtitle_config, video_crafter.width, video_crafter.height)
+            else:
+                rasterizer = SubtitleRasterizer.from_subtitle_config(subtitle_config)
+                for _, text in video_crafter.get_subtitle_cues(timeline_layout, subtitle_config):
+                    rasterizer.render(text)
+        with timer.stage('audio_mix'):
+            final_video.audio.write_audiofile(os.path.join(work_dir, 'audio.m4a'), fps=44100, codec='aac', logger=None)
+        n_frames = int(math.ceil(final_video.duration * video_crafter.fps - 1e-6))
+        with timer.stage('frame_composition'):
+            for frame_index in range(n_frames):
+                final_video.get_frame(frame_index / video_crafter.fps)
+        # writing composes the frames and renders the audio again, the encode time is what is left of the write
+        time_start = time.perf_counter()
+        if mode in ('fast_video', 'libass_video'):
+            video_crafter._write_video(final_video, timeline_layout=video_crafter.clips_info_dicts)
+        else:
+            video_crafter._write_video(final_video)
+        write_time = time.perf_counter() - time_start
+        timer.stages['write'] = write_time
+        timer.stages['encode'] = max(write_time - timer.stages['frame_composition'] - timer.stages['audio_mix'], 0)
+        episode_duration = final_video.duration
+    return {
+        'mode': mode,
+        'clips': episode.n_clips,
+        'episode_duration': round(episode_duration, 3),
+        'stages': {name: round(seconds, 4) for name, seconds in timer.stages.items()},
+        'total': round(sum(seconds for name, seconds in timer.stages.items() if name != 'write'), 4),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(clip_counts=(10, 100, 1000), modes=MODES, width=640, height=360, assets_dir=None, options=None):
+    assets_root = assets_dir or os.path.join(tempfile.gettempdir(), 'aipodcast_benchmark_assets')
+    results = []
+    for n_clips in clip_counts:
+        episode = SyntheticEpisode(os.path.join(assets_root, f'{n_clips}_clips_{width}x{height}'), n_clips, width, height)
+        time_start = time.time()
+        episode.build()
+        print(f"Synthetic episode of {n_clips} clips ready in {time.time() - time_start:.2f} seconds")
+        for mode in modes:
+            work_dir = tempfile.mkdtemp(prefix=f'bench_{mode}_{n_clips}_')
+            try:
+                result = run_episode(episode, mode, work_dir, options)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            results.append(result)
+            print(format_result(result))
+    return {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'settings': {'width': width, 'height': height, 'options': options or {}},
+        'results': results,
+    }
+
+
+def format_result(result):
+    stages = ', '.join(f"{name} {result['stages'][name]:.2f}s" for name in STAGES if name in result['stages'])
+    return f"{result['mode']:>14} {result['clips']:>5} clips ({result['episode_duration']:.0f}s): total {result['total']:.2f}s | {stages}"
+
+
+def compare_results(base, new):
+    '''Prints the stage times of new relative to base, for the (mode, clips) present in both.'''
+    base_results = {(result['mode'], result['clips']): result for result in base['results']}
+    print(f"base {base.get('commit')} -> new {new.get('commit')}")
+    for result in new['results']:
+        base_result = base_results.get((result['mode'], result['clips']))
+        if base_result is None:
+            continue
+        print(f"{result['mode']} {result['clips']} clips")
+        for name in STAGES + ['total']:
+            base_time = base_result['total'] if name == 'total' else base_result['stages'].get(name)
+            new_time = result['total'] if name == 'total' else result['stages'].get(name)
+            if base_time is None or new_time is None:
+                continue
+            ratio = f'{base_time / new_time:.2f}x' if new_time > 0 else '-'
+            print(f"    {name:>18}: {base_time:8.2f}s -> {new_time:8.2f}s  {ratio}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clips', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--assets-dir', help='where the synthetic episodes are generated and reused, default a temp dir')
+    parser.add_argument('--options', type=json.loads, default={}, help='JSON merged into every VideoCrafter config')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as f:
+            base = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            new = json.load(f)
+        compare_results(base, new)
+        return
+    report = run_benchmark(args.clips, args.modes, args.width, args.height, args.assets_dir, args.options)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+if __name__ == '__main__':
+    main()
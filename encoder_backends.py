@@ -0,0 +1,146 @@
+from ffmpeg_utils import FFmpegError, run_ffmpeg
+
+# named encoder profiles, the ffmpeg_params come after moviepy's own '-preset medium' so they override it
+ENCODER_PROFILES = {
+    'nvenc': {
+        'codec': 'h264_nvenc',
+        'ffmpeg_params': [
+            "-b:v", "5M",  # Adjust the bitrate as needed
+            "-preset", "fast",  # Speed up encoding
+            "-rc", "vbr",  # Variable bitrate control for better performance
+            "-gpu", "0"  # Ensure the GPU is used if multiple are available
+        ],
+    },
+    'x264_ultrafast': {'codec': 'libx264', 'ffmpeg_params': ['-preset', 'ultrafast', '-crf', '23']},
+    'x264_veryfast': {'codec': 'libx264', 'ffmpeg_params': ['-preset', 'veryfast', '-crf', '23']},
+    'x264_medium': {'codec': 'libx264', 'ffmpeg_params': ['-preset', 'medium', '-crf', '21']},
+    'x264_slow': {'codec': 'libx264', 'ffmpeg_params': ['-preset', 'slow', '-crf', '23']},
+    'x265_fast': {'codec': 'libx265', 'ffmpeg_params': ['-preset', 'fast', '-crf', '28', '-tag:v', 'hvc1']},
+    'x265_medium': {'codec': 'libx265', 'ffmpeg_params': ['-preset', 'medium', '-crf', '28', '-tag:v', 'hvc1']},
+}
+
+# encoder_profile can also name a speed/size trade-off, the first profile that works on this machine is used
+ENCODER_TRADEOFFS = {
+    'speed': ['nvenc', 'x264_ultrafast'],
+    'balanced': ['nvenc', 'x264_veryfast'],
+    'size': ['x265_medium', 'x264_slow'],
+}
+DEFAULT_ENCODER_PROFILE = 'balanced'
+FALLBACK_ENCODER_PROFILE = 'x264_veryfast'
+
+_probed_codecs = {}
+
+
+def probe_encoder(codec):
+    '''
+    True if ffmpeg can encode with codec on this machine. Hardware encoders are listed by ffmpeg builds
+    even without the hardware, so every codec is checked with a one-frame test encode. Memoized per process.
+    '''
+    if codec not in _probed_codecs:
+        try:
+            run_ffmpeg(['-f', 'lavfi', '-i', 'color=size=256x256:rate=24', '-frames:v', 1,
+                        '-vcodec', codec, '-pix_fmt', 'yuv420p', '-f', 'null', '-'])
+            _probed_codecs[codec] = True
+        except (FFmpegError, OSError):
+            _probed_codecs[codec] = False
+    return _probed_codecs[codec]
+
+
+def select_encoder_profile(preference=None):
+    '''
+    preference is a profile name of ENCODER_PROFILES or a trade-off of ENCODER_TRADEOFFS, default 'balanced'.
+    Returns the name of the first profile whose codec works here, falling back to FALLBACK_ENCODER_PROFILE.
+    '''
+    preference = preference or DEFAULT_ENCODER_PROFILE
+    if preference in ENCODER_TRADEOFFS:
+        candidates = ENCODER_TRADEOFFS[preference]
+    elif preference in ENCODER_PROFILES:
+        candidates = [preference]
+    else:
+        raise ValueError(f"Unknown encoder_profile {preference}, use one of {sorted(ENCODER_PROFILES) + sorted(ENCODER_TRADEOFFS)}")
+    for profile_name in candidates:
+        if probe_encoder(ENCODER_PROFILES[profile_name]['codec']):
+            return profile_name
+        print(f"Encoder {ENCODER_PROFILES[profile_name]['codec']} is not available, skipping profile {profile_name}")
+    print(f"Falling back to encoder profile {FALLBACK_ENCODER_PROFILE}")
+    return FALLBACK_ENCODER_PROFILE
+
+
+class EncoderBackend:
+    '''
+    The video encoder used by VideoCrafter, chosen from a named profile, every video write goes through its settings.
+    The achieved render fps is logged with log_render_speed, to tune the profile per machine.
+    '''
+    def __init__(self, profile_name, threads=8):
+        profile = ENCODER_PROFILES[profile_name]
+        self.profile_name = profile_name
+        self.codec = profile['codec']
+        self.ffmpeg_params = list(profile['ffmpeg_params'])
+        self.threads = threads
+
+    @classmethod
+    def from_config(cls, config):
+        '''Uses the encoder_profile and encoder_threads keys of a VideoCrafter config.'''
+        return cls(select_encoder_profile(config.get('encoder_profile')), config.get('encoder_threads', 8))
+
+    def output_params(self):
+        '''The profile's ffmpeg output options with the encoder thread count, for the ffmpeg writers outside moviepy.'''
+        return self.ffmpeg_params + ['-threads', str(self.threads)]
+
+    def write_videofile(self, clip, output_path, fps, audio_codec='aac', extra_ffmpeg_params=None):
+        '''extra_ffmpeg_params are appended to the profile's, e.g. a video filter.'''
+        clip.write_videofile(
+            output_path,
+            codec=self.codec,
+            audio_codec=audio_codec,
+            fps=fps,
+            threads=self.threads,  # Use multiple threads for video processing
+            # moviepy only asks libx264 for yuv420p, libx265 would keep the RGB input as 4:4:4 (Rext) most players refuse
+            ffmpeg_params=self.ffmpeg_params + ['-pix_fmt', 'yuv420p'] + list(extra_ffmpeg_params or [])
+        )
+
+
+def log_render_speed(profile_name, n_frames, seconds, encode_seconds=None):
+    '''
+    seconds is the whole write, composing the frames included, which gives the render fps. encode_seconds is the write
+    time minus the frame composition time, which gives the encoder throughput.
+    '''
+    line = f"Rendered {n_frames} frames with encoder profile {profile_name} at {n_frames / max(seconds, 1e-6):.1f} fps"
+    if encode_seconds is not None:
+        line += f", encoder throughput {n_frames / max(encode_seconds, 1e-6):.1f} fps"
+    print(line)
+
+
+def test_select_encoder_profile():
+    assert probe_encoder('libx264')
+    assert not probe_encoder('no_such_encoder')
+    assert select_encoder_profile('x264_medium') == 'x264_medium'
+    assert select_encoder_profile('speed') in ('nvenc', 'x264_ultrafast')
+    _probed_codecs['libx265'] = False
+    assert select_encoder_profile('x265_medium') == FALLBACK_ENCODER_PROFILE
+    del _probed_codecs['libx265']
+    assert EncoderBackend('x264_ultrafast', threads=3).output_params() == ['-preset', 'ultrafast', '-crf', '23', '-threads', '3']
+    print('test_select_encoder_profile passed')
+
+def test_write_videofile_pixel_format():
+    '''Every profile that can encode here writes yuv420p, the pixel format players and browsers decode.'''
+    import os
+    import re
+    import tempfile
+    from moviepy.editor import ColorClip
+    clip = ColorClip(size=(64, 36), color=(200, 30, 60)).set_duration(0.5)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for profile_name, profile in ENCODER_PROFILES.items():
+            if not probe_encoder(profile['codec']):
+                print(f"{profile['codec']} is not available, {profile_name} is not checked")
+                continue
+            output_path = os.path.join(temp_dir, f'{profile_name}.mp4')
+            EncoderBackend(profile_name, threads=2).write_videofile(clip, output_path, 24, audio_codec=None)
+            _, stderr = run_ffmpeg(['-i', output_path, '-f', 'null', '-t', 0, '-'], return_stderr=True, loglevel='info')
+            stream = re.search(r'Stream #0:0.*Video: (.*)', stderr.decode('utf-8', errors='replace')).group(1)
+            assert re.search(r'\byuv420p\b', stream), (profile_name, stream)
+    print('test_write_videofile_pixel_format passed')
+
+if __name__ == '__main__':
+    test_select_encoder_profile()
+    # test_write_videofile_pixel_format()
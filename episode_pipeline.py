@@ -0,0 +1,173 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from audio_mixer import AudioMixer
+from ffmpeg_utils import encode_audio
+from video_crafter import VideoCrafter
+
+_END_OF_CLIPS = object()
+
+
+class EpisodePipeline:
+    '''
+    Prepares and renders an episode as one pipeline instead of prepare_data() followed by VideoCrafter(config).create().
+    Each clip flows through download, stretch, decode and timeline placement as soon as it is ready: asyncio coordinates
+    the stages and the blocking work runs on thread pools (downloads, and ffmpeg runs in its own processes).
+    The clips are mixed and placed on the timeline in script order while later clips are still downloading,
+    and their key frames are resized into the asset cache, so the network and CPU work overlap and the wall time
+    tends to max(network, CPU) instead of their sum. The video frames are rendered once the timeline is complete,
+    with the segmented renderer (set segments in video_options to render the segments in parallel).
+
+    preparation is a PodcastDataPreparation, video_options are merged into the VideoCrafter config.
+    At most max_clips_in_flight clips are decoded ahead of the placement, which bounds the PCM held in memory.
+    '''
+    def __init__(self, preparation, pure_audio=False, video_options=None, cpu_workers=None, max_clips_in_flight=None):
+        self.preparation = preparation
+        self.pure_audio = pure_audio
+        self.video_options = video_options or {}
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.max_clips_in_flight = max_clips_in_flight or 4 * self.cpu_workers
+
+    def run(self):
+        '''Runs the pipeline, also from a notebook whose event loop is already running.'''
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.run_async())
+        # asyncio.run cannot nest in a running loop (Jupyter), the pipeline gets a loop of its own in a thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.run_async()).result()
+
+    async def run_async(self):
+        if self.pure_audio:
+            config = self.preparation.prepare_pure_audio_data(stream=True)
+        else:
+            config = self.preparation.prepare_data(stream=True)
+        clip_configs = config['clips']
+        config['clips'] = []
+        config.update(self.video_options)
+        video_crafter = VideoCrafter(config)
+        # the clips are stretched one by one below, not up front
+        video_crafter.stretched_audio_paths = {}
+        self.mixer = AudioMixer(fps=44100, nchannels=2, pcm_cache=video_crafter.pcm_cache, loudness=video_crafter.loudness)
+        self.timeline_layout = []
+        metrics = video_crafter.metrics
+        metrics.set('output_path', video_crafter.output_path)
+        metrics.set('mode', 'pipeline_pure_audio' if self.pure_audio else 'pipeline')
+        try:
+            with ThreadPoolExecutor(max_workers=self.cpu_workers) as cpu_executor, ThreadPoolExecutor(max_workers=1) as script_executor:
+                with metrics.stage('pipeline') as stage:
+                    # the background loop is built here while the clips flow, the segment processes only read it
+                    background = None if self.pure_audio else asyncio.get_running_loop().run_in_executor(cpu_executor, video_crafter.prefetch_background)
+                    queue = asyncio.Queue(maxsize=self.max_clips_in_flight)
+                    producer = asyncio.ensure_future(self._produce_clips(video_crafter, iter(clip_configs), queue, cpu_executor, script_executor))
+                    try:
+                        await self._place_clips(video_crafter, queue)
+                        await producer
+                    finally:
+                        producer.cancel()
+                    if background is not None:
+                        await background
+                    stage['clips'] = len(self.timeline_layout)
+                final_audio = self.mixer.end_mix(video_crafter.bgm_path if video_crafter.bgm_path and video_crafter.bgm_path != -1 else None,
+                                                 video_crafter.bgm_volume, video_crafter.audio_fadeout_duration)
+            if self.pure_audio:
+                with metrics.stage('audio_encode'):
+                    encode_audio(final_audio, 44100, video_crafter.output_path)
+            else:
+                video_crafter.create_video_segmented(self.timeline_layout, final_audio)
+            metrics.set('status', 'succeeded')
+        except BaseException:
+            metrics.set('status', 'failed')
+            raise
+        finally:
+            metrics.set('cache_freed_bytes', video_crafter.asset_cache.evict())
+            metrics.set('clips', len(self.timeline_layout))
+            metrics.finish()
+        print(f"Pipeline wrote {video_crafter.output_path}")
+        return video_crafter.output_path
+
+    async def _produce_clips(self, video_crafter, clip_configs, queue, cpu_executor, script_executor):
+        '''Reads the clips as the script is parsed and downloaded, and queues a stretch and decode task for each, in order.'''
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # the clips generator downloads ahead on its own pool, one thread keeps its calls in sequence
+                clip_config = await loop.run_in_executor(script_executor, next, clip_configs, _END_OF_CLIPS)
+                if clip_config is _END_OF_CLIPS:
+                    break
+                video_crafter.clips_config.append(clip_config)
+                task = asyncio.ensure_future(self._prepare_clip(video_crafter, clip_config, loop, cpu_executor))
+                await queue.put((clip_config, task))
+        finally:
+            await queue.put(None)
+
+    async def _prepare_clip(self, video_crafter, clip_config, loop, cpu_executor):
+        '''Stretches and decodes the clip's audio and resizes its key frame, returns (mixer_clip, decoded_clip).'''
+        mixer_clip = await loop.run_in_executor(cpu_executor, video_crafter.make_mixer_clip, clip_config)
+        decoded_clip = await loop.run_in_executor(cpu_executor, self.mixer.decode_clip, mixer_clip)
+        if not self.pure_audio and clip_config.get('key_frame_path') and clip_config['key_frame_path'] != -1:
+            # warms the asset cache for the segment renderers, the clip itself is built again there
+            await loop.run_in_executor(cpu_executor, video_crafter.create_image_clip, clip_config, decoded_clip[1] / self.mixer.fps)
+        return mixer_clip, decoded_clip
+
+    async def _place_clips(self, video_crafter, queue):
+        '''Mixes the clips and appends them to the timeline layout in script order, as they are decoded.'''
+        self.mixer.begin_mix()
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            clip_config, task = item
+            mixer_clip, decoded_clip = await task
+            start_sample, _, end_sample = self.mixer.add_clip(mixer_clip, decoded_clip)
+            self.timeline_layout.append({
+                'start_time': start_sample / self.mixer.fps,
+                'duration': (end_sample - start_sample) / self.mixer.fps,
+                'subtitle_text': clip_config.get('subtitle_text', ''),
+                'has_image': bool(clip_config.get('key_frame_path')) and clip_config['key_frame_path'] != -1,
+                'movement': clip_config.get('movement'),
+                'fadeout_duration': clip_config.get('fadeout_duration', 0),
+            })
+            video_crafter.metrics.progress('pipeline', len(self.timeline_layout), None)
+
+
+def test_EpisodePipeline():
+    '''The pipeline places the clips where prepare_data + VideoCrafter does, for pure audio and video outputs.'''
+    import tempfile
+    from moviepy.editor import VideoFileClip
+    from benchmark import SyntheticEpisode, serve_directory
+    from ffmpeg_utils import decode_audio
+    from podcast_data_preparation import PodcastDataPreparation
+    with tempfile.TemporaryDirectory() as temp_dir:
+        episode = SyntheticEpisode(os.path.join(temp_dir, 'assets'), 6, 160, 90)
+        episode.build()
+        json_path = os.path.join(temp_dir, 'podcast.json')
+        with serve_directory(episode.clips_dir) as base_url:
+            episode.write_podcast_json(json_path, base_url)
+
+            def make_preparation(name):
+                return PodcastDataPreparation(json_path, os.path.join(temp_dir, name), 160, 90, key_frame_path=episode.key_frame_paths[0],
+                                              cache_dir=os.path.join(temp_dir, 'cache'), assets_dir=episode.assets_dir)
+            pipeline = EpisodePipeline(make_preparation('pipeline_audio'), pure_audio=True, cpu_workers=2, max_clips_in_flight=2)
+            output_path = pipeline.run()
+            expected = VideoCrafter(make_preparation('sequential_audio').prepare_pure_audio_data()).mix_final_audio()
+            assert abs(pipeline.timeline_layout[-1]['start_time'] + pipeline.timeline_layout[-1]['duration'] - len(expected) / 44100) < 1e-3
+            # mp3 adds its encoder delay and padding
+            assert abs(len(decode_audio(output_path)) - len(expected)) < 44100 * 0.05
+
+            pipeline = EpisodePipeline(make_preparation('pipeline_video'), video_options={'fps': 12})
+            video_path = pipeline.run()
+            expected_layout = VideoCrafter(make_preparation('sequential_video').prepare_data()).build_timeline_layout()
+        assert len(pipeline.timeline_layout) == len(expected_layout)
+        for placed, expected_clip in zip(pipeline.timeline_layout, expected_layout):
+            assert abs(placed['start_time'] - expected_clip['start_time']) < 1e-3 and abs(placed['duration'] - expected_clip['duration']) < 1e-3
+            assert {key: value for key, value in placed.items() if key not in ('start_time', 'duration')} == \
+                {key: value for key, value in expected_clip.items() if key not in ('start_time', 'duration')}
+        with VideoFileClip(video_path) as video:
+            assert abs(video.duration - sum(clip['duration'] for clip in expected_layout)) < 0.2
+            assert video.size == [160, 90]
+    print('test_EpisodePipeline passed')
+
+if __name__ == '__main__':
+    test_EpisodePipeline()
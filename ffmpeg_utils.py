@@ -0,0 +1,224 @@
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+import re
+from moviepy.config import get_setting
+from parallel_render import iter_frames_parallel, can_render_in_parallel
+
+DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d+):(\d+\.?\d*)')
+AUDIO_CODECS = {'.mp3': 'libmp3lame', '.wav': 'pcm_s16le', '.m4a': 'aac', '.aac': 'aac'}
+
+
+class FFmpegError(RuntimeError):
+    pass
+
+
+def get_ffmpeg_binary():
+    return get_setting('FFMPEG_BINARY')
+
+
+def _popen_params():
+    # This was added so that no extra unwanted window opens on windows
+    if os.name == 'nt':
+        return {'creationflags': 0x08000000}  # CREATE_NO_WINDOW
+    return {}
+
+
+def _build_command(args, loglevel):
+    return [get_ffmpeg_binary(), '-hide_banner', '-loglevel', loglevel, '-y'] + [str(arg) for arg in args]
+
+
+def _check_returncode(command, returncode, stderr):
+    if returncode != 0:
+        stderr_tail = stderr.decode('utf-8', errors='replace')[-2000:]
+        raise FFmpegError(f"ffmpeg exited with code {returncode}: {' '.join(command)}\n{stderr_tail}")
+
+
+def run_ffmpeg(args, input_bytes=None, return_stderr=False, loglevel='error'):
+    '''
+    Runs ffmpeg with args and returns its stdout (and stderr if return_stderr),
+    raises FFmpegError with the stderr tail on a non-zero exit code.
+    '''
+    command = _build_command(args, loglevel)
+    result = subprocess.run(command, input=input_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **_popen_params())
+    _check_returncode(command, result.returncode, result.stderr)
+    if return_stderr:
+        return result.stdout, result.stderr
+    return result.stdout
+
+
+def run_ffmpeg_with_progress(args, progress_callback=None):
+    '''
+    Runs ffmpeg with args like run_ffmpeg, for long runs: progress_callback(frames_done) is called
+    every time ffmpeg reports its progress, about twice a second.
+    '''
+    command = _build_command(['-nostats', '-progress', 'pipe:1'] + list(args), 'error')
+    # stderr goes to a file, a full stderr pipe would block ffmpeg while its progress is read here
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, **_popen_params())
+        try:
+            for line in process.stdout:
+                if line.startswith(b'frame=') and progress_callback is not None:
+                    progress_callback(int(line[len(b'frame='):]))
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        stderr_file.seek(0)
+        _check_returncode(command, returncode, stderr_file.read())
+
+
+def escape_filter_value(value):
+    '''Escapes a filter option value (e.g. a path) for a -vf filtergraph: once for the option parser, once for the graph.'''
+    for special in '\\\':':
+        value = value.replace(special, '\\' + special)
+    for special in '\\\'[],;':
+        value = value.replace(special, '\\' + special)
+    return value
+
+
+def build_atempo_filter(speed_factor):
+    '''atempo only accepts factors in [0.5, 2.0] on older ffmpeg builds, so larger changes are chained.'''
+    factors = []
+    while speed_factor > 2.0:
+        factors.append(2.0)
+        speed_factor /= 2.0
+    while speed_factor < 0.5:
+        factors.append(0.5)
+        speed_factor /= 0.5
+    factors.append(speed_factor)
+    return ','.join(f'atempo={factor}' for factor in factors)
+
+
+def decode_audio(audio_path, fps=44100, nchannels=2, with_duration=False):
+    '''
+    Decodes an audio file to a float32 array of shape (samples, nchannels).
+    with_duration also returns the container duration ffmpeg reports, the same duration moviepy's AudioFileClip uses,
+    it can be slightly longer than the decoded samples because of the encoder padding.
+    '''
+    raw_bytes, stderr = run_ffmpeg(['-i', audio_path, '-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ar', fps, '-ac', nchannels, '-'],
+                                   return_stderr=True, loglevel='info')
+    samples = np.frombuffer(raw_bytes, dtype=np.float32).reshape(-1, nchannels)
+    if not with_duration:
+        return samples
+    duration_match = DURATION_PATTERN.search(stderr.decode('utf-8', errors='replace'))
+    if duration_match:
+        hours, minutes, seconds = duration_match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    else:
+        duration = len(samples) / fps
+    return samples, duration
+
+
+def probe_duration(media_path):
+    '''The container duration ffmpeg reports for media_path, in seconds.'''
+    _, stderr = run_ffmpeg(['-i', media_path, '-f', 'null', '-t', 0, '-'], return_stderr=True, loglevel='info')
+    duration_match = DURATION_PATTERN.search(stderr.decode('utf-8', errors='replace'))
+    if not duration_match:
+        raise FFmpegError(f"ffmpeg reports no duration for {media_path}")
+    hours, minutes, seconds = duration_match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def iter_video_frames(video_path, size, fps, max_frames=None):
+    '''
+    Yields the frames of video_path as (height, width, 3) uint8 arrays, scaled to size = (width, height) and resampled
+    to fps by ffmpeg, at most max_frames of them. The frames are read from one decode, no seeking.
+    '''
+    width, height = size
+    args = ['-i', video_path, '-an', '-vf', f'scale={width}:{height},fps={fps}']
+    if max_frames is not None:
+        args.extend(['-frames:v', max_frames])
+    command = _build_command(args + ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'], 'error')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **_popen_params())
+    frame_bytes = width * height * 3
+    try:
+        while True:
+            raw_frame = process.stdout.read(frame_bytes)
+            if len(raw_frame) < frame_bytes:
+                break
+            yield np.frombuffer(raw_frame, dtype=np.uint8).reshape(height, width, 3)
+        stderr = process.stderr.read()
+        _check_returncode(command, process.wait(), stderr)
+    finally:
+        # the consumer stopped early
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def encode_audio(samples, fps, output_path, bitrate=None):
+    '''Encodes a float32 (samples, nchannels) buffer in one pass, streaming it to ffmpeg without copying it.'''
+    codec = AUDIO_CODECS.get(os.path.splitext(output_path)[1].lower(), 'libmp3lame')
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    args = ['-f', 'f32le', '-ar', fps, '-ac', samples.shape[1], '-i', '-', '-vn', '-acodec', codec]
+    if bitrate is not None:
+        args.extend(['-b:a', bitrate])
+    command = _build_command(args + [output_path], 'error')
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, **_popen_params())
+    try:
+        process.stdin.write(memoryview(samples).cast('B'))
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    stderr = process.stderr.read()
+    _check_returncode(command, process.wait(), stderr)
+
+
+def encode_still(image_path, n_frames, fps, output_path, codec, ffmpeg_params=None):
+    '''Encodes one image held for n_frames frames, ffmpeg repeats the frame so nothing is composed in python.'''
+    run_ffmpeg(['-loop', 1, '-framerate', fps, '-i', image_path, '-frames:v', n_frames, '-an', '-vcodec', codec]
+               + list(ffmpeg_params or []) + ['-pix_fmt', 'yuv420p', '-r', fps, output_path])
+
+
+def write_frames(clip, start_frame, end_frame, fps, output_path, codec, ffmpeg_params=None, workers=1, progress_callback=None):
+    '''
+    Writes the frames start_frame <= i < end_frame of clip, frame i being clip.get_frame(i / fps), without audio.
+    With workers > 1 the frames are rendered by forked processes (see parallel_render), the output is identical.
+    progress_callback(frames_written, n_frames) is called after every frame.
+    Returns the seconds spent waiting for composed frames, the rest of the write is the encoder's.
+    '''
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+    if workers > 1 and can_render_in_parallel():
+        frames = iter_frames_parallel(clip, start_frame, end_frame, fps, workers)
+    else:
+        frames = (clip.get_frame(frame_index / fps) for frame_index in range(start_frame, end_frame))
+    compose_seconds = 0.0
+    with FFMPEG_VideoWriter(output_path, clip.size, fps, codec=codec,
+                            ffmpeg_params=list(ffmpeg_params or []) + ['-pix_fmt', 'yuv420p']) as writer:
+        time_start = time.perf_counter()
+        for frames_written, frame in enumerate(frames, 1):
+            compose_seconds += time.perf_counter() - time_start
+            if frame.dtype != 'uint8':
+                frame = frame.astype('uint8')
+            writer.write_frame(frame)
+            if progress_callback is not None:
+                progress_callback(frames_written, end_frame - start_frame)
+            time_start = time.perf_counter()
+    return compose_seconds
+
+
+def concat_videos(video_paths, output_path):
+    '''Joins videos encoded with the same settings without re-encoding (concat demuxer, stream copy).'''
+    list_path = output_path + '.txt'
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for video_path in video_paths:
+            escaped_path = os.path.abspath(video_path).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+    try:
+        run_ffmpeg(['-f', 'concat', '-safe', 0, '-i', list_path, '-c', 'copy', output_path])
+    finally:
+        os.remove(list_path)
+
+
+def add_subtitle_track(video_path, subtitle_path, output_path):
+    '''Copies the streams of video_path and adds subtitle_path (e.g. SRT) as a soft subtitle track, mov_text in mp4.'''
+    subtitle_codec = 'mov_text' if output_path.lower().endswith(('.mp4', '.m4v', '.mov')) else 'srt'
+    run_ffmpeg(['-i', video_path, '-i', subtitle_path, '-map', 0, '-map', 1, '-c', 'copy', '-c:s', subtitle_codec, output_path])
+
+
+def mux_audio(video_path, audio_path, output_path):
+    run_ffmpeg(['-i', video_path, '-i', audio_path, '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', output_path])
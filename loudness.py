@@ -0,0 +1,300 @@
+import itertools
+import json
+import math
+import threading
+import numpy as np
+from asset_cache import AssetCache
+from ffmpeg_utils import decode_audio
+
+# BS.1770 gating: 400 ms blocks every 100 ms, an absolute gate at -70 LUFS and a relative gate 10 LU under the ungated level
+BLOCK_SECONDS = 0.4
+BLOCK_STEP_SECONDS = 0.1
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+TRUE_PEAK_OVERSAMPLING = 4
+# samples filtered per FFT, the memory of an analysis does not grow with the length of the audio
+CHUNK_SAMPLES = 1 << 16
+
+
+def _biquad_response(b, a, frequencies, fps):
+    z = np.exp(-2j * np.pi * frequencies / fps)
+    return (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+
+
+def k_weighting_response(frequencies, fps):
+    '''
+    The complex response of the BS.1770 K-weighting at frequencies (Hz): the head shelf (+4 dB above 1.5 kHz)
+    followed by the RLB high-pass (38 Hz), as RBJ biquads which reproduce the 48 kHz coefficients of the standard
+    and are defined at any sample rate.
+    '''
+    gain = 10 ** (4.0 / 40)
+    w0 = 2 * np.pi * 1500.0 / fps
+    alpha = np.sin(w0) / (2 * (1 / np.sqrt(2)))
+    cos_w0, sqrt_gain = np.cos(w0), np.sqrt(gain)
+    shelf = _biquad_response(
+        [gain * ((gain + 1) + (gain - 1) * cos_w0 + 2 * sqrt_gain * alpha), -2 * gain * ((gain - 1) + (gain + 1) * cos_w0),
+         gain * ((gain + 1) + (gain - 1) * cos_w0 - 2 * sqrt_gain * alpha)],
+        [(gain + 1) - (gain - 1) * cos_w0 + 2 * sqrt_gain * alpha, 2 * ((gain - 1) - (gain + 1) * cos_w0),
+         (gain + 1) - (gain - 1) * cos_w0 - 2 * sqrt_gain * alpha],
+        frequencies, fps)
+    w0 = 2 * np.pi * 38.0 / fps
+    alpha = np.sin(w0) / (2 * 0.5)
+    cos_w0 = np.cos(w0)
+    high_pass = _biquad_response([(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2], [1 + alpha, -2 * cos_w0, 1 - alpha],
+                                 frequencies, fps)
+    return shelf * high_pass
+
+
+def k_weighting_impulse_response(fps, length=4096):
+    '''The K-weighting as an FIR filter, its IIR response has decayed far below float32 precision after length samples.'''
+    frequencies = np.fft.rfftfreq(length, 1 / fps)
+    return np.fft.irfft(k_weighting_response(frequencies, fps), length).astype(np.float32)
+
+
+def interpolation_filter(factor=TRUE_PEAK_OVERSAMPLING, taps_per_phase=12):
+    '''The low-pass FIR of a zero-stuffing upsampler by factor, a Hann-windowed sinc.'''
+    n = np.arange(factor * taps_per_phase + 1) - factor * taps_per_phase / 2
+    return (np.sinc(n / factor) * np.hanning(len(n))).astype(np.float32)
+
+
+def _iter_chunks(samples, chunk_samples=CHUNK_SAMPLES):
+    for chunk_start in range(0, len(samples), chunk_samples):
+        yield np.asarray(samples[chunk_start:chunk_start + chunk_samples], dtype=np.float32)
+
+
+def iter_fft_filtered(chunks, impulse_response):
+    '''
+    Filters a signal given as consecutive (n, nchannels) chunks with an FIR filter by FFT convolution (overlap-add),
+    yields the filtered chunks, each as long as its input chunk.
+    '''
+    tail = None
+    spectra = {}
+    for chunk in chunks:
+        n_filtered = len(chunk) + len(impulse_response) - 1
+        fft_size = 1 << (n_filtered - 1).bit_length()
+        if fft_size not in spectra:
+            spectra[fft_size] = np.fft.rfft(impulse_response, fft_size)[:, None]
+        filtered = np.fft.irfft(np.fft.rfft(chunk, fft_size, axis=0) * spectra[fft_size], fft_size, axis=0)[:n_filtered]
+        if tail is not None:
+            filtered[:len(tail)] += tail
+        yield filtered[:len(chunk)]
+        tail = filtered[len(chunk):]
+
+
+def block_energies(samples, fps):
+    '''The K-weighted mean square of every 400 ms gating block, summed over the channels (all weighted 1.0, no surround).'''
+    step = int(round(BLOCK_STEP_SECONDS * fps))
+    steps_per_block = int(round(BLOCK_SECONDS / BLOCK_STEP_SECONDS))
+    # the energy of every 100 ms step, a block is the sum of 4 consecutive steps
+    impulse_response = k_weighting_impulse_response(fps)
+    step_energies = []
+    remainder = np.zeros(0, dtype=np.float64)
+    # whole steps per chunk, a chunk and the filter fit one FFT of CHUNK_SAMPLES
+    chunk_samples = step * max((CHUNK_SAMPLES - len(impulse_response)) // step, 1)
+    for filtered in iter_fft_filtered(_iter_chunks(samples, chunk_samples), impulse_response):
+        powers = np.concatenate([remainder, np.square(filtered, dtype=np.float64).sum(axis=1)])
+        n_steps = len(powers) // step
+        step_energies.append(powers[:n_steps * step].reshape(n_steps, step).sum(axis=1))
+        remainder = powers[n_steps * step:]
+    step_energies = np.concatenate(step_energies) if step_energies else np.zeros(0)
+    if len(step_energies) < steps_per_block:
+        return np.zeros(0)
+    cumulative = np.concatenate([[0], np.cumsum(step_energies)])
+    return (cumulative[steps_per_block:] - cumulative[:-steps_per_block]) / (step * steps_per_block)
+
+
+def energy_to_lufs(energy):
+    return -0.691 + 10 * np.log10(energy)
+
+
+def integrated_loudness(samples, fps):
+    '''The gated integrated loudness of (samples, nchannels) in LUFS, None for silence or audio shorter than a block.'''
+    energies = block_energies(samples, fps)
+    with np.errstate(divide='ignore'):
+        loudness = energy_to_lufs(energies)
+    energies = energies[loudness > ABSOLUTE_GATE_LUFS]
+    if len(energies) == 0:
+        return None
+    relative_gate = energy_to_lufs(energies.mean()) + RELATIVE_GATE_LU
+    energies = energies[energy_to_lufs(energies) > relative_gate]
+    return float(energy_to_lufs(energies.mean()))
+
+
+def polyphase_filters(interpolation, factor):
+    '''
+    The interpolation filter as a (taps, factor) matrix: a window of taps consecutive samples times it gives the factor
+    upsampled samples after the window's last sample, the zero-stuffed convolution without multiplying the zeros.
+    '''
+    taps = -(-len(interpolation) // factor)
+    padded = np.zeros(taps * factor, dtype=np.float32)
+    padded[:len(interpolation)] = interpolation
+    return np.ascontiguousarray(padded.reshape(taps, factor)[::-1])
+
+
+def true_peak(samples, factor=TRUE_PEAK_OVERSAMPLING):
+    '''The true peak of (samples, nchannels) in dBTP, from the samples upsampled by factor. None for silence.'''
+    filters = polyphase_filters(interpolation_filter(factor), factor)
+    taps = len(filters)
+    peak = 0.0
+    # the last taps - 1 samples of the previous chunk, zeros before the audio (and after it, the filter's tail)
+    history = np.zeros((taps - 1, samples.shape[1]), dtype=np.float32)
+    for chunk in itertools.chain(_iter_chunks(samples), [np.zeros((taps - 1, samples.shape[1]), dtype=np.float32)]):
+        chunk = np.concatenate([history, chunk])
+        for channel in range(chunk.shape[1]):
+            windows = np.lib.stride_tricks.sliding_window_view(np.ascontiguousarray(chunk[:, channel]), taps)
+            peak = max(peak, float(np.abs(windows @ filters).max(initial=0)))
+        history = chunk[len(chunk) - taps + 1:]
+    return 20 * math.log10(peak) if peak > 0 else None
+
+
+class LoudnessAnalyzer:
+    '''
+    Measures the integrated loudness (BS.1770 K-weighting and gating) and the true peak of audio files with NumPy.
+    The results are kept in the asset cache by the content hash of the file, so a file is analysed once across runs.
+    With a pcm_cache (see pcm_cache.PcmCache) the samples are read from its memory maps instead of being decoded.
+    '''
+    def __init__(self, asset_cache, pcm_cache=None, fps=44100, nchannels=2):
+        self.asset_cache = asset_cache
+        self.pcm_cache = pcm_cache
+        self.fps = fps
+        self.nchannels = nchannels
+        self._analyses = {}
+        self._lock = threading.Lock()
+
+    def analyze(self, audio_path):
+        '''Returns {'integrated_lufs': ..., 'true_peak_dbtp': ...} of audio_path, both None for silence.'''
+        key = AssetCache.make_key('loudness', self.asset_cache.content_hash(audio_path), fps=self.fps, nchannels=self.nchannels)
+        with self._lock:
+            analysis = self._analyses.get(key)
+        if analysis is not None:
+            return analysis
+
+        def measure(temp_path):
+            if self.pcm_cache is not None:
+                samples = self.pcm_cache.load(audio_path)[0]
+            else:
+                samples = decode_audio(audio_path, self.fps, self.nchannels)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'integrated_lufs': integrated_loudness(samples, self.fps), 'true_peak_dbtp': true_peak(samples)}, f)
+        with open(self.asset_cache.fetch(key, '.json', measure), 'r', encoding='utf-8') as f:
+            analysis = json.load(f)
+        with self._lock:
+            self._analyses[key] = analysis
+        return analysis
+
+
+def ducking_gains(times, speech_spans, depth_db, attack=0.2, release=0.6):
+    '''
+    The gain of the BGM at times (seconds, an array): depth_db down during the speech_spans, sorted (start, end) seconds,
+    ramping down over attack seconds before a span starts and back up over release seconds after it ends.
+    The ramps are linear in dB, so gaps shorter than attack + release stay mostly ducked.
+    '''
+    times = np.asarray(times, dtype=np.float64)
+    if not speech_spans or depth_db <= 0:
+        return np.ones(len(times), dtype=np.float32)
+    starts = np.array([start for start, _ in speech_spans], dtype=np.float64)
+    ends = np.array([end for _, end in speech_spans], dtype=np.float64)
+    # the last span starting at or before each time, and the next one
+    span_index = np.searchsorted(starts, times, side='right') - 1
+    previous_end = np.where(span_index >= 0, ends[np.maximum(span_index, 0)], -np.inf)
+    next_start = np.where(span_index + 1 < len(starts), starts[np.minimum(span_index + 1, len(starts) - 1)], np.inf)
+    release_amount = np.clip(1 - (times - previous_end) / max(release, 1e-9), 0, 1)
+    attack_amount = np.clip(1 - (next_start - times) / max(attack, 1e-9), 0, 1)
+    amount = np.where(times < previous_end, 1.0, np.maximum(release_amount, attack_amount))
+    return (10 ** (-depth_db * amount / 20)).astype(np.float32)
+
+
+class LoudnessNormalizer:
+    '''
+    The loudness stage of the audio mix. Each clip gets the gain bringing it to target_lufs, capped so its true peak stays
+    under max_true_peak, and the BGM is brought to target_lufs too, so bgm_volume sets its level relative to the speech.
+    The BGM is ducked by bgm_ducking_db under the speech. The gains are applied while mixing, nothing is re-encoded.
+    '''
+    def __init__(self, analyzer, target_lufs=-16.0, max_true_peak=-1.0, max_gain_db=20.0, bgm_ducking_db=6.0,
+                 ducking_attack=0.2, ducking_release=0.6):
+        self.analyzer = analyzer
+        self.target_lufs = target_lufs
+        self.max_true_peak = max_true_peak
+        self.max_gain_db = max_gain_db
+        self.bgm_ducking_db = bgm_ducking_db
+        self.ducking_attack = ducking_attack
+        self.ducking_release = ducking_release
+
+    @classmethod
+    def from_config(cls, loudness_config, asset_cache, pcm_cache=None):
+        '''Uses a loudness_config dict of a VideoCrafter config, see its docstring.'''
+        return cls(LoudnessAnalyzer(asset_cache, pcm_cache), loudness_config.get('target_lufs', -16.0), loudness_config.get('max_true_peak', -1.0),
+                   loudness_config.get('max_gain_db', 20.0), loudness_config.get('bgm_ducking_db', 6.0),
+                   loudness_config.get('ducking_attack', 0.2), loudness_config.get('ducking_release', 0.6))
+
+    def gain(self, audio_path, max_true_peak=None):
+        '''The linear gain bringing audio_path to target_lufs, limited by max_true_peak and max_gain_db, 1.0 for silence.'''
+        analysis = self.analyzer.analyze(audio_path)
+        if analysis['integrated_lufs'] is None:
+            return 1.0
+        gain_db = min(self.target_lufs - analysis['integrated_lufs'], self.max_gain_db)
+        max_true_peak = self.max_true_peak if max_true_peak is None else max_true_peak
+        if analysis['true_peak_dbtp'] is not None:
+            gain_db = min(gain_db, max_true_peak - analysis['true_peak_dbtp'])
+        return 10 ** (gain_db / 20)
+
+    def clip_gain(self, audio_path):
+        return self.gain(audio_path)
+
+    def bgm_gain(self, bgm_path, bgm_volume=1.0):
+        '''The BGM gain, bgm_volume included. Its true peak is capped after bgm_volume, it never clips on its own.'''
+        bgm_volume = 1.0 if bgm_volume is None else bgm_volume
+        if bgm_volume <= 0:
+            return 0.0
+        return self.gain(bgm_path, self.max_true_peak - 20 * math.log10(bgm_volume)) * bgm_volume
+
+    def ducking_gains(self, times, speech_spans):
+        return ducking_gains(times, speech_spans, self.bgm_ducking_db, self.ducking_attack, self.ducking_release)
+
+
+def test_loudness():
+    '''Reference levels of BS.1770 test tones, inter-sample peaks, the cache, and the ducking ramps.'''
+    import os
+    import tempfile
+    from ffmpeg_utils import run_ffmpeg
+    fps = 44100
+    t = np.arange(10 * fps) / fps
+    # a 1 kHz sine at -23 dBFS on both channels measures -23 LUFS (within the 0.1 LU of the standard's test signals)
+    tone = np.repeat((10 ** (-23 / 20) * np.sin(2 * np.pi * 1000 * t)).astype(np.float32)[:, None], 2, axis=1)
+    assert abs(integrated_loudness(tone, fps) - -23) < 0.1
+    # K-weighting: 20 dB less energy at 30 Hz would be about 20 LU quieter, it measures quieter still (the RLB high-pass)
+    low_tone = np.repeat((10 ** (-23 / 20) * np.sin(2 * np.pi * 30 * t)).astype(np.float32)[:, None], 2, axis=1)
+    assert integrated_loudness(low_tone, fps) < -23 - 1
+    # the relative gate ignores a quiet half (but for the blocks across the change), the absolute gate ignores silence
+    half_quiet = np.concatenate([tone, tone * 10 ** (-30 / 20)])
+    assert abs(integrated_loudness(half_quiet, fps) - -23) < 0.2
+    assert integrated_loudness(np.zeros((fps, 2), np.float32), fps) is None
+    # a sine at fs/4 sampled 45 degrees off its peaks: the samples peak 3 dB under the true peak of 0 dBFS
+    quarter_rate = np.repeat(np.sin(2 * np.pi * t[:fps] * fps / 4 + np.pi / 4).astype(np.float32)[:, None], 2, axis=1)
+    assert abs(20 * math.log10(np.abs(quarter_rate).max()) - -3.01) < 0.01
+    assert abs(true_peak(quarter_rate) - 0) < 0.3
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        audio_path = os.path.join(temp_dir, 'tone.wav')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=1000:duration=3', '-af', 'volume=-9dB', '-ac', 2, '-ar', fps, audio_path])
+        analyzer = LoudnessAnalyzer(AssetCache(os.path.join(temp_dir, 'cache')))
+        analysis = analyzer.analyze(audio_path)
+        # a stereo 1 kHz sine measures its peak level in LUFS
+        peak_level = 20 * math.log10(np.abs(decode_audio(audio_path)).max())
+        assert abs(analysis['integrated_lufs'] - peak_level) < 0.2 and abs(analysis['true_peak_dbtp'] - peak_level) < 0.2
+        cached_analyzer = LoudnessAnalyzer(AssetCache(os.path.join(temp_dir, 'cache')))
+        cached_analyzer.asset_cache.misses = 0
+        assert cached_analyzer.analyze(audio_path) == analysis and cached_analyzer.asset_cache.misses == 0
+        normalizer = LoudnessNormalizer(analyzer, target_lufs=-16, max_true_peak=-1, max_gain_db=30)
+        assert abs(20 * math.log10(normalizer.clip_gain(audio_path)) - (-16 - analysis['integrated_lufs'])) < 1e-6
+        # the peak cap: raised at most to -1 dBTP
+        normalizer.target_lufs = 0
+        assert abs(20 * math.log10(normalizer.clip_gain(audio_path)) - (-1 - analysis['true_peak_dbtp'])) < 1e-6
+
+    gains = ducking_gains(np.array([0, 0.9, 1.0, 1.5, 2.0, 2.3, 2.6, 3.0]), [(1.0, 2.0)], 6, attack=0.2, release=0.6)
+    assert gains[0] == 1 and abs(gains[1] - 10 ** (-3 / 20)) < 1e-6 and abs(gains[3] - 10 ** (-6 / 20)) < 1e-6
+    assert abs(gains[5] - 10 ** (-3 / 20)) < 1e-6 and gains[6] == 1 and gains[7] == 1
+    print('test_loudness passed')
+
+if __name__ == '__main__':
+    test_loudness()
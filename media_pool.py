@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+from moviepy.audio.AudioClip import AudioClip
+
+DEFAULT_MAX_OPEN_CLIPS = 8
+
+
+def close_clip(clip):
+    '''Closes clip and the clips it is composed of, a CompositeAudioClip does not close its parts itself.'''
+    for part in getattr(clip, 'clips', None) or []:
+        close_clip(part)
+    clip.close()
+
+
+class MediaPool:
+    '''
+    The media clips of a render, opened when a frame or an audio chunk first needs them.
+    At most max_open clips are kept open, the least recently used one is closed when another is opened, so the
+    ffmpeg readers, file handles and decoded images of an episode do not grow with its number of clips.
+    A render reads the timeline in order, so a clip is rarely opened twice.
+    '''
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_CLIPS):
+        self.max_open = max(max_open, 1)
+        self._clips = OrderedDict()
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.peak_open = 0
+
+    def get(self, key, opener):
+        '''The clip of key, opener() opens it if it is not open.'''
+        with self._lock:
+            clip = self._clips.get(key)
+            if clip is not None:
+                self._clips.move_to_end(key)
+                return clip
+            clip = opener()
+            self._clips[key] = clip
+            self.opened += 1
+            while len(self._clips) > self.max_open:
+                close_clip(self._clips.popitem(last=False)[1])
+            self.peak_open = max(self.peak_open, len(self._clips))
+            return clip
+
+    def close(self):
+        with self._lock:
+            while self._clips:
+                close_clip(self._clips.popitem(last=False)[1])
+
+    def stats(self):
+        return {'opened': self.opened, 'peak_open': self.peak_open, 'max_open': self.max_open}
+
+
+class LazyAudioClip(AudioClip):
+    '''An audio clip of known duration whose samples come from the clip opener() opens through the pool when played.'''
+    def __init__(self, pool, key, duration, opener, fps=44100, nchannels=2):
+        AudioClip.__init__(self, duration=duration)
+        self.fps = fps
+        self.nchannels = nchannels
+        self.make_frame = lambda t: pool.get(key, opener).get_frame(t)
+
+
+class LazyLayer:
+    '''
+    A layer of timeline.TimelineClip from start to end, the clip opener() opens (already set to start) is opened
+    through the pool when a frame needs it.
+    '''
+    def __init__(self, pool, key, start, end, opener):
+        self.pool = pool
+        self.key = key
+        self.start = start
+        self.end = end
+        self.opener = opener
+
+    def blit_on(self, picture, t):
+        return self.pool.get(self.key, self.opener).blit_on(picture, t)
+
+
+def test_MediaPool():
+    '''The pool keeps at most max_open clips and closes the least recently used, lazy clips match the clips they open.'''
+    import numpy as np
+    from moviepy.editor import ColorClip, concatenate_audioclips
+    from moviepy.audio.AudioClip import AudioArrayClip
+    from timeline import TimelineClip
+    closed = []
+
+    class Tracked:
+        def __init__(self, name):
+            self.name = name
+
+        def close(self):
+            closed.append(self.name)
+    pool = MediaPool(max_open=2)
+    for name in ['a', 'b', 'a', 'c', 'd']:
+        pool.get(name, lambda name=name: Tracked(name))
+    assert closed == ['b', 'a'] and pool.stats() == {'opened': 4, 'peak_open': 2, 'max_open': 2}
+    pool.close()
+    assert closed == ['b', 'a', 'c', 'd']
+
+    # three clips through a pool of one: the audio and the frames are those of the clips opened eagerly
+    fps = 44100
+    tones = [np.stack([np.sin(np.arange(int(duration * fps)) * frequency)] * 2, axis=1) for frequency, duration in ((0.01, 0.5), (0.02, 0.3), (0.03, 0.7))]
+    pool = MediaPool(max_open=1)
+    lazy_audio = concatenate_audioclips([LazyAudioClip(pool, clip_index, len(tone) / fps, lambda tone=tone: AudioArrayClip(tone, fps=fps))
+                                         for clip_index, tone in enumerate(tones)])
+    eager_audio = concatenate_audioclips([AudioArrayClip(tone, fps=fps) for tone in tones])
+    t = np.arange(int(1.5 * fps)) / fps
+    assert lazy_audio.duration == eager_audio.duration and np.array_equal(lazy_audio.get_frame(t), eager_audio.get_frame(t))
+    background = ColorClip(size=(32, 18), color=(255, 255, 255)).set_duration(3)
+    layer_clips = [ColorClip(size=(10, 6), color=color).set_duration(1).set_start(start) for start, color in ((0, (255, 0, 0)), (1, (0, 255, 0)), (2, (0, 0, 255)))]
+    lazy_layers = [LazyLayer(pool, ('image', clip_index), clip.start, clip.end, lambda clip=clip: clip) for clip_index, clip in enumerate(layer_clips)]
+    for frame_t in np.arange(0, 3, 0.25):
+        assert np.array_equal(TimelineClip(background, lazy_layers).get_frame(frame_t), TimelineClip(background, layer_clips).get_frame(frame_t))
+    assert pool.peak_open == 1
+    print('test_MediaPool passed')
+
+if __name__ == '__main__':
+    test_MediaPool()
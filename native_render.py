@@ -0,0 +1,326 @@
+import os
+import tempfile
+import time
+from PIL import Image
+from background_store import BackgroundStore
+from encoder_backends import log_render_speed
+from ffmpeg_utils import build_atempo_filter, escape_filter_value, run_ffmpeg_with_progress
+from render_planner import first_frame_at
+from subtitle_export import write_ass, build_subtitles_filter
+
+AUDIO_FPS = 44100
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+# every key frame, clip audio, background and BGM is a source filter holding its file open for the whole run
+DEFAULT_MAX_SOURCES = 500
+
+
+class NativeRenderer:
+    '''
+    Renders the config of a VideoCrafter as one ffmpeg filtergraph run by a single ffmpeg process, no frame or sample
+    goes through Python. The graph follows the timeline of create_video_fast:
+        video: the background (white, an image, or a video looped from the background store) under one layer stream,
+            the key frames placed by their frame_size with their fadeout_duration as an alpha fade, concatenated clip
+            after clip with transparent frames between them, then the subtitles burnt in with libass
+        audio: the clips, stretched by audio_speed, faded in and out and padded with their transition_pause_time,
+            concatenated and mixed with the looped BGM at bgm_volume, faded out over audio_fadeout_duration
+            (with the loudness stage, the clip and BGM gains are volume filters, its BGM ducking falls back to moviepy)
+    Each layer segment starts on the frame grid, frame i shows clip k if start_k <= i / fps < end_k as in moviepy,
+    so the frames match the moviepy render.
+    The 'pil' subtitle renderer is approximated with libass, see subtitle_export.write_ass.
+    Configs the graph cannot express (see unsupported_reason) are rendered by the moviepy path instead.
+    '''
+    def __init__(self, video_crafter):
+        self.video_crafter = video_crafter
+        self.max_sources = video_crafter.config.get('native_max_sources', DEFAULT_MAX_SOURCES)
+
+    def unsupported_reason(self):
+        '''Why the config cannot be rendered natively, None if it can.'''
+        video_crafter = self.video_crafter
+        config = video_crafter.config
+        for clip_index, clip_config in enumerate(video_crafter.clips_config):
+            has_image = bool(clip_config.get('key_frame_path')) and clip_config['key_frame_path'] != -1
+            if has_image and clip_config.get('movement'):
+                return f"clip {clip_index} has a {clip_config['movement'].get('type')} movement"
+        subtitle_config = config.get('subtitle_config')
+        if subtitle_config and subtitle_config.get('renderer', 'pil') not in ('pil', 'libass'):
+            return f"the {subtitle_config['renderer']} subtitle renderer"
+        background_path = config.get('background_video_path')
+        if background_path and background_path.lower().endswith(IMAGE_EXTENSIONS):
+            with Image.open(self._get_background_image(background_path)) as img:
+                if img.size != (video_crafter.width, video_crafter.height):
+                    # moviepy then renders at the size of the background image
+                    return f"the background image does not fit {video_crafter.width}x{video_crafter.height}"
+        if video_crafter.loudness is not None and video_crafter.loudness.bgm_ducking_db > 0 and video_crafter.bgm_path and video_crafter.bgm_path != -1:
+            return 'the BGM ducking of the loudness stage'
+        n_sources = sum(1 for clip_config in video_crafter.clips_config for key in ('audio_path', 'key_frame_path')
+                        if clip_config.get(key) and clip_config[key] != -1)
+        n_sources += bool(background_path) + bool(video_crafter.bgm_path and video_crafter.bgm_path != -1)
+        if n_sources > self.max_sources:
+            return f"{n_sources} media files, more than native_max_sources ({self.max_sources}) open at once"
+        return None
+
+    def render(self, timeline_layout=None):
+        '''Writes the video to the output path of the VideoCrafter, returns the path.'''
+        video_crafter = self.video_crafter
+        time_start = time.time()
+        if timeline_layout is None:
+            with video_crafter.metrics.stage('layout', clips=len(video_crafter.clips_config)):
+                timeline_layout = video_crafter.build_timeline_layout()
+        total_duration = sum(clip['duration'] for clip in timeline_layout)
+        total_frames = first_frame_at(total_duration, video_crafter.fps)
+        with tempfile.TemporaryDirectory(dir=video_crafter.output_dir or None) as temp_dir:
+            filtergraph = self.build_filtergraph(timeline_layout, temp_dir)
+            # the graph grows with the episode, a script file keeps it off the command line
+            filtergraph_path = os.path.join(temp_dir, 'filtergraph.txt')
+            with open(filtergraph_path, 'w', encoding='utf-8') as f:
+                f.write(filtergraph)
+            encoder = video_crafter.encoder
+            with video_crafter.metrics.stage('write', frames=total_frames, encoder_profile=encoder.profile_name, backend='native'):
+                run_ffmpeg_with_progress(['-filter_complex_script', filtergraph_path, '-map', '[video]', '-map', '[audio]',
+                                          '-vcodec', encoder.codec] + encoder.ffmpeg_params
+                                         + ['-pix_fmt', 'yuv420p', '-r', video_crafter.fps, '-threads', encoder.threads,
+                                            '-acodec', 'aac', video_crafter.output_path],
+                                         lambda frames_done: video_crafter.metrics.progress('write', frames_done, total_frames))
+        time_end = time.time()
+        log_render_speed(encoder.profile_name, total_frames, time_end - time_start)
+        print(f"Video created and saved to {video_crafter.output_path} by one ffmpeg filtergraph, time used: {time_end - time_start:.2f} seconds")
+        return video_crafter.output_path
+
+    def build_filtergraph(self, timeline_layout, temp_dir):
+        '''
+        The filtergraph of the episode, its outputs are labelled [video] and [audio].
+        timeline_layout is the clip layout of VideoCrafter.build_timeline_layout, the subtitle script is written to temp_dir.
+        '''
+        video_crafter = self.video_crafter
+        total_frames = first_frame_at(sum(clip['duration'] for clip in timeline_layout), video_crafter.fps)
+        chains = [self._build_background(total_frames) + '[background]']
+        composition = '[background]'
+        layer_chains = self._build_layer(timeline_layout)
+        if layer_chains:
+            chains.extend(layer_chains)
+            chains.append('[background][layer]overlay=format=rgb:eof_action=pass[composed]')
+            composition = '[composed]'
+        video_filters = ['format=rgb24']
+        subtitle_config = video_crafter.config.get('subtitle_config')
+        if subtitle_config:
+            cues = video_crafter.get_subtitle_cues(timeline_layout, subtitle_config)
+            video_crafter.subtitle_cues = cues
+            ass_path = os.path.join(temp_dir, 'subtitles.ass')
+            font_dir = write_ass(cues, ass_path, subtitle_config, video_crafter.width, video_crafter.height,
+                                 video_crafter.get_subtitle_y_position(subtitle_config))
+            video_filters.append(build_subtitles_filter(ass_path, font_dir))
+        chains.append(composition + ','.join(video_filters) + '[video]')
+        chains.extend(self._build_audio(timeline_layout))
+        return ';\n'.join(chains) + '\n'
+
+    def _frame_timestamps(self, first_frame=0):
+        '''setpts putting frame N of a stream on the output frame grid from first_frame on.'''
+        return f'setpts=(N+{first_frame})/({self.video_crafter.fps}*TB)'
+
+    def _build_still(self, image_path, n_frames, first_frame=0):
+        '''A source holding the image for n_frames frames.'''
+        return (f'movie=filename={escape_filter_value(image_path)},loop=loop=-1:size=1,settb=AVTB,'
+                f'{self._frame_timestamps(first_frame)},trim=end_frame={n_frames}')
+
+    def _get_background_image(self, background_path):
+        video_crafter = self.video_crafter
+        with Image.open(background_path) as img:
+            if img.size == (video_crafter.width, video_crafter.height):
+                return background_path
+        return video_crafter.get_resized_image(background_path, (video_crafter.width, video_crafter.height))
+
+    def _build_background(self, total_frames):
+        video_crafter = self.video_crafter
+        background_path = video_crafter.config.get('background_video_path')
+        width, height, fps = video_crafter.width, video_crafter.height, video_crafter.fps
+        if not background_path:
+            return f'color=c=white:size={width}x{height}:rate={fps},settb=AVTB,{self._frame_timestamps()},trim=end_frame={total_frames}'
+        if background_path.lower().endswith(IMAGE_EXTENSIONS):
+            return self._build_still(self._get_background_image(background_path), total_frames)
+        background_store = video_crafter.background_store
+        if background_store is None:
+            # like a VideoFileClip set to a longer duration, the last frame is held
+            return (f'movie=filename={escape_filter_value(background_path)},scale={width}:{height},fps={fps},'
+                    f'tpad=stop=-1:stop_mode=clone,settb=AVTB,{self._frame_timestamps()},trim=end_frame={total_frames}')
+        if background_store.store_format != 'video':
+            # ffmpeg reads the same loop from the encoded store
+            background_store = BackgroundStore(background_store.asset_cache, background_store.size, background_store.fps, 'video',
+                                               background_store.loop_seconds, background_store.crossfade_seconds)
+        store_path, _ = background_store.fetch(background_path)
+        return f'movie=filename={escape_filter_value(store_path)}:loop=0,settb=AVTB,{self._frame_timestamps()},trim=end_frame={total_frames}'
+
+    def _build_layer(self, timeline_layout):
+        '''
+        The chains of the [layer] stream: every key frame padded to the frame for the frames of its clip,
+        transparent frames elsewhere, concatenated. [] if no clip has a key frame.
+        '''
+        video_crafter = self.video_crafter
+        width, height, fps = video_crafter.width, video_crafter.height, video_crafter.fps
+        # (first_frame, end_frame, clip_config, clip) of the clips with a key frame, None between them
+        segments = []
+        next_frame = 0
+        for clip_config, clip in zip(video_crafter.clips_config, timeline_layout):
+            if not clip['has_image']:
+                continue
+            first_frame = first_frame_at(clip['start_time'], fps)
+            end_frame = first_frame_at(clip['start_time'] + clip['duration'], fps)
+            if end_frame <= first_frame:
+                continue
+            if first_frame > next_frame:
+                segments.append((next_frame, first_frame, None, None))
+            segments.append((first_frame, end_frame, clip_config, clip))
+            next_frame = end_frame
+        if not segments:
+            return []
+        total_frames = first_frame_at(sum(clip['duration'] for clip in timeline_layout), fps)
+        if total_frames > next_frame:
+            segments.append((next_frame, total_frames, None, None))
+
+        chains = []
+        for segment_index, (first_frame, end_frame, clip_config, clip) in enumerate(segments):
+            n_frames = end_frame - first_frame
+            if clip_config is None:
+                chains.append(f'color=c=black@0:size={width}x{height}:rate={fps},format=rgba,settb=AVTB,{self._frame_timestamps()},'
+                              f'trim=end_frame={n_frames},setsar=1[segment{segment_index}]')
+                continue
+            key_frame_path = video_crafter.get_key_frame(clip_config)
+            with Image.open(key_frame_path) as img:
+                image_width, image_height = img.size
+            # the frame times are made clip-local for the fade: frame i is at i / fps - start_time
+            chain = [f"movie=filename={escape_filter_value(key_frame_path)},loop=loop=-1:size=1,settb=AVTB,"
+                     f"{self._frame_timestamps(first_frame)}-{clip['start_time']}/TB,trim=end_frame={n_frames},format=rgba"]
+            fadeout_duration = clip_config.get('fadeout_duration')
+            if fadeout_duration:
+                # crossfadeout: the opacity falls linearly to 0 over the last fadeout_duration seconds
+                chain.append(f"fade=t=out:st={clip['duration'] - fadeout_duration}:d={fadeout_duration}:alpha=1")
+            # centered like moviepy's ('center', 'center'), an image larger than the frame is cropped
+            x, y = int((width - image_width) / 2), int((height - image_height) / 2)
+            if x < 0 or y < 0:
+                chain.append(f'crop={min(image_width, width)}:{min(image_height, height)}:{max(-x, 0)}:{max(-y, 0)}')
+            chain.append(f'pad={width}:{height}:{max(x, 0)}:{max(y, 0)}:color=black@0,setsar=1[segment{segment_index}]')
+            chains.append(','.join(chain))
+        chains.append(''.join(f'[segment{segment_index}]' for segment_index in range(len(segments)))
+                      + f'concat=n={len(segments)}:v=1:a=0,{self._frame_timestamps()}[layer]')
+        return chains
+
+    def _build_audio(self, timeline_layout):
+        '''The chains of the [audio] stream, timed sample by sample like AudioMixer.'''
+        video_crafter = self.video_crafter
+        audio_format = f'aresample={AUDIO_FPS},aformat=sample_fmts=fltp:channel_layouts=stereo,asetpts=N/SR/TB'
+        fade_samples = int(0.5 * AUDIO_FPS)
+        use_numpy_stretch = video_crafter.config.get('time_stretch_engine', 'ffmpeg') == 'numpy'
+        chains = []
+        total_samples = 0
+        for clip_index, (clip_config, clip) in enumerate(zip(video_crafter.clips_config, timeline_layout)):
+            n_samples = int(round(clip['duration'] * AUDIO_FPS))
+            total_samples += n_samples
+            if not clip_config.get('audio_path') or clip_config['audio_path'] == -1:
+                chains.append(f'anullsrc=r={AUDIO_FPS}:cl=stereo,atrim=end_sample={n_samples}[clip{clip_index}]')
+                continue
+            mixer_clip = video_crafter.make_mixer_clip(clip_config)
+            chain = [f"amovie=filename={escape_filter_value(mixer_clip['audio_path'])}", audio_format]
+            if use_numpy_stretch and mixer_clip['time_stretch'] != 1.0:
+                # atempo stands in for the WSOLA stretch, the clip keeps the timeline length of the layout
+                chain.extend([build_atempo_filter(mixer_clip['time_stretch']), 'asetpts=N/SR/TB'])
+            audio_samples = max(n_samples - int(mixer_clip['pause_duration'] * AUDIO_FPS), 0)
+            if video_crafter.loudness is not None:
+                chain.append(f"volume={video_crafter.loudness.clip_gain(mixer_clip['audio_path'])}")
+            chain.extend([f'atrim=end_sample={audio_samples}',
+                          # the 0.5 second fade in and out of create_audio_clip
+                          f'afade=t=in:ns={fade_samples}',
+                          f'afade=t=out:ss={max(audio_samples - fade_samples, 0)}:ns={fade_samples}',
+                          f'apad=whole_len={n_samples}[clip{clip_index}]'])
+            chains.append(','.join(chain))
+        chains.append(''.join(f'[clip{clip_index}]' for clip_index in range(len(chains)))
+                      + f'concat=n={len(chains)}:v=0:a=1[speech]')
+
+        bgm_path = video_crafter.bgm_path
+        if not bgm_path or bgm_path == -1:
+            chains.append('[speech]anull[audio]')
+            return chains
+        bgm_volume = 1.0 if video_crafter.bgm_volume is None else video_crafter.bgm_volume
+        if video_crafter.loudness is not None:
+            bgm_volume = video_crafter.loudness.bgm_gain(bgm_path, bgm_volume)
+        chain = [f'amovie=filename={escape_filter_value(bgm_path)}:loop=0', audio_format,
+                 f'atrim=end_sample={total_samples}', f'volume={bgm_volume}']
+        fadeout_samples = int((video_crafter.audio_fadeout_duration or 0) * AUDIO_FPS)
+        if fadeout_samples > 0:
+            chain.append(f'afade=t=out:ss={max(total_samples - fadeout_samples, 0)}:ns={fadeout_samples}')
+        chains.append(','.join(chain) + '[bgm]')
+        # the clips and the BGM are summed like CompositeAudioClip, amix would scale them down
+        chains.append('[speech][bgm]amix=inputs=2:duration=first:normalize=0[audio]')
+        return chains
+
+
+def test_NativeRenderer():
+    '''
+    The native render of a config matches create_video_fast: same duration, frames and audio up to the encoding noise.
+    The config covers frame_size rules, a transparent key frame, fades, pauses, a stretched clip, a silent clip,
+    a looped background video, the BGM and libass subtitles (burnt in by both). A movement falls back to moviepy.
+    '''
+    import numpy as np
+    from ffmpeg_utils import decode_audio, iter_video_frames, probe_duration, run_ffmpeg
+    from video_crafter import VideoCrafter
+    fps = 10
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, frequency, duration in (('speech0.mp3', 440, 1.3), ('speech1.mp3', 660, 0.9), ('bgm.mp3', 220, 8)):
+            run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency={frequency}:duration={duration}', '-ac', 2, '-ar', AUDIO_FPS,
+                        os.path.join(temp_dir, name)])
+        background_path = os.path.join(temp_dir, 'background.mp4')
+        # a smooth moving gradient, the encoder turns the last-bit rounding differences of a busy picture into visible noise
+        run_ffmpeg(['-f', 'lavfi', '-i', "nullsrc=s=320x180:r=25:d=2,geq=lum='40+X/2+3*N':cb=128:cr='100+Y/4'",
+                    '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', background_path])
+        logo = Image.new('RGBA', (200, 100), (0, 0, 0, 0))
+        logo.paste((200, 30, 30, 255), (20, 20, 180, 80))
+        logo.save(os.path.join(temp_dir, 'logo.png'))
+        key_frame = Image.new('RGB', (400, 300), (30, 60, 200))
+        key_frame.paste((250, 220, 40), (0, 0, 200, 150))
+        key_frame.save(os.path.join(temp_dir, 'key_frame.png'))
+
+        def make_config(name, **options):
+            config = {
+                'width': 160, 'height': 90, 'fps': fps,
+                'output_path': os.path.join(temp_dir, name),
+                'cache_dir': os.path.join(temp_dir, 'cache'),
+                'metrics_report_path': None,
+                'bgm_path': os.path.join(temp_dir, 'bgm.mp3'), 'bgm_volume': 0.3, 'audio_fadeout_duration': 1,
+                'background_video_path': background_path,
+                'subtitle_config': {'renderer': 'libass', 'fontsize': 14, 'background_color': 'black', 'y_position': 0.75},
+                'clips': [
+                    {'audio_path': -1, 'key_frame_path': os.path.join(temp_dir, 'logo.png'), 'duration': 1.05,
+                     'frame_size': {'width': -1, 'height': 0.5, 'unit': 'ratio'}, 'fadeout_duration': 0.5, 'transition_pause_time': 0.3},
+                    {'audio_path': os.path.join(temp_dir, 'speech0.mp3'), 'key_frame_path': os.path.join(temp_dir, 'key_frame.png'),
+                     'frame_size': {'width': 120, 'height': -1}, 'transition_pause_time': 0.25, 'fadeout_duration': 0.4,
+                     'subtitle_text': 'First line'},
+                    {'audio_path': os.path.join(temp_dir, 'speech1.mp3'), 'key_frame_path': -1, 'audio_speed': 1.25,
+                     'transition_pause_time': 0.2, 'subtitle_text': 'Second line'},
+                    {'audio_path': os.path.join(temp_dir, 'speech0.mp3'), 'key_frame_path': os.path.join(temp_dir, 'key_frame.png')},
+                ],
+            }
+            config.update(options)
+            return config
+        VideoCrafter(make_config('fast.mp4')).create_video_fast()
+        native_crafter = VideoCrafter(make_config('native.mp4', render_backend='native'))
+        native_crafter.create()
+        assert native_crafter.metrics.report()['mode'] == 'native'
+
+        fast_path, native_path = os.path.join(temp_dir, 'fast.mp4'), os.path.join(temp_dir, 'native.mp4')
+        assert abs(probe_duration(native_path) - probe_duration(fast_path)) < 0.05
+        fast_frames = list(iter_video_frames(fast_path, (160, 90), fps))
+        native_frames = list(iter_video_frames(native_path, (160, 90), fps))
+        assert len(native_frames) == len(fast_frames) > 40
+        for fast_frame, native_frame in zip(fast_frames, native_frames):
+            # a key frame a frame early or late, or off by a pixel, differs by tens of levels
+            assert np.abs(fast_frame.astype(np.float32) - native_frame).mean() < 3
+        fast_audio, native_audio = decode_audio(fast_path), decode_audio(native_path)
+        assert abs(len(native_audio) - len(fast_audio)) < 0.05 * AUDIO_FPS
+        n_samples = min(len(fast_audio), len(native_audio))
+        assert np.abs(fast_audio[:n_samples] - native_audio[:n_samples]).max() < 0.05
+
+        zoom_config = make_config('zoom.mp4', render_backend='native')
+        zoom_config['clips'][1]['movement'] = {'type': 'zoom'}
+        assert 'zoom' in NativeRenderer(VideoCrafter(zoom_config)).unsupported_reason()
+    print('test_NativeRenderer passed')
+
+if __name__ == '__main__':
+    test_NativeRenderer()
@@ -0,0 +1,196 @@
+import functools
+import gc
+import multiprocessing
+import queue
+import traceback
+import types
+from multiprocessing import shared_memory
+import numpy as np
+
+# the clip rendered by the forked workers, set in the parent right before forking so it is inherited, never pickled
+_worker_clip = None
+
+
+def can_render_in_parallel():
+    '''Workers inherit the clip graph (closures, readers) by forking, which is not available on Windows.'''
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def _skip_frames_keeping_last(reader, n=1):
+    # past the end of the file the reader repeats the last frame it read, which must not depend on
+    # which frames this worker skipped, so skipped frames are read too
+    for _ in range(n):
+        reader.read_frame()
+    reader.pos += n
+
+
+def _iter_reachable(root):
+    '''
+    The objects reachable from root through attributes, containers and closures. Function globals, modules and classes
+    are not followed, they lead to objects of the whole process rather than of the clip.
+    '''
+    seen = set()
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (types.ModuleType, type, str, bytes, int, float, np.ndarray)):
+            continue
+        seen.add(id(obj))
+        yield obj
+        if isinstance(obj, types.FunctionType):
+            for cell in obj.__closure__ or ():
+                try:
+                    stack.append(cell.cell_contents)
+                except ValueError:
+                    # an empty cell
+                    pass
+            stack.extend(obj.__defaults__ or ())
+            stack.extend((obj.__kwdefaults__ or {}).values())
+        else:
+            stack.extend(gc.get_referents(obj))
+
+
+def _reopen_video_readers(clip):
+    '''
+    A forked worker shares the parent's ffmpeg reader pipes, reading from them would steal the parent's frames.
+    Every reader of clip gets its own process, reset to the state VideoFileClip leaves it in, so frames read the same.
+    Readers of other clips of the process are left alone, their files may be gone.
+    '''
+    from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+    for obj in _iter_reachable(clip):
+        if isinstance(obj, FFMPEG_VideoReader) and obj.proc is not None:
+            obj.proc = None  # the parent's process, must not be terminated from here
+            obj.initialize()
+            obj.pos = 1
+            obj.lastread = obj.read_frame()
+            obj.skip_frames = functools.partial(_skip_frames_keeping_last, obj)
+
+
+def _render_worker(shm_name, frame_shape, fps, task_queue, done_queue):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        _reopen_video_readers(_worker_clip)
+        slots = np.ndarray((shm.size // int(np.prod(frame_shape)),) + frame_shape, dtype=np.uint8, buffer=shm.buf)
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            frame_index, slot = task
+            try:
+                slots[slot] = _worker_clip.get_frame(frame_index / fps)
+                done_queue.put((frame_index, slot, None))
+            except Exception:
+                done_queue.put((frame_index, slot, traceback.format_exc()))
+                break
+        del slots
+    finally:
+        shm.close()
+
+
+def iter_frames_parallel(clip, start_frame, end_frame, fps, workers=2, ring_size=None, block_frames=4):
+    '''
+    Yields the uint8 frames start_frame <= i < end_frame of clip, frame i being clip.get_frame(i / fps), in order.
+    workers forked processes render frames into a shared-memory ring of ring_size frame slots, a slot is handed out
+    again only once its frame has been consumed, so at most ring_size frames are in flight (backpressure).
+    Frames are dealt to the workers in blocks of block_frames, so each worker reads video sources almost sequentially.
+    A yielded frame is a view into the ring, valid until the next frame is requested.
+    '''
+    global _worker_clip
+    if end_frame <= start_frame:
+        return
+    ring_size = ring_size or 2 * workers * block_frames
+    frame_shape = (clip.size[1], clip.size[0], 3)
+    frame_bytes = int(np.prod(frame_shape))
+    context = multiprocessing.get_context('fork')
+    shm = shared_memory.SharedMemory(create=True, size=ring_size * frame_bytes)
+    slots = np.ndarray((ring_size,) + frame_shape, dtype=np.uint8, buffer=shm.buf)
+    task_queues = [context.SimpleQueue() for _ in range(workers)]
+    done_queue = context.Queue()
+    _worker_clip = clip
+    processes = [context.Process(target=_render_worker, args=(shm.name, frame_shape, fps, task_queue, done_queue), daemon=True)
+                 for task_queue in task_queues]
+    try:
+        for process in processes:
+            process.start()
+    finally:
+        _worker_clip = None
+
+    def dispatch(frame_index, slot):
+        task_queues[(frame_index - start_frame) // block_frames % workers].put((frame_index, slot))
+
+    try:
+        next_dispatch = start_frame
+        for slot in range(min(ring_size, end_frame - start_frame)):
+            dispatch(next_dispatch, slot)
+            next_dispatch += 1
+        ready = {}
+        for frame_index in range(start_frame, end_frame):
+            while frame_index not in ready:
+                try:
+                    done_index, slot, error = done_queue.get(timeout=1)
+                except queue.Empty:
+                    if not all(process.is_alive() for process in processes):
+                        raise RuntimeError('A render worker died')
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Rendering frame {done_index} failed in a worker:\n{error}")
+                ready[done_index] = slot
+            slot = ready.pop(frame_index)
+            yield slots[slot]
+            # the consumer is done with the frame, its slot can take the next frame
+            if next_dispatch < end_frame:
+                dispatch(next_dispatch, slot)
+                next_dispatch += 1
+    finally:
+        for task_queue in task_queues:
+            task_queue.put(None)
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        del slots
+        shm.close()
+        shm.unlink()
+
+
+def test_iter_frames_parallel():
+    '''Parallel frames must be identical to the single-threaded ones, for a composed and a file-backed clip.'''
+    import os
+    import tempfile
+    from moviepy.editor import ColorClip, VideoFileClip
+    from timeline import TimelineClip
+    from ffmpeg_utils import run_ffmpeg
+    fps = 24
+    background = ColorClip(size=(64, 36), color=(255, 255, 255)).set_duration(2)
+    layers = [
+        ColorClip(size=(20, 10), color=(255, 0, 0)).set_duration(1.5).set_start(0).set_position(lambda t: (int(t * 30), 5)).crossfadeout(0.5),
+        ColorClip(size=(30, 10), color=(0, 255, 0)).set_duration(1).set_start(1).set_position((5, 20)),
+    ]
+    clip = TimelineClip(background, layers)
+    expected = [clip.get_frame(i / fps).astype('uint8') for i in range(48)]
+    frames = [frame.copy() for frame in iter_frames_parallel(clip, 0, 48, fps, workers=3, ring_size=5, block_frames=2)]
+    assert all(np.array_equal(a, b) for a, b in zip(expected, frames)) and len(frames) == 48
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = os.path.join(temp_dir, 'source.mp4')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=size=64x36:rate=24:duration=2', '-pix_fmt', 'yuv420p', video_path])
+        # past its end the video freezes on its last frame
+        video = VideoFileClip(video_path).set_duration(3)
+        frames = [frame.copy() for frame in iter_frames_parallel(video, 10, 72, fps, workers=2)]
+        expected = [video.get_frame(i / fps) for i in range(10, 72)]
+        assert all(np.array_equal(a, b) for a, b in zip(expected, frames))
+        video.close()
+
+        # a reader of an unrelated clip whose file is gone is not reopened by the workers
+        stale_path = os.path.join(temp_dir, 'stale.mp4')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=size=64x36:rate=24:duration=1', '-pix_fmt', 'yuv420p', stale_path])
+        stale_video = VideoFileClip(stale_path)
+        os.remove(stale_path)
+        color = ColorClip(size=(64, 36), color=(0, 0, 255)).set_duration(1)
+        frames = [frame.copy() for frame in iter_frames_parallel(color, 0, 24, fps, workers=2)]
+        assert len(frames) == 24 and all(np.array_equal(frame, color.get_frame(0)) for frame in frames)
+        stale_video.close()
+    print('test_iter_frames_parallel passed')
+
+if __name__ == '__main__':
+    test_iter_frames_parallel()
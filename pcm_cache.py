@@ -0,0 +1,85 @@
+import json
+import threading
+import numpy as np
+from asset_cache import AssetCache
+from ffmpeg_utils import decode_audio
+
+
+class PcmCache:
+    '''
+    Decoded audio kept in the asset cache as float32 (samples, nchannels) .npy files at a fixed fps, keyed by the content
+    hash of the source, and opened as read-only memory maps. An audio file is decoded once across runs, and readers
+    slice the mapped pages instead of copying or decoding the whole file again.
+    The container duration ffmpeg reports is cached next to the samples, moviepy and AudioMixer time clips by it.
+    '''
+    def __init__(self, asset_cache, fps=44100, nchannels=2):
+        self.asset_cache = asset_cache
+        self.fps = fps
+        self.nchannels = nchannels
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def load(self, audio_path):
+        '''Returns (samples, duration) of audio_path, samples being a read-only memory map.'''
+        key = AssetCache.make_key('pcm', self.asset_cache.content_hash(audio_path), fps=self.fps, nchannels=self.nchannels)
+        decoded_durations = []
+
+        def decode(temp_path):
+            samples, duration = decode_audio(audio_path, self.fps, self.nchannels, with_duration=True)
+            np.save(temp_path, samples)
+            decoded_durations.append(duration)
+        samples_path = self.asset_cache.fetch(key, '.npy', decode)
+        try:
+            samples = np.load(samples_path, mmap_mode='r')
+        except ValueError:
+            # an empty array cannot be memory-mapped
+            samples = np.load(samples_path)
+
+        with self._lock:
+            duration = self._durations.get(key)
+        if duration is None:
+            def write_duration(temp_path):
+                if not decoded_durations:
+                    # the samples were cached but their duration was evicted
+                    decoded_durations.append(decode_audio(audio_path, self.fps, self.nchannels, with_duration=True)[1])
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'duration': decoded_durations[0]}, f)
+            duration_path = self.asset_cache.fetch(AssetCache.make_key('pcm_duration', key), '.json', write_duration)
+            with open(duration_path, 'r', encoding='utf-8') as f:
+                duration = json.load(f)['duration']
+            with self._lock:
+                self._durations[key] = duration
+        return samples, duration
+
+
+def test_PcmCache():
+    '''A file is decoded on the first load only, also by a new cache instance (a new run), and reads back identical.'''
+    import os
+    import tempfile
+    from ffmpeg_utils import run_ffmpeg
+    decode_calls = []
+    original_decode_audio = decode_audio
+
+    def counting_decode_audio(*args, **kwargs):
+        decode_calls.append(args[0])
+        return original_decode_audio(*args, **kwargs)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        audio_path = os.path.join(temp_dir, 'tone.mp3')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=440:duration=1.5', '-ac', 2, '-ar', 44100, audio_path])
+        expected, expected_duration = decode_audio(audio_path, with_duration=True)
+        module_globals = PcmCache.load.__globals__
+        module_globals['decode_audio'] = counting_decode_audio
+        try:
+            for _ in range(2):
+                cache = PcmCache(AssetCache(os.path.join(temp_dir, 'cache')))
+                for _ in range(2):
+                    samples, duration = cache.load(audio_path)
+                    assert isinstance(samples, np.memmap) and not samples.flags.writeable
+                    assert np.array_equal(samples, expected) and duration == expected_duration
+        finally:
+            module_globals['decode_audio'] = original_decode_audio
+        assert decode_calls == [audio_path]
+    print('test_PcmCache passed')
+
+if __name__ == '__main__':
+    test_PcmCache()
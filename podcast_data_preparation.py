@@ -1,33 +1,223 @@
+import itertools
 import json
 import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from asset_cache import AssetCache
+from render_metrics import RenderMetrics, JsonReportHook
+
+class _JsonStream:
+    '''Decodes JSON values one at a time from a text file read in chunks, with JSONDecoder.raw_decode.'''
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''The next non-whitespace character, '' at the end of the file.'''
+        while True:
+            self.pos = self._whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in {self.f.name}, got {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+                # a number followed by the end of the buffer, or by what could be more digits, may go on in the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in '0123456789.eE+-'):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self.pos += 1
+
 
 class PodcastDataJsonReader:
-    def __init__(self, json_path):
+    '''
+    Reads the items of an episode script lazily, so a long script is never held in memory at once.
+    The file can hold {"result": [...]}, a bare list of items or JSON Lines (one item per line):
+    an object with a "result" list contributes the items of that list, any other object is an item itself.
+    '''
+    def __init__(self, json_path, chunk_size=1 << 16):
         self.json_path = json_path
+        self.chunk_size = chunk_size
 
     def read_json(self):
+        return list(self.iter_items())
+
+    def iter_items(self):
         with open(self.json_path, 'r', encoding='utf-8') as f:
-            return json.load(f)['result']
+            stream = _JsonStream(f, self.chunk_size)
+            while True:
+                char = stream.peek()
+                if char == '':
+                    return
+                if char == '[':
+                    yield from stream.iter_array()
+                elif char == '{':
+                    yield from self._iter_object_items(stream)
+                else:
+                    raise ValueError(f"Expected an object or a list in {self.json_path}, got {char!r}")
+
+    def _iter_object_items(self, stream):
+        stream.expect('{')
+        fields = {}
+        has_result = False
+        if stream.peek() == '}':
+            stream.pos += 1
+        else:
+            while True:
+                key = stream.value()
+                stream.expect(':')
+                if key == 'result' and stream.peek() == '[':
+                    yield from stream.iter_array()
+                    has_result = True
+                else:
+                    fields[key] = stream.value()
+                if stream.peek() != ',':
+                    stream.expect('}')
+                    break
+                stream.pos += 1
+        if not has_result:
+            yield fields
+
+
+class AudioDownloader:
+    '''
+    Downloads audio files over one pooled requests.Session, safe to share between the threads of a download pool,
+    max_workers sizes its connection pool (and the pool of PodcastDataPreparation.iter_audio_paths).
+    Every file is written to a temp file first and renamed into place once complete,
+    so an interrupted run never leaves a truncated file behind.
+    '''
+    def __init__(self, max_workers=8, max_retries=3, backoff_factor=0.5, timeout=30, chunk_size=8192):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # bytes received over the network, across all threads, retries included
+        self.bytes_downloaded = 0
+        self._bytes_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url, local_filename):
+        if os.path.exists(local_filename):
+            print(f"File {local_filename} already exists")
+            return local_filename
+
+        # the temp name is unique per thread, so two jobs for the same url never share a partial file
+        temp_filename = f"{local_filename}.{os.getpid()}.{threading.get_ident()}.part"
+        self.fetch(url, temp_filename)
+        os.replace(temp_filename, local_filename)
+        print(f"Downloaded {url} to {local_filename}")
+        return local_filename
+
+    def fetch(self, url, filename):
+        '''Streams url into filename with retries, removes the partial file if every attempt fails.'''
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    with open(filename, 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                            with self._bytes_lock:
+                                self.bytes_downloaded += len(chunk)
+                return filename
+            # a connection dropped mid-body surfaces as ChunkedEncodingError (or ContentDecodingError if compressed)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError) as e:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                # client errors (404, 403...) will not be fixed by retrying
+                status_code = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+                if attempt == self.max_retries or (status_code is not None and status_code < 500 and status_code != 429):
+                    raise
+                wait_time = self.backoff_factor * (2 ** attempt) * (1 + random.random())
+                print(f"Download of {url} failed ({e}), retrying in {wait_time:.2f} seconds")
+                time.sleep(wait_time)
+
+    def close(self):
+        self.session.close()
 
 
 class PodcastDataPreparation:
-    def __init__(self, json_path, output_dir, video_width=1920, video_height=1080, key_frame_path=-1):
-        self.url_data_list = PodcastDataJsonReader(json_path).read_json()
+    def __init__(self, json_path, output_dir, video_width=1920, video_height=1080, key_frame_path=-1, max_download_workers=8,
+                 cache_dir=None, cache_max_bytes=None, assets_dir='D:\Study\AIAgent\AIPodcast\\assets', metrics=None):
+        '''metrics is a RenderMetrics to record into, by default the report is written to <output_dir>/prepare_report.json.'''
+        self.json_reader = PodcastDataJsonReader(json_path)
         self.output_dir = output_dir
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
         self.video_width = video_width
         self.video_height = video_height
         self.key_frame_path = key_frame_path
+        self.downloader = AudioDownloader(max_workers=max_download_workers)
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.asset_cache = AssetCache(cache_dir, cache_max_bytes)
+        # lounge_jazz.mp3, raining_window_10min.mp4, cover.png and logo.png
+        self.assets_dir = assets_dir
+        if metrics is None:
+            metrics = RenderMetrics('podcast_data_preparation', hooks=[JsonReportHook(os.path.join(output_dir, 'prepare_report.json'))])
+        self.metrics = metrics
 
     def get_basic_video_info(self):
         return {
             'height': self.video_height,
             'width': self.video_width,
-            'bgm_path': 'D:\Study\AIAgent\AIPodcast\\assets\lounge_jazz.mp3',
-            'background_video_path': 'D:\Study\AIAgent\AIPodcast\\assets\\raining_window_10min.mp4',
+            'bgm_path': os.path.join(self.assets_dir, 'lounge_jazz.mp3'),
+            'background_video_path': os.path.join(self.assets_dir, 'raining_window_10min.mp4'),
             'output_path': os.path.join(self.output_dir, 'output.mp4'),
+            'cache_dir': self.cache_dir,
+            'cache_max_bytes': self.cache_max_bytes,
             'audio_fadeout_duration': 2,
             'bgm_volume': 0.3,
             'subtitle_config': {
@@ -37,13 +227,17 @@ class PodcastDataPreparation:
             'clips': []
         }
 
-    def prepare_data(self):
+    def prepare_data(self, stream=False):
+        '''
+        With stream, clips is a generator: the script is read and the audios are downloaded while the clips are consumed,
+        so VideoCrafter starts stretching before the whole script has been parsed.
+        '''
         video_info_config = self.get_basic_video_info()
         # Cover
         cover_clip_info = {
             'audio_path': -1,
-            'key_frame_path': 'D:\Study\AIAgent\AIPodcast\\assets\cover.png',
-            'frame_size': {'width': 1920, 'height': 1080, 'unit': 'pixel'},
+            'key_frame_path': os.path.join(self.assets_dir, 'cover.png'),
+            'frame_size': {'width': self.video_width, 'height': self.video_height, 'unit': 'pixel'},
             'duration': 1,
             'fadeout_duration': 0,
             'transition_pause_time': 0.0,
@@ -53,7 +247,7 @@ class PodcastDataPreparation:
         # Opening
         opening_clip_info = {
             'audio_path': -1,
-            'key_frame_path': 'D:\Study\AIAgent\AIPodcast\\assets\logo.png',
+            'key_frame_path': os.path.join(self.assets_dir, 'logo.png'),
             'frame_size': {'width': -1, 'height': 0.5, 'unit': 'ratio'},
             'duration': 3,
             'fadeout_duration': 2,
@@ -62,28 +256,33 @@ class PodcastDataPreparation:
         }
         video_info_config['clips'].append(opening_clip_info)
         # Body
-        for item in self.url_data_list:
-            clip_info = {
-                'audio_path': self.download_audio(item['audio_url']),
-                'key_frame_path': self.key_frame_path,
-                'duration': -1,
-                'transition_pause_time': 0.3,
-                'audio_speed': 1.1,
-                'subtitle_text': self.get_subtitle(item['sentence'])
-            }
-            video_info_config['clips'].append(clip_info)
+        body_clip_infos = self.iter_body_clip_infos(lambda item, audio_path: {
+            'audio_path': audio_path,
+            'key_frame_path': self.key_frame_path,
+            'duration': -1,
+            'transition_pause_time': 0.3,
+            'audio_speed': 1.1,
+            'subtitle_text': self.get_subtitle(item['sentence'])
+        })
+        if stream:
+            video_info_config['clips'] = itertools.chain(video_info_config['clips'], body_clip_infos)
+        else:
+            video_info_config['clips'].extend(body_clip_infos)
         return video_info_config
 
     def get_basic_pure_audio_info(self):
         return {
-            'bgm_path': 'D:\Study\AIAgent\AIPodcast\\assets\lounge_jazz.mp3',
+            'bgm_path': os.path.join(self.assets_dir, 'lounge_jazz.mp3'),
             'output_path': os.path.join(self.output_dir, 'output.mp3'),
+            'cache_dir': self.cache_dir,
+            'cache_max_bytes': self.cache_max_bytes,
             'audio_fadeout_duration': 2,
             'bgm_volume': 0.3,
             'clips': []
         }
 
-    def prepare_pure_audio_data(self):
+    def prepare_pure_audio_data(self, stream=False):
+        '''stream works as in prepare_data.'''
         pure_audio_info_config = self.get_basic_pure_audio_info()
         # Opening
         opening_clip_info = {
@@ -92,33 +291,86 @@ class PodcastDataPreparation:
         }
         pure_audio_info_config['clips'].append(opening_clip_info)
         # Body
-        for item in self.url_data_list:
-            clip_info = {
-                'audio_path': self.download_audio(item['audio_url']),
-                'duration': -1,
-                'transition_pause_time': 0.3,
-                'audio_speed': 1.1,
-            }
-            pure_audio_info_config['clips'].append(clip_info)
+        body_clip_infos = self.iter_body_clip_infos(lambda item, audio_path: {
+            'audio_path': audio_path,
+            'duration': -1,
+            'transition_pause_time': 0.3,
+            'audio_speed': 1.1,
+        })
+        if stream:
+            pure_audio_info_config['clips'] = itertools.chain(pure_audio_info_config['clips'], body_clip_infos)
+        else:
+            pure_audio_info_config['clips'].extend(body_clip_infos)
         return pure_audio_info_config
 
+    def iter_body_clip_infos(self, make_clip_info):
+        '''Yields make_clip_info(item, audio_path) for every script item, in order, as the items are read and downloaded.'''
+        items = deque()
+
+        def iter_urls():
+            for item in self.json_reader.iter_items():
+                items.append(item)
+                yield item['audio_url']
+        try:
+            for audio_path in self.iter_audio_paths(iter_urls()):
+                yield make_clip_info(items.popleft(), audio_path)
+        finally:
+            # also when the consumer stops early or a download fails
+            self.metrics.finish()
+
     def download_audio(self, url):
-        output_dir = os.path.join(self.output_dir, 'downloaded_audios')
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        # the content is unknown before downloading, so downloads are keyed by url
+        key = AssetCache.make_key('download', url)
+        audio_extension = os.path.splitext(url.split('/')[-1])[1]
+        cached_path = self.asset_cache.fetch(key, audio_extension, lambda temp_path: self.downloader.fetch(url, temp_path))
+        print(f"Audio {url} is cached at {cached_path}")
+        return cached_path
 
-        local_filename = os.path.join(output_dir, url.split('/')[-1])
-        if os.path.exists(local_filename):
-            print(f"File {local_filename} already exists")
-            return local_filename
-        
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        print(f"Downloaded {url} to {local_filename}")
-        return local_filename
+    def _download_audio_timed(self, url_index, url):
+        time_start = time.perf_counter()
+        audio_path = self.download_audio(url)
+        self.metrics.record_clip(url_index, time.perf_counter() - time_start, audio_url=url)
+        return audio_path
+
+    def iter_audio_paths(self, urls, total=None, prefetch=None):
+        '''
+        Downloads urls, read lazily, with the thread pool and yields the audio paths in order.
+        At most prefetch downloads (default twice the workers) run ahead of the consumer.
+        '''
+        prefetch = prefetch or 2 * self.downloader.max_workers
+        bytes_start = self.downloader.bytes_downloaded
+        hits_start, misses_start = self.asset_cache.hits, self.asset_cache.misses
+        # the count of this stream, streams of the same preparation can overlap
+        progress_lock = threading.Lock()
+        downloads_done = [0]
+
+        def download(url_index, url):
+            audio_path = self._download_audio_timed(url_index, url)
+            with progress_lock:
+                downloads_done[0] += 1
+                self.metrics.progress('download', downloads_done[0], total)
+            return audio_path
+        with self.metrics.stage('download') as stage:
+            with ThreadPoolExecutor(max_workers=self.downloader.max_workers) as executor:
+                pending = deque()
+                for url_index, url in enumerate(urls):
+                    pending.append(executor.submit(download, url_index, url))
+                    if len(pending) >= prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            stage['audios'] = downloads_done[0]
+            stage['bytes_downloaded'] = self.downloader.bytes_downloaded - bytes_start
+        print(f"Asset cache: {self.asset_cache.hits} hits, {self.asset_cache.misses} misses")
+        self.metrics.add('bytes_downloaded', self.downloader.bytes_downloaded - bytes_start)
+        self.metrics.add('cache_hits', self.asset_cache.hits - hits_start)
+        self.metrics.add('cache_misses', self.asset_cache.misses - misses_start)
+
+    def download_audios(self, urls):
+        urls = list(urls)
+        if not urls:
+            return []
+        return list(self.iter_audio_paths(urls, total=len(urls), prefetch=len(urls)))
 
     def get_subtitle(self, sentence):
         '''input: 原来如此。（恍然大悟）啊，我懂了。
@@ -137,6 +389,30 @@ def test_PodcastDataJsonReader():
     for item in data:
         print(item)
 
+def test_PodcastDataJsonReader_layouts():
+    '''The {"result": [...]}, bare list and JSON Lines layouts give the same items, read in chunks smaller than an item.'''
+    import tempfile
+    items = [{'audio_url': f'http://example.com/{i}.mp3', 'sentence': f'第{i}句，"quoted" {{braces}} [brackets]', 'score': i * 1.5}
+             for i in range(30)]
+    layouts = {
+        'result.json': json.dumps({'code': 0, 'result': items, 'message': 'ok'}, ensure_ascii=False, indent=2),
+        'list.json': json.dumps(items),
+        'items.jsonl': '\n'.join(json.dumps(item, ensure_ascii=False) for item in items) + '\n',
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, text in layouts.items():
+            path = os.path.join(temp_dir, name)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            for chunk_size in (7, 1 << 16):
+                assert PodcastDataJsonReader(path, chunk_size).read_json() == items, (name, chunk_size)
+        # items are yielded before the end of the file is read
+        path = os.path.join(temp_dir, 'result.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"result": [' + json.dumps(items[0]) + ', {"broken"')
+        assert next(PodcastDataJsonReader(path, 16).iter_items()) == items[0]
+    print('test_PodcastDataJsonReader_layouts passed')
+
 def test_PodcastDataPreparation():
     preparation = PodcastDataPreparation('D:\Study\AIAgent\AIPodcast\output\episode_test\\test_long.json', 'D:\Study\AIAgent\AIPodcast\output\\episode_test')
     print(preparation.prepare_data())
@@ -145,7 +421,99 @@ def test_get_subtitle():
     preparation = PodcastDataPreparation('D:\Study\AIAgent\AIPodcast\output\episode_test\\test_long.json', 'D:\Study\AIAgent\AIPodcast\output\\episode_test')
     print(preparation.get_subtitle("原来（思考片刻）“我要做”，就是我们该做却总是拖延的事情，对吧？"))
 
+def test_AudioDownloader():
+    '''Downloads from a local stand-in http server, one url fails once and one is cut off once to exercise the retry path.'''
+    import tempfile
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        serve_dir = os.path.join(temp_dir, 'serve')
+        output_dir = os.path.join(temp_dir, 'output')
+        os.makedirs(serve_dir)
+        os.makedirs(output_dir)
+        for i in range(20):
+            with open(os.path.join(serve_dir, f'{i}.mp3'), 'wb') as f:
+                f.write(os.urandom(100000 + i))
+
+        failed_once = set()
+        class FlakyHandler(SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=serve_dir, **kwargs)
+
+            def do_GET(self):
+                if self.path == '/3.mp3' and self.path not in failed_once:
+                    failed_once.add(self.path)
+                    self.send_error(503)
+                    return
+                if self.path == '/5.mp3' and self.path not in failed_once:
+                    # the connection drops in the middle of the body
+                    failed_once.add(self.path)
+                    self.send_response(200)
+                    self.send_header('Content-Length', 100005)
+                    self.end_headers()
+                    self.wfile.write(b'x' * 1000)
+                    self.close_connection = True
+                    return
+                super().do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            downloader = AudioDownloader(max_workers=4, backoff_factor=0.01)
+            base_url = f'http://127.0.0.1:{server.server_address[1]}'
+            pairs = [(f'{base_url}/{i}.mp3', os.path.join(output_dir, f'{i}.mp3')) for i in range(20)]
+            with ThreadPoolExecutor(max_workers=downloader.max_workers) as executor:
+                paths = list(executor.map(lambda pair: downloader.download(*pair), pairs))
+            for i, path in enumerate(paths):
+                with open(path, 'rb') as f, open(os.path.join(serve_dir, f'{i}.mp3'), 'rb') as g:
+                    assert f.read() == g.read()
+            assert not [name for name in os.listdir(output_dir) if name.endswith('.part')]
+            try:
+                downloader.download(f'{base_url}/missing.mp3', os.path.join(output_dir, 'missing.mp3'))
+                assert False, 'a 404 should raise'
+            except requests.HTTPError:
+                pass
+            assert not os.path.exists(os.path.join(output_dir, 'missing.mp3'))
+            downloader.close()
+            print('test_AudioDownloader passed')
+        finally:
+            server.shutdown()
+
+def test_iter_audio_paths():
+    '''Overlapping download streams of one preparation count their own downloads, a body stream left early still reports.'''
+    import tempfile
+    from benchmark import SyntheticEpisode, serve_directory
+    with tempfile.TemporaryDirectory() as temp_dir:
+        episode = SyntheticEpisode(os.path.join(temp_dir, 'assets'), 6, 160, 90)
+        episode.build()
+        json_path = os.path.join(temp_dir, 'podcast.json')
+        with serve_directory(episode.clips_dir) as base_url:
+            episode.write_podcast_json(json_path, base_url)
+            reports = []
+            preparation = PodcastDataPreparation(json_path, os.path.join(temp_dir, 'output'), 160, 90, key_frame_path=episode.key_frame_paths[0],
+                                                 cache_dir=os.path.join(temp_dir, 'cache'), assets_dir=episode.assets_dir,
+                                                 metrics=RenderMetrics('test', hooks=[reports.append]))
+            urls = [item['audio_url'] for item in preparation.json_reader.iter_items()]
+            first_stream, second_stream = preparation.iter_audio_paths(urls[:2], prefetch=1), preparation.iter_audio_paths(urls[2:], prefetch=1)
+            paths = [next(first_stream), next(second_stream)]
+            paths = paths[:1] + list(first_stream) + paths[1:] + list(second_stream)
+            assert len(paths) == len(urls) and all(os.path.exists(path) for path in paths)
+            assert sorted(stage['audios'] for stage in preparation.metrics.stages if stage['name'] == 'download') == sorted([2, len(urls) - 2])
+
+            body_clip_infos = preparation.iter_body_clip_infos(lambda item, audio_path: audio_path)
+            next(body_clip_infos)
+            body_clip_infos.close()
+            assert len(reports) == 1
+        preparation.downloader.close()
+    print('test_iter_audio_paths passed')
+
 if __name__ == '__main__':
     # test_PodcastDataJsonReader()
+    # test_PodcastDataJsonReader_layouts()
     # test_PodcastDataPreparation()
+    # test_AudioDownloader()
+    # test_iter_audio_paths()
     test_get_subtitle()
@@ -0,0 +1,188 @@
+import gc
+import heapq
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_bytes():
+    '''Peak resident memory of this process and of its waited-for children (ffmpeg), None where unsupported.'''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+
+
+def count_ffmpeg_readers():
+    '''Number of moviepy ffmpeg reader processes currently open in this process.'''
+    from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+    from moviepy.audio.io.readers import FFMPEG_AudioReader
+    return sum(1 for obj in gc.get_objects()
+               if isinstance(obj, (FFMPEG_VideoReader, FFMPEG_AudioReader)) and getattr(obj, 'proc', None) is not None)
+
+
+class JsonReportHook:
+    '''Writes the report to path, the default hook.'''
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, report):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+
+class RenderMetrics:
+    '''
+    Structured metrics of a run: wall and CPU time per stage (CPU of this process and of finished ffmpeg children),
+    counters (bytes downloaded, cache hits...), the slowest clips, peak RSS and open ffmpeg readers.
+    finish() sends the report to every hook, a hook is any callable taking the report dict, e.g. JsonReportHook
+    or a function feeding a metrics pipeline. progress_callback(stage, done, total, eta_seconds) is called
+    at most every progress_interval seconds while a stage reports progress, total and eta_seconds are None
+    while the total is not known yet (e.g. a script that is still being read).
+    '''
+    def __init__(self, name, hooks=None, progress_callback=None, slowest_clips=10, progress_interval=0.5):
+        self.name = name
+        self.hooks = list(hooks or [])
+        self.progress_callback = progress_callback
+        self.slowest_clips = slowest_clips
+        self.progress_interval = progress_interval
+        self.stages = []
+        self.counters = {}
+        self.values = {}
+        self._clips = []
+        self._progress_state = {}
+        self._max_ffmpeg_readers = 0
+        self._lock = threading.Lock()
+        self._time_start = time.time()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        '''Times the block as stage name, fields are stored with the stage.'''
+        times_start = os.times()
+        wall_start = time.perf_counter()
+        stage = dict(fields, name=name)
+        # the ETA of the stage's progress counts from the start of the stage
+        self._progress_state[name] = {'start': wall_start, 'last_call': 0}
+        try:
+            yield stage
+        finally:
+            times_end = os.times()
+            stage['wall_seconds'] = round(time.perf_counter() - wall_start, 4)
+            stage['cpu_seconds'] = round(max(times_end.user + times_end.system - times_start.user - times_start.system, 0), 4)
+            stage['children_cpu_seconds'] = round(max(times_end.children_user + times_end.children_system
+                                                      - times_start.children_user - times_start.children_system, 0), 4)
+            if 'frames' in stage and stage['wall_seconds'] > 0:
+                stage['fps'] = round(stage['frames'] / stage['wall_seconds'], 2)
+            stage['ffmpeg_readers'] = count_ffmpeg_readers()
+            self._max_ffmpeg_readers = max(self._max_ffmpeg_readers, stage['ffmpeg_readers'])
+            self.stages.append(stage)
+            print(f"[{self.name}] {name}: {stage['wall_seconds']:.2f}s wall, {stage['cpu_seconds']:.2f}s cpu"
+                  + (f", {stage['fps']:.1f} fps" if 'fps' in stage else ''))
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def record_clip(self, clip_index, seconds, **info):
+        '''Keeps the slowest_clips slowest clips.'''
+        with self._lock:
+            item = (seconds, clip_index, info)
+            if len(self._clips) < self.slowest_clips:
+                heapq.heappush(self._clips, item)
+            elif seconds > self._clips[0][0]:
+                heapq.heapreplace(self._clips, item)
+
+    def progress(self, stage, done, total):
+        if self.progress_callback is None:
+            return
+        now = time.perf_counter()
+        state = self._progress_state.setdefault(stage, {'start': now, 'last_call': 0})
+        if (total is None or done < total) and now - state['last_call'] < self.progress_interval:
+            return
+        state['last_call'] = now
+        elapsed = now - state['start']
+        eta_seconds = elapsed / done * (total - done) if done > 0 and total is not None else None
+        self.progress_callback(stage, done, total, eta_seconds)
+
+    def track_frames(self, clip, stage, total_frames):
+        '''Returns clip with its frame composition timed (counter frame_composition_seconds) and reported as progress.'''
+        frames_done = [0]
+
+        def timed_frame(get_frame, t):
+            time_start = time.perf_counter()
+            frame = get_frame(t)
+            self.add('frame_composition_seconds', time.perf_counter() - time_start)
+            frames_done[0] += 1
+            self.progress(stage, min(frames_done[0], total_frames), total_frames)
+            return frame
+        return clip.fl(timed_frame)
+
+    def report(self):
+        peak_rss, peak_children_rss = peak_rss_bytes()
+        return dict(self.values, **{
+            'name': self.name,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._time_start)),
+            'wall_seconds': round(time.time() - self._time_start, 4),
+            'stages': self.stages,
+            'counters': {key: round(value, 4) if isinstance(value, float) else value for key, value in self.counters.items()},
+            'slowest_clips': [dict(info, clip_index=clip_index, seconds=round(seconds, 4))
+                              for seconds, clip_index, info in sorted(self._clips, reverse=True)],
+            'peak_rss_bytes': peak_rss,
+            'peak_children_rss_bytes': peak_children_rss,
+            'max_open_ffmpeg_readers': self._max_ffmpeg_readers,
+        })
+
+    def finish(self):
+        report = self.report()
+        for hook in self.hooks:
+            hook(report)
+        return report
+
+
+def test_RenderMetrics():
+    import tempfile
+    progress_calls = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report_path = os.path.join(temp_dir, 'report.json')
+        metrics = RenderMetrics('test', hooks=[JsonReportHook(report_path)], progress_callback=lambda *args: progress_calls.append(args),
+                                slowest_clips=2, progress_interval=0)
+        with metrics.stage('busy', frames=10) as stage:
+            sum(i * i for i in range(200000))
+            stage['note'] = 'done'
+        for clip_index, seconds in enumerate([0.1, 0.5, 0.2, 0.4]):
+            metrics.record_clip(clip_index, seconds, audio_path=f'{clip_index}.mp3')
+        metrics.add('bytes_downloaded', 100)
+        metrics.add('bytes_downloaded', 50)
+        with metrics.stage('write'):
+            time.sleep(0.05)
+            for done in range(1, 5):
+                metrics.progress('write', done, 4)
+        metrics.finish()
+        with open(report_path, encoding='utf-8') as f:
+            report = json.load(f)
+    assert report['stages'][0]['name'] == 'busy' and report['stages'][0]['note'] == 'done' and 'fps' in report['stages'][0]
+    assert report['stages'][0]['cpu_seconds'] > 0
+    assert [clip['clip_index'] for clip in report['slowest_clips']] == [1, 3]
+    assert report['counters']['bytes_downloaded'] == 150
+    assert progress_calls[0][:3] == ('write', 1, 4) and progress_calls[0][3] > 0.1
+    assert progress_calls[-1][:3] == ('write', 4, 4) and progress_calls[-1][3] == 0
+    print('test_RenderMetrics passed')
+
+if __name__ == '__main__':
+    test_RenderMetrics()
@@ -0,0 +1,182 @@
+import math
+from timeline import IntervalIndex
+
+
+class RenderSpan:
+    '''Frames start_frame <= i < end_frame, a static span shows the same composed frame throughout.'''
+    def __init__(self, start_frame, end_frame, is_static):
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.is_static = is_static
+
+    @property
+    def n_frames(self):
+        return self.end_frame - self.start_frame
+
+    def __repr__(self):
+        return f"RenderSpan({self.start_frame}, {self.end_frame}, {'static' if self.is_static else 'dynamic'})"
+
+
+def first_frame_at(t, fps):
+    '''Index of the first frame whose time i / fps is at or after t.'''
+    return int(math.ceil(t * fps - 1e-6))
+
+
+def frame_boundary(t, fps, start_frame=0):
+    '''
+    The time halfway before frame first_frame_at(t), on the clock of a video starting at frame start_frame of the episode.
+    The frame times from that frame on are past it, also off by a rounding error: a time shifted by a segment's start,
+    or one of moviepy's writer, which steps with np.arange.
+    '''
+    return (first_frame_at(t, fps) - start_frame - 0.5) / fps
+
+
+def frame_cues(cues, fps, start_frame=0, end_frame=None):
+    '''
+    The cues on the frames start_frame <= i < end_frame, their start and end at the frame_boundary on the clock of a video
+    starting at start_frame. A cue showing on none of those frames is dropped.
+    '''
+    framed_cues = []
+    for (start_time, end_time), text in cues:
+        first_frame = max(first_frame_at(start_time, fps), start_frame)
+        last_frame = first_frame_at(end_time, fps) if end_frame is None else min(first_frame_at(end_time, fps), end_frame)
+        if last_frame > first_frame:
+            framed_cues.append((((first_frame - start_frame - 0.5) / fps, (last_frame - start_frame - 0.5) / fps), text))
+    return framed_cues
+
+
+def plan_render_spans(timeline_layout, subtitle_cues, total_duration, fps, has_dynamic_background=False):
+    '''
+    Splits the frames of an episode into static and dynamic spans.
+    timeline_layout is a list of dicts with start_time, duration, has_image, movement and fadeout_duration,
+    subtitle_cues a list of ((start_time, end_time), text).
+    A frame can only change where an image layer or a cue starts or ends, so the spans are cut there.
+    Spans covered by a moving image, a fading image or a background video are dynamic, consecutive dynamic spans are merged.
+    '''
+    total_frames = int(math.ceil(total_duration * fps - 1e-6))
+    if has_dynamic_background:
+        return [RenderSpan(0, total_frames, False)] if total_frames > 0 else []
+
+    cut_times = [0, total_duration]
+    dynamic_intervals = []
+    for clip_info in timeline_layout:
+        if not clip_info.get('has_image'):
+            continue
+        start_time = clip_info['start_time']
+        end_time = start_time + clip_info['duration']
+        cut_times.extend([start_time, end_time])
+        if clip_info.get('movement'):
+            dynamic_intervals.append((start_time, end_time, True))
+        elif clip_info.get('fadeout_duration'):
+            # crossfadeout only changes the last fadeout_duration seconds of the clip
+            fade_start_time = max(start_time, end_time - clip_info['fadeout_duration'])
+            cut_times.append(fade_start_time)
+            dynamic_intervals.append((fade_start_time, end_time, True))
+    for (start_time, end_time), _ in subtitle_cues:
+        cut_times.extend([start_time, end_time])
+
+    cut_frames = sorted(set(min(max(first_frame_at(t, fps), 0), total_frames) for t in cut_times))
+    dynamic_index = IntervalIndex([(first_frame_at(start_time, fps), first_frame_at(end_time, fps), flag)
+                                   for start_time, end_time, flag in dynamic_intervals])
+    spans = []
+    for start_frame, end_frame in zip(cut_frames[:-1], cut_frames[1:]):
+        # spans never straddle a dynamic interval edge, so checking the first frame is enough
+        is_static = not dynamic_index.query(start_frame)
+        if spans and not is_static and not spans[-1].is_static:
+            spans[-1].end_frame = end_frame
+        else:
+            spans.append(RenderSpan(start_frame, end_frame, is_static))
+    return spans
+
+
+def plan_segments(timeline_layout, total_duration, fps, n_segments):
+    '''
+    Splits an episode at clip boundaries into at most n_segments segments of about the same duration.
+    Returns a list of dicts with clip_start, clip_end (clips clip_start <= i < clip_end), start_frame and end_frame,
+    the frames stay on the episode's frame grid so the segments join without a dropped or repeated frame.
+    '''
+    clip_boundaries = [0]
+    for segment_index in range(n_segments - 1):
+        clip_start = clip_boundaries[-1]
+        if clip_start >= len(timeline_layout):
+            break
+        target_end_time = total_duration * (segment_index + 1) / n_segments
+        clip_end = clip_start + 1
+        # take clips until the next one would end further from the target than stopping here
+        while clip_end < len(timeline_layout):
+            end_time = timeline_layout[clip_end - 1]['start_time'] + timeline_layout[clip_end - 1]['duration']
+            next_end_time = end_time + timeline_layout[clip_end]['duration']
+            if abs(next_end_time - target_end_time) >= abs(end_time - target_end_time):
+                break
+            clip_end += 1
+        clip_boundaries.append(clip_end)
+    return _segments_at_clip_boundaries(timeline_layout, total_duration, fps, clip_boundaries)
+
+
+def plan_fixed_segments(timeline_layout, total_duration, fps, clips_per_segment):
+    '''
+    Like plan_segments, with clips_per_segment clips per segment. A clip changing its duration does not move
+    the clip ranges of the other segments, which lets incremental renders reuse them.
+    '''
+    return _segments_at_clip_boundaries(timeline_layout, total_duration, fps, list(range(0, len(timeline_layout), clips_per_segment)))
+
+
+def _segments_at_clip_boundaries(timeline_layout, total_duration, fps, clip_boundaries):
+    total_frames = int(math.ceil(total_duration * fps - 1e-6))
+    clip_boundaries = [clip_start for clip_start in clip_boundaries if clip_start < len(timeline_layout)] + [len(timeline_layout)]
+    segments = []
+    for clip_start, clip_end in zip(clip_boundaries[:-1], clip_boundaries[1:]):
+        start_frame = first_frame_at(timeline_layout[clip_start]['start_time'], fps)
+        end_frame = total_frames if clip_end == len(timeline_layout) else \
+            first_frame_at(timeline_layout[clip_end]['start_time'], fps)
+        if end_frame > start_frame:
+            segments.append({'clip_start': clip_start, 'clip_end': clip_end, 'start_frame': start_frame, 'end_frame': end_frame})
+        elif segments:
+            # clips shorter than a frame belong to the previous segment
+            segments[-1]['clip_end'] = clip_end
+    return segments
+
+
+def test_plan_render_spans():
+    fps = 24
+    timeline_layout = [
+        {'start_time': 0, 'duration': 1, 'has_image': True, 'movement': None, 'fadeout_duration': 0.5},
+        {'start_time': 1, 'duration': 2, 'has_image': True, 'movement': None, 'fadeout_duration': 0},
+        {'start_time': 3, 'duration': 1, 'has_image': True, 'movement': {'type': 'zoom'}, 'fadeout_duration': 0},
+        {'start_time': 4, 'duration': 1.01, 'has_image': False, 'movement': None, 'fadeout_duration': 0},
+    ]
+    subtitle_cues = [((1, 2.02), 'a'), ((2.02, 3), 'b')]
+    spans = plan_render_spans(timeline_layout, subtitle_cues, 5.01, fps)
+    assert [(span.start_frame, span.end_frame, span.is_static) for span in spans] == [
+        (0, 12, True), (12, 24, False), (24, 49, True), (49, 72, True), (72, 96, False), (96, 121, True)
+    ], spans
+    assert plan_render_spans(timeline_layout, subtitle_cues, 5.01, fps, has_dynamic_background=True)[0].n_frames == 121
+    print('test_plan_render_spans passed')
+
+def test_plan_segments():
+    import numpy as np
+    fps = 24
+    durations = [1, 2.01, 0.02, 1.5, 3, 0.5]
+    timeline_layout = []
+    start_time = 0
+    for duration in durations:
+        timeline_layout.append({'start_time': start_time, 'duration': duration})
+        start_time += duration
+    segments = plan_segments(timeline_layout, start_time, fps, 3)
+    assert [(segment['clip_start'], segment['clip_end']) for segment in segments] == [(0, 2), (2, 4), (4, 6)], segments
+    # the segments tile the frames of the episode
+    assert segments[0]['start_frame'] == 0 and segments[-1]['end_frame'] == first_frame_at(start_time, fps)
+    assert all(a['end_frame'] == b['start_frame'] for a, b in zip(segments[:-1], segments[1:]))
+    # the third clip is shorter than a frame and joins the second segment
+    assert len(plan_segments(timeline_layout, start_time, fps, 100)) == 5
+    assert [(segment['clip_start'], segment['clip_end']) for segment in plan_fixed_segments(timeline_layout, start_time, fps, 4)] == [(0, 4), (4, 6)]
+    # a clip starting a rounding error past frame 95 shows from it on, on a segment's clock and at the times of moviepy's writer
+    assert -1 / 25 < frame_boundary(3.8000000000000003, 25, 95) < 0
+    assert 94 / 25 < frame_boundary(3.8000000000000003, 25) < np.arange(0, 4, 1 / 25)[95]
+    assert frame_cues([((0, 1.0), 'a'), ((1.0, 3.8000000000000003), 'b'), ((3.8000000000000003, 5), 'c')], 25, 25, 95) == \
+        [((-0.5 / 25, 69.5 / 25), 'b')]
+    print('test_plan_segments passed')
+
+if __name__ == '__main__':
+    test_plan_render_spans()
+    test_plan_segments()
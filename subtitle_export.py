@@ -0,0 +1,147 @@
+import os
+from PIL import ImageColor, ImageFont
+from ffmpeg_utils import escape_filter_value
+from subtitle_renderer import MISSING_GLYPHS_HINT, find_font_file, missing_characters
+
+SUBTITLE_FORMATS = ('srt', 'ass')
+
+
+def format_srt_time(seconds):
+    milliseconds = int(round(max(seconds, 0) * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}'
+
+
+def format_ass_time(seconds):
+    centiseconds = int(round(max(seconds, 0) * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f'{hours:d}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}'
+
+
+def ass_color(color, default=(255, 255, 255)):
+    '''&HAABBGGRR of a PIL color name or hex string, fully opaque.'''
+    red, green, blue = ImageColor.getrgb(color)[:3] if color else default
+    return f'&H00{blue:02X}{green:02X}{red:02X}'
+
+
+def write_srt(cues, path):
+    '''Writes the cues, ((start_time, end_time), text) as built by VideoCrafter.get_subtitle_cues, as SubRip.'''
+    with open(path, 'w', encoding='utf-8') as f:
+        for cue_index, ((start_time, end_time), text) in enumerate(cues, 1):
+            f.write(f'{cue_index}\n{format_srt_time(start_time)} --> {format_srt_time(end_time)}\n{text}\n\n')
+
+
+def resolve_ass_font(font=None, text=''):
+    '''
+    Returns (family name, bold, size ratio, font directory) of the font the Pillow renderer would use for text, the directory
+    is None if not found. Pillow sizes a font by its em, libass by its ascent + descent, an ASS Fontsize is the fontsize times the ratio.
+    Warns if the font has no glyph for some characters of text, libass draws them as boxes.
+    '''
+    font_file = find_font_file(font, text) or find_font_file(font)
+    if font_file is None:
+        print(f"WARNING: no font file found for {font or 'the subtitles'}, libass picks a system font: {MISSING_GLYPHS_HINT}")
+        return 'Sans', False, 1.0, None
+    measured_font = ImageFont.truetype(font_file, 100)
+    missing = missing_characters(measured_font, text)
+    if missing:
+        print(f"WARNING: {os.path.basename(font_file)} has no glyph for {''.join(missing[:20])!r} of the subtitles, "
+              f"they render as boxes: {MISSING_GLYPHS_HINT}")
+    family, style = measured_font.getname()
+    return family, 'bold' in (style or '').lower(), sum(measured_font.getmetrics()) / 100, os.path.dirname(font_file)
+
+
+def write_ass(cues, path, subtitle_config, width, height, y_position='bottom'):
+    '''
+    Writes the cues as an ASS script styled like the Pillow renderer: font, fontsize (pixels of a width x height video),
+    color, stroke_color and stroke_width, background_color as an opaque box, and the cue's top at y_position pixels
+    ('top', 'center' and 'bottom' are also accepted). Returns the font directory for libass, or None.
+    '''
+    family, bold, size_ratio, font_dir = resolve_ass_font(subtitle_config.get('font'), ''.join(text for _, text in cues))
+    if isinstance(y_position, (int, float)) and not isinstance(y_position, bool):
+        alignment, margin_v = 8, int(round(y_position))
+    else:
+        alignment, margin_v = {'top': (8, 0), 'center': (5, 0)}.get(y_position, (2, 0))
+    background_color = subtitle_config.get('background_color')
+    if background_color:
+        # an opaque box drawn in the outline color, a stroke cannot be drawn around the text then
+        border_style, outline_color, outline = 3, ass_color(background_color), max(subtitle_config.get('stroke_width', 0), 1)
+    else:
+        border_style, outline_color = 1, ass_color(subtitle_config.get('stroke_color'), (0, 0, 0))
+        outline = subtitle_config.get('stroke_width', 0) if subtitle_config.get('stroke_color') else 0
+    style = ','.join(str(value) for value in [
+        'Default', family, int(round(subtitle_config.get('fontsize', 50) * size_ratio)), ass_color(subtitle_config.get('color', 'white')), '&H000000FF',
+        outline_color, '&H00000000', -1 if bold else 0, 0, 0, 0, 100, 100, 0, 0, border_style, outline, 0, alignment, 0, 0, margin_v, 1])
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[Script Info]\nScriptType: v4.00+\n'
+                f'PlayResX: {width}\nPlayResY: {height}\n'
+                # the cues are already split to fit, libass must not wrap them again
+                'WrapStyle: 2\nScaledBorderAndShadow: yes\n\n'
+                '[V4+ Styles]\n'
+                'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, '
+                'StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n'
+                f'Style: {style}\n\n'
+                '[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n')
+        for (start_time, end_time), text in cues:
+            text = text.replace('\\', '\\\\').replace('{', '\\{').replace('}', '\\}').replace('\n', '\\N')
+            f.write(f'Dialogue: 0,{format_ass_time(start_time)},{format_ass_time(end_time)},Default,,0,0,0,,{text}\n')
+    return font_dir
+
+
+def shift_cues(cues, time_offset, duration=None):
+    '''The cues overlapping [time_offset, time_offset + duration) on the clock of a video starting at time_offset.'''
+    end_time_limit = float('inf') if duration is None else time_offset + duration
+    return [((max(start_time - time_offset, 0), end_time - time_offset), text)
+            for (start_time, end_time), text in cues if end_time > time_offset and start_time < end_time_limit]
+
+
+def build_subtitles_filter(ass_path, font_dir=None):
+    '''
+    The ffmpeg video filter burning the ASS script in with libass, timed by the frame timestamps of the encoded video.
+    A video starting later in the episode (a segment, a span) gets a script of cues shifted with shift_cues,
+    shifting the timestamps instead would lose the frame rate of the stream.
+    '''
+    subtitles_filter = f'subtitles=filename={escape_filter_value(ass_path)}'
+    if font_dir:
+        subtitles_filter += f':fontsdir={escape_filter_value(font_dir)}'
+    return subtitles_filter
+
+
+def test_subtitle_export():
+    '''SRT/ASS text and timing, and a libass burn-in of shifted cues draws each cue on its frames only.'''
+    import tempfile
+    import numpy as np
+    from ffmpeg_utils import iter_video_frames, run_ffmpeg
+    cues = [((0, 0.5), 'Hello 你好'), ((1.5, 3.004), '{second} cue'), ((3661.2, 3662), 'late')]
+    assert format_srt_time(3661.2) == '01:01:01,200' and format_ass_time(3661.2) == '1:01:01.20'
+    assert ass_color('#102030') == '&H00302010'
+    with tempfile.TemporaryDirectory(prefix="sub's dir, [x]") as temp_dir:
+        srt_path = os.path.join(temp_dir, 'cues.srt')
+        write_srt(cues, srt_path)
+        with open(srt_path, encoding='utf-8') as f:
+            assert f.read().startswith('1\n00:00:00,000 --> 00:00:00,500\nHello 你好\n\n2\n00:00:01,500 --> 00:00:03,004\n')
+        ass_path = os.path.join(temp_dir, 'cues.ass')
+        font_dir = write_ass(cues, ass_path, {'fontsize': 40, 'background_color': 'black'}, 320, 180, y_position=100)
+        with open(ass_path, encoding='utf-8') as f:
+            ass_text = f.read()
+        assert 'Dialogue: 0,0:00:01.50,0:00:03.00,Default,,0,0,0,,\\{second\\} cue' in ass_text and ',8,0,0,100,1\n' in ass_text
+
+        # one second of white frames from the second 1 of the episode, between the cues, then the second cue (a black box)
+        shifted_cues = shift_cues(cues, 1.0, 1.0)
+        assert shifted_cues == [((0.5, 2.004), '{second} cue')]
+        font_dir = write_ass(shifted_cues, ass_path, {'fontsize': 40, 'background_color': 'black'}, 320, 180, y_position=100)
+        video_path = os.path.join(temp_dir, 'burnt.mp4')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'color=c=white:size=320x180:rate=10:duration=1', '-vf', build_subtitles_filter(ass_path, font_dir),
+                    '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', video_path])
+        frames = list(iter_video_frames(video_path, (320, 180), 10))
+        assert len(frames) == 10
+        assert all(frame.min() > 200 for frame in frames[:4])
+        assert all(frame[100:140].min() < 50 and frame[:95].min() > 200 for frame in frames[6:])
+        assert np.abs(frames[6].astype(int) - frames[9]).mean() < 2
+    print('test_subtitle_export passed')
+
+if __name__ == '__main__':
+    test_subtitle_export()
@@ -0,0 +1,247 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from timeline import IntervalIndex
+
+DEFAULT_FONT = 'Microsoft-YaHei-Bold-&-Microsoft-YaHei-UI-Bold'
+
+# ImageMagick font names used in our configs -> font files, CJK fallbacks come last
+FONT_FILE_CANDIDATES = {
+    'Microsoft-YaHei-Bold-&-Microsoft-YaHei-UI-Bold': ['msyhbd.ttc', 'msyhbd.ttf'],
+    'Microsoft-YaHei-&-Microsoft-YaHei-UI': ['msyh.ttc', 'msyh.ttf'],
+    'SimHei': ['simhei.ttf'],
+    'KaiTi': ['simkai.ttf'],
+}
+FALLBACK_FONT_FILES = ['NotoSansCJK-Bold.ttc', 'NotoSansCJKsc-Bold.otf', 'NotoSansCJK-Regular.ttc', 'wqy-microhei.ttc',
+                       'wqy-zenhei.ttc', 'DroidSansFallbackFull.ttf', 'DejaVuSans-Bold.ttf']
+# the subtitles of our episodes are Chinese, the font chosen before the cues are known must have these glyphs
+DEFAULT_COVERAGE_TEXT = '字幕，'
+MISSING_GLYPHS_HINT = 'install a CJK font (Noto Sans CJK, WenQuanYi) or set the font of subtitle_config to a font file that has them'
+FONT_DIRS = [
+    os.path.join(os.environ.get('WINDIR', r'C:\Windows'), 'Fonts'),
+    os.path.join(os.path.expanduser('~'), '.fonts'),
+    os.path.join(os.path.expanduser('~'), '.local', 'share', 'fonts'),
+    '/usr/share/fonts',
+    '/usr/local/share/fonts',
+    '/System/Library/Fonts',
+    '/Library/Fonts',
+]
+
+_font_file_index = None
+_coverage_fonts = {}
+
+
+def missing_characters(font, text):
+    '''
+    The characters of text the Pillow font has no glyph for, in order. Pillow exposes no cmap, a character without
+    a glyph is recognized by rendering as the .notdef glyph, like a code point no font maps.
+    '''
+    notdef = _glyph_signature(font, '\U0010FFFF')
+    return [char for char in dict.fromkeys(text) if not char.isspace() and _glyph_signature(font, char) == notdef]
+
+
+def _glyph_signature(font, char):
+    mask = font.getmask(char)
+    return mask.size, bytes(mask)
+
+
+def _covers(font_file, text):
+    if not text:
+        return True
+    if font_file not in _coverage_fonts:
+        _coverage_fonts[font_file] = ImageFont.truetype(font_file, 32)
+    return not missing_characters(_coverage_fonts[font_file], text)
+
+
+def find_font_file(font=None, text=''):
+    '''
+    font is a font file path or an ImageMagick font name, returns a font file path or None.
+    A font file found by name, the fallbacks included, is only used if it has a glyph for every character of text.
+    '''
+    global _font_file_index
+    font = font or DEFAULT_FONT
+    if os.path.isfile(font):
+        return font
+    if _font_file_index is None:
+        _font_file_index = {}
+        for font_dir in FONT_DIRS:
+            for root, _, files in os.walk(font_dir):
+                for name in files:
+                    _font_file_index.setdefault(name.lower(), os.path.join(root, name))
+    for file_name in FONT_FILE_CANDIDATES.get(font, [font + '.ttf', font + '.ttc', font + '.otf']) + FALLBACK_FONT_FILES:
+        if file_name.lower() in _font_file_index and _covers(_font_file_index[file_name.lower()], text):
+            return _font_file_index[file_name.lower()]
+    return None
+
+
+class SubtitleRasterizer:
+    '''
+    Rasterizes subtitle cues in-process with Pillow/FreeType, as RGBA arrays cached by (text, style) with an LRU bound.
+    Supports the font, fontsize, color, stroke_color, stroke_width and background_color options of subtitle_config.
+    A cue with characters the font has no glyph for is drawn with a fallback font that has them, if none has them
+    a warning names the characters, which render as boxes.
+    '''
+    def __init__(self, font=None, fontsize=50, color='white', stroke_color=None, stroke_width=0, background_color=None, max_cached_cues=256):
+        self.style = (font, fontsize, color, stroke_color, stroke_width, background_color)
+        self.font_name = font
+        self.fontsize = fontsize
+        font_file = find_font_file(font, DEFAULT_COVERAGE_TEXT) or find_font_file(font)
+        if font_file is None:
+            raise ValueError(f"No font file found for {font or DEFAULT_FONT}, {MISSING_GLYPHS_HINT}")
+        self.font = ImageFont.truetype(font_file, fontsize)
+        self.font_file = font_file
+        # font file -> font at fontsize, characters -> the font drawing them
+        self._fonts = {font_file: self.font}
+        self._char_fonts = {}
+        self._warned_missing_glyphs = False
+        self.color = ImageColor.getrgb(color) if color else (255, 255, 255)
+        self.stroke_color = ImageColor.getrgb(stroke_color) if stroke_color else None
+        self.stroke_width = stroke_width if stroke_color else 0
+        self.background_color = ImageColor.getrgb(background_color) if background_color else None
+        self.max_cached_cues = max_cached_cues
+        self._cache = OrderedDict()
+
+    @classmethod
+    def from_subtitle_config(cls, subtitle_config, scale=1.0):
+        return cls(font=subtitle_config.get('font'),
+                   fontsize=max(int(round(subtitle_config.get('fontsize', 50) * scale)), 1),
+                   color=subtitle_config.get('color', 'white'),
+                   stroke_color=subtitle_config.get('stroke_color', None),
+                   stroke_width=int(round(subtitle_config.get('stroke_width', 0) * scale)),
+                   background_color=subtitle_config.get('background_color', None))
+
+    def font_for(self, text):
+        '''The font drawing text: the rasterizer's font, or the first font file that has a glyph for every character.'''
+        chars = ''.join(sorted(set(text)))
+        if chars not in self._char_fonts:
+            missing = missing_characters(self.font, text)
+            font_file = self.font_file if not missing else find_font_file(self.font_name, text)
+            if font_file is None:
+                if not self._warned_missing_glyphs:
+                    # once, every cue of a Chinese episode would warn
+                    print(f"WARNING: no font has a glyph for {''.join(missing)!r} of the subtitle {text!r}, these and the characters "
+                          f"of later subtitles missing from {os.path.basename(self.font_file)} render as boxes: {MISSING_GLYPHS_HINT}")
+                    self._warned_missing_glyphs = True
+                font_file = self.font_file
+            if font_file not in self._fonts:
+                self._fonts[font_file] = ImageFont.truetype(font_file, self.fontsize)
+            self._char_fonts[chars] = self._fonts[font_file]
+        return self._char_fonts[chars]
+
+    def render(self, text):
+        '''Returns an (h, w, 4) uint8 RGBA array of text.'''
+        cache_key = (text, self.style)
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            return self._cache[cache_key]
+        font = self.font_for(text)
+        draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font, stroke_width=self.stroke_width)
+        # keep the font's ascent/descent so lines with and without descenders have the same height, like ImageMagick labels
+        ascent, descent = font.getmetrics()
+        top = min(top, 0) - self.stroke_width
+        bottom = max(bottom, ascent + descent) + self.stroke_width
+        width, height = max(right - left, 1), max(bottom - top, 1)
+        background = self.background_color + (255,) if self.background_color else (0, 0, 0, 0)
+        image = Image.new('RGBA', (width, height), background)
+        ImageDraw.Draw(image).text((-left, -top), text, font=font, fill=self.color + (255,),
+                                   stroke_width=self.stroke_width, stroke_fill=self.stroke_color + (255,) if self.stroke_color else None)
+        rgba = np.array(image)
+        self._cache[cache_key] = rgba
+        if len(self._cache) > self.max_cached_cues:
+            self._cache.popitem(last=False)
+        return rgba
+
+
+class SubtitleTrack:
+    '''
+    The subtitle cues of an episode, ((start_time, end_time), text) as built by VideoCrafter.get_subtitle_cues.
+    blit_on only blends the bounding box of the active cue, the rest of the frame is untouched.
+    position follows moviepy: (x, y) with 'center', 'left', 'right', 'top', 'bottom' or pixels.
+    '''
+    def __init__(self, cues, rasterizer, position=('center', 'bottom')):
+        self.cues = cues
+        self.rasterizer = rasterizer
+        self.position = position
+        self.cue_index = IntervalIndex([(start_time, end_time, text) for (start_time, end_time), text in cues])
+
+    def _resolve_position(self, frame_size, cue_size):
+        (frame_width, frame_height), (cue_width, cue_height) = frame_size, cue_size
+        x, y = self.position
+        x = {'left': 0, 'center': (frame_width - cue_width) / 2, 'right': frame_width - cue_width}.get(x, x)
+        y = {'top': 0, 'center': (frame_height - cue_height) / 2, 'bottom': frame_height - cue_height}.get(y, y)
+        return int(x), int(y)
+
+    def blit_on(self, frame, t):
+        texts = self.cue_index.query(t)
+        if not texts:
+            return frame
+        # the reader may hand out its own buffer, never blend into it
+        frame = np.array(frame, dtype=np.uint8)
+        frame_height, frame_width = frame.shape[:2]
+        for text in texts:
+            rgba = self.rasterizer.render(text)
+            x, y = self._resolve_position((frame_width, frame_height), (rgba.shape[1], rgba.shape[0]))
+            # clip the cue to the frame
+            left, top = max(x, 0), max(y, 0)
+            right, bottom = min(x + rgba.shape[1], frame_width), min(y + rgba.shape[0], frame_height)
+            if right <= left or bottom <= top:
+                continue
+            cue = rgba[top - y:bottom - y, left - x:right - x]
+            alpha = cue[:, :, 3:4].astype(np.float32) / 255
+            region = frame[top:bottom, left:right].astype(np.float32)
+            frame[top:bottom, left:right] = (cue[:, :, :3] * alpha + region * (1 - alpha)).astype(np.uint8)
+        return frame
+
+    def apply_to(self, video_clip):
+        '''Returns video_clip with the subtitles burnt in, audio and duration are kept.'''
+        return video_clip.fl(lambda get_frame, t: self.blit_on(get_frame(t), t))
+
+
+def test_SubtitleTrack():
+    rasterizer = SubtitleRasterizer(fontsize=30, background_color='black', max_cached_cues=2)
+    track = SubtitleTrack([((0, 1), 'Hello 你好'), ((1, 2.5), 'second cue')], rasterizer, position=('center', 50))
+    frame = np.full((120, 320, 3), 255, dtype=np.uint8)
+    frame.setflags(write=False)
+    out = track.blit_on(frame, 0.5)
+    rgba = rasterizer.render('Hello 你好')
+    x, _ = track._resolve_position((320, 120), (rgba.shape[1], rgba.shape[0]))
+    # only the cue's bounding box changes, with a black background box
+    assert (out[:50] == 255).all() and (out[50 + rgba.shape[0]:] == 255).all()
+    assert (out[50:50 + rgba.shape[0], :x] == 255).all()
+    assert out[50, x].tolist() == [0, 0, 0]
+    assert track.blit_on(frame, 3) is frame
+    assert rasterizer.render('Hello 你好') is rgba
+    rasterizer.render('second cue')
+    rasterizer.render('third')
+    assert ('Hello 你好', rasterizer.style) not in rasterizer._cache
+    print('test_SubtitleTrack passed')
+
+
+def test_font_coverage():
+    '''A font is only used for a cue if it has its glyphs, the font size is honored whichever font draws the cue.'''
+    latin_font_file = find_font_file('DejaVuSans-Bold')
+    if latin_font_file is None:
+        print('test_font_coverage skipped, DejaVuSans-Bold.ttf is not installed')
+        return
+    latin_font = ImageFont.truetype(latin_font_file, 30)
+    assert missing_characters(latin_font, 'Hello 你好，') == ['你', '好', '，'] and missing_characters(latin_font, 'Hello') == []
+    assert find_font_file('DejaVuSans-Bold', 'Hello') == latin_font_file
+    # DejaVu is never picked for Chinese, either a CJK font is or nothing is
+    cjk_font_file = find_font_file(None, '你好')
+    assert cjk_font_file != latin_font_file
+    assert cjk_font_file is None or not missing_characters(ImageFont.truetype(cjk_font_file, 30), '你好')
+    for fontsize in (20, 40):
+        rasterizer = SubtitleRasterizer(latin_font_file, fontsize=fontsize)
+        assert rasterizer.font_for('Hello') is rasterizer.font and rasterizer.font.size == fontsize
+        assert rasterizer.font_for('你好').size == fontsize
+        assert (rasterizer.font_for('你好') is rasterizer.font) == (cjk_font_file is None)
+    assert SubtitleRasterizer(latin_font_file, fontsize=40).render('Hello').shape[0] > SubtitleRasterizer(latin_font_file, fontsize=20).render('Hello').shape[0] * 1.5
+    # an unknown font falls back to an installed font file, never to Pillow's bitmap font that ignores the size
+    assert SubtitleRasterizer('No-Such-Font', fontsize=40).font.size == 40
+    print('test_font_coverage passed')
+
+if __name__ == '__main__':
+    test_SubtitleTrack()
+    # test_font_coverage()
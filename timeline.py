@@ -0,0 +1,129 @@
+from bisect import bisect_right
+from moviepy.video.VideoClip import VideoClip
+
+
+class IntervalIndex:
+    '''
+    A static interval index over half-open [start, end) intervals.
+    The sorted interval boundaries split the timeline into elementary spans and every span stores
+    the items covering it, in insertion order, so a query is one bisect plus the k active items.
+    '''
+    def __init__(self, intervals):
+        '''intervals is a list of (start, end, item).'''
+        self.boundaries = sorted(set([start for start, _, _ in intervals] + [end for _, end, _ in intervals]))
+        self.active_items = [[] for _ in range(max(len(self.boundaries) - 1, 0))]
+        for start, end, item in intervals:
+            if end <= start:
+                continue
+            first_span = bisect_right(self.boundaries, start) - 1
+            last_span = bisect_right(self.boundaries, end) - 1
+            for span_index in range(first_span, last_span):
+                self.active_items[span_index].append(item)
+
+    def query(self, t):
+        span_index = bisect_right(self.boundaries, t) - 1
+        if 0 <= span_index < len(self.active_items):
+            return self.active_items[span_index]
+        return []
+
+    def spans(self):
+        '''Yields (start, end, items) for every elementary span.'''
+        for span_index, items in enumerate(self.active_items):
+            yield self.boundaries[span_index], self.boundaries[span_index + 1], items
+
+
+class ClipRecord:
+    '''
+    The timeline facts of one clip: where it sits, its asset refs and flags, no media. A 500 clip episode is 500 of
+    these, the clips themselves are opened through a media_pool.MediaPool when the render reaches them.
+    It reads like a layout dict (record['duration']), for the render planner and the subtitle cues.
+    '''
+    LAYOUT_FIELDS = ('start_time', 'duration', 'subtitle_text', 'has_image', 'movement', 'fadeout_duration')
+    __slots__ = LAYOUT_FIELDS + ('clip_index', 'audio_path', 'key_frame_path')
+
+    def __init__(self, clip_index, start_time, duration, clip_config):
+        self.clip_index = clip_index
+        self.start_time = start_time
+        self.duration = duration
+        self.audio_path = clip_config.get('audio_path') if clip_config.get('audio_path') != -1 else None
+        self.key_frame_path = clip_config.get('key_frame_path') if clip_config.get('key_frame_path') != -1 else None
+        self.subtitle_text = clip_config.get('subtitle_text', '')
+        self.has_image = bool(self.key_frame_path)
+        self.movement = clip_config.get('movement')
+        self.fadeout_duration = clip_config.get('fadeout_duration', 0)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def layout(self):
+        '''The plain dict of VideoCrafter.build_timeline_layout, it can be sent to other processes and hashed.'''
+        return {field: getattr(self, field) for field in self.LAYOUT_FIELDS}
+
+
+class TimelineClip(VideoClip):
+    '''
+    Composes layers over a background with one flat interval index, instead of one nested
+    CompositeVideoClip per layer. Each frame only blits the layers active at that time,
+    so the cost of a frame does not grow with the number of layers in the episode.
+    Layers keep moviepy semantics: start/end, pos, mask, blitted in list order.
+    '''
+    def __init__(self, background, layers):
+        VideoClip.__init__(self)
+        self.background = background
+        self.layers = layers
+        self.layer_index = IntervalIndex([(layer.start, layer.end, layer) for layer in layers if layer.end is not None])
+        self.size = background.size
+        self.duration = background.duration
+        self.end = background.end
+
+        def make_frame(t):
+            frame = background.get_frame(t)
+            for layer in self.layer_index.query(t):
+                frame = layer.blit_on(frame, t)
+            return frame
+        self.make_frame = make_frame
+
+
+def test_IntervalIndex():
+    index = IntervalIndex([(0, 2, 'a'), (1, 3, 'b'), (3, 4, 'c'), (5, 5, 'empty')])
+    assert index.query(-1) == []
+    assert index.query(0) == ['a']
+    assert index.query(1.5) == ['a', 'b']
+    assert index.query(2) == ['b']
+    assert index.query(3) == ['c']
+    assert index.query(4) == []
+    print('test_IntervalIndex passed')
+
+def test_TimelineClip():
+    '''The flat timeline must produce the same frames as the nested CompositeVideoClip it replaces.'''
+    import numpy as np
+    from moviepy.editor import ColorClip, CompositeVideoClip
+    background = ColorClip(size=(64, 36), color=(255, 255, 255)).set_duration(3)
+    layers = [
+        ColorClip(size=(20, 10), color=(255, 0, 0)).set_duration(1.5).set_start(0).set_position(('center', 'center')).crossfadeout(0.5),
+        ColorClip(size=(30, 10), color=(0, 255, 0)).set_duration(1).set_start(1).set_position((5, 5)),
+    ]
+    nested = background
+    for layer in layers:
+        nested = CompositeVideoClip([nested, layer])
+    flat = TimelineClip(background, layers)
+    for t in np.arange(0, 3, 1 / 24):
+        assert np.array_equal(nested.get_frame(t).astype('uint8'), flat.get_frame(t).astype('uint8')), t
+    print('test_TimelineClip passed')
+
+def test_ClipRecord():
+    record = ClipRecord(3, 1.5, 2.0, {'audio_path': -1, 'key_frame_path': 'key.png', 'subtitle_text': 'hi', 'fadeout_duration': 0.5})
+    assert record['start_time'] == 1.5 and record.get('missing', 'default') == 'default' and record.audio_path is None
+    assert record.layout() == {'start_time': 1.5, 'duration': 2.0, 'subtitle_text': 'hi', 'has_image': True, 'movement': None, 'fadeout_duration': 0.5}
+    assert not hasattr(record, '__dict__')
+    print('test_ClipRecord passed')
+
+if __name__ == '__main__':
+    test_IntervalIndex()
+    test_TimelineClip()
+    test_ClipRecord()
@@ -12,9 +12,35 @@ import time
 import re
 import math
 import numpy
-
-# Specify the path to the ImageMagick binary
-change_settings({"IMAGEMAGICK_BINARY": r"C:\Program Files\ImageMagick-7.1.1-Q16-HDRI\magick.exe"})
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from asset_cache import AssetCache
+from ffmpeg_utils import run_ffmpeg, build_atempo_filter, decode_audio, probe_duration
+from time_stretch import stretch_audio_file, wsola_time_stretch
+from timeline import TimelineClip, ClipRecord
+from media_pool import MediaPool, LazyAudioClip, LazyLayer, DEFAULT_MAX_OPEN_CLIPS
+from render_planner import frame_boundary, frame_cues, plan_render_spans, plan_segments, plan_fixed_segments
+from parallel_render import can_render_in_parallel
+from subtitle_renderer import SubtitleRasterizer, SubtitleTrack
+from ken_burns import make_zoom_clip, make_pan_position
+from ffmpeg_utils import encode_still, write_frames, concat_videos, mux_audio, encode_audio, add_subtitle_track
+from subtitle_export import SUBTITLE_FORMATS, write_srt, write_ass, shift_cues, build_subtitles_filter
+from audio_mixer import AudioMixer
+from pcm_cache import PcmCache
+from loudness import LoudnessNormalizer
+from background_store import BackgroundStore
+from encoder_backends import EncoderBackend, log_render_speed
+from render_metrics import RenderMetrics, JsonReportHook
+from native_render import NativeRenderer
+import tempfile
+import json
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+RENDER_BACKENDS = ('moviepy', 'native')
+
+# Specify the path to the ImageMagick binary, only the 'imagemagick' subtitle renderer needs it
+IMAGEMAGICK_BINARY = r"C:\Program Files\ImageMagick-7.1.1-Q16-HDRI\magick.exe"
+if os.path.exists(IMAGEMAGICK_BINARY):
+    change_settings({"IMAGEMAGICK_BINARY": IMAGEMAGICK_BINARY})
 
 def zoom_effect(clip, zoom_ratio_per_second=0.04, zoom_type='in'):
     def effect(get_frame, t):
@@ -63,15 +89,54 @@ class VideoCrafter():
     bgm_path:
     background_video_path: # could be image or video or none
     output_path: 
+    cache_dir: # shared asset cache for resized images and stretched audios, default ~/.cache/aipodcast
+    cache_max_bytes: # the budget AssetCache.evict() trims the cache to at the end of every create(), entries in use or touched in the last hour are kept, default 10 GiB
+    stretch_workers: # ffmpeg processes time-stretching audios at once, default the number of cores
+    fps: # default 24
+    plan_static_spans: # if True, spans whose frame never changes are encoded from one still, create_video_fast only
+    render_workers: # processes composing frames in parallel, default 1 (in the writing process), needs fork (not on Windows)
+    render_backend: # 'moviepy' (default) or 'native', the fast mode compiled into one ffmpeg filtergraph (see native_render.NativeRenderer), configs it cannot express fall back to moviepy
+    native_max_sources: # media files the native backend opens at once, default 500, more fall back to moviepy
+    segments: # if > 1, the episode is split at clip boundaries into this many segments rendered in separate processes
+    segment_workers: # processes rendering segments, default the number of cores
+    encoder_profile: # 'speed', 'balanced' (default, nvenc else x264 veryfast), 'size' or a profile name of encoder_backends.ENCODER_PROFILES
+    encoder_threads: # default 8
+    incremental: # if True, segments of segment_clips clips are kept in <output>_segments and reused while their clips are unchanged
+    segment_clips: # clips per segment of an incremental render, default 20
+    time_stretch_engine: # 'ffmpeg' (default) stretches to a cached mp3 with atempo, 'numpy' stretches the decoded audio in memory
+    audio_engine: # 'numpy' (default) mixes pure-audio episodes sample-accurately in one buffer, 'moviepy' uses the moviepy audio graph
+    pcm_cache: # default True, decoded audio is kept in the asset cache as memory-mapped float32, so no audio file is decoded twice
+    loudness: { # or True for the defaults, every clip is normalized to target_lufs (BS.1770) and the BGM is ducked under the speech, see loudness.LoudnessNormalizer
+        target_lufs: # default -16
+        max_true_peak: # dBTP a clip is never raised above, default -1
+        max_gain_db: # default 20
+        bgm_ducking_db: # default 6, the BGM is normalized to target_lufs and scaled by bgm_volume before ducking
+        ducking_attack: # seconds, default 0.2
+        ducking_release: # seconds, default 0.6
+    }
+    max_open_clips: # clips (audio readers, decoded key frames) the moviepy render keeps open at once, default 8, they are opened when the render reaches them and the least recently used is closed first
+    background_store: # 'video' (default) or 'frames', a background video is decoded once at the render size into a looping asset shared by the episodes (see background_store.BackgroundStore), False reads and resizes the source every frame and holds its last frame past its end
+    background_loop_seconds: # loop length of the stored background, default the whole video ('video') or 10 seconds ('frames')
+    background_loop_crossfade: # seconds crossfading the end of the loop into its start, default 1.0
+    subtitle_export: # sidecar subtitle files written next to the output, a list of 'srt' and 'ass', True for both
+    soft_subtitles: # if True, the cues are also muxed into the output video as a soft subtitle track
+    preview_height: # height of create(preview=True) renders, default 360, the width keeps the aspect ratio
+    preview_fps: # default 12
+    preview_encoder_profile: # default 'x264_ultrafast'
+    metrics_report_path: # JSON report of the per-stage metrics of create, default <output>_report.json, None for no report file
     audio_fadeout_duration: 
     bgm_volume:
     subtitle_config: {
-        font:
+        renderer: # 'pil' (default) rasterizes cues in-process with Pillow, 'imagemagick' uses moviepy TextClip, 'libass' burns an ASS script in while encoding (ffmpeg subtitles filter), no text is composed in Python
+        font: # font file path or ImageMagick font name, default Microsoft-YaHei-Bold
         fontsize:
         color:
+        stroke_color:
+        stroke_width:
+        background_color:
         y_position: 0.9
     }
-    clips: [
+    clips: [ # or a generator of clip dicts, read once
         dict{
             audio_path, # -1 for silence
             audio_speed,
@@ -88,7 +153,8 @@ class VideoCrafter():
         ]
     }
     '''
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
+        '''metrics is a RenderMetrics to record into, e.g. one with a callback hook or a progress callback, or shared with PodcastDataPreparation.'''
         self.height = config.get('height', 1080)
         self.width = config.get('width', 1920)
         self.bgm_path = config.get('bgm_path')
@@ -98,71 +164,309 @@ class VideoCrafter():
         self.bgm_volume = config.get('bgm_volume')
         self.clips_config = config.get('clips', [])
         self.config = config
-        # include audio_clip, image_clip, duration, subtitle_text
+        # clips can be a generator (see PodcastDataPreparation.prepare_data(stream=True)), it is read once by
+        # prepare_stretched_audios, which starts stretching while the rest of the clips are still being produced
+        self._clips_source = None
+        if not isinstance(self.clips_config, list):
+            self._clips_source = iter(self.clips_config)
+            self.clips_config = []
+            self.config = dict(config, clips=self.clips_config)
+        self.fps = config.get('fps', 24)
+        self.render_workers = config.get('render_workers', 1)
+        self.render_backend = config.get('render_backend', 'moviepy')
+        if self.render_backend not in RENDER_BACKENDS:
+            raise ValueError(f"Unknown render_backend {self.render_backend}, use one of {RENDER_BACKENDS}")
+        # probes ffmpeg once per process and falls back to a CPU encoder when the preferred one is missing
+        self.encoder = EncoderBackend.from_config(config)
+        self.video_codec = self.encoder.codec
+        self.video_ffmpeg_params = self.encoder.output_params()
+        self.asset_cache = AssetCache(config.get('cache_dir'), config.get('cache_max_bytes'))
+        self.pcm_cache = PcmCache(self.asset_cache, fps=44100, nchannels=2) if config.get('pcm_cache', True) else None
+        self.loudness = None
+        if config.get('loudness'):
+            loudness_config = config['loudness'] if isinstance(config['loudness'], dict) else {}
+            self.loudness = LoudnessNormalizer.from_config(loudness_config, self.asset_cache, self.pcm_cache)
+        self.background_store = None
+        if config.get('background_store', 'video'):
+            self.background_store = BackgroundStore(self.asset_cache, (self.width, self.height), self.fps, config.get('background_store', 'video'),
+                                                    config.get('background_loop_seconds'), config.get('background_loop_crossfade', 1.0))
+        # (audio_path, audio_speed) -> stretched audio path, filled by prepare_stretched_audios
+        self.stretched_audio_paths = None
+        # the ClipRecord of every clip of the last moviepy build, see build_clip_records
         self.clips_info_dicts = []
+        # the audio and image clips of a moviepy render are opened through the pool as the render reaches them
+        self.media_pool = MediaPool(config.get('max_open_clips', DEFAULT_MAX_OPEN_CLIPS))
+        # the subtitle cues of the whole episode once the timeline is known, and those the encoder burns in (libass renderer)
+        self.subtitle_cues = None
+        self.burn_in_cues = None
+        self._burn_in_position = None
+        if metrics is None:
+            report_path = config.get('metrics_report_path', os.path.splitext(self.output_path)[0] + '_report.json')
+            metrics = RenderMetrics('video_crafter', hooks=[JsonReportHook(report_path)] if report_path else [])
+        self.metrics = metrics
+
+    def prepare_stretched_audios(self):
+        '''Time-stretches every clip with audio_speed != 1.0 up front, with several ffmpeg processes at once.'''
+        if self.stretched_audio_paths is not None:
+            return
+        if self.config.get('time_stretch_engine', 'ffmpeg') == 'numpy':
+            for _ in self._iter_clip_configs():
+                pass
+            self.stretched_audio_paths = {}
+            return
+        with self.metrics.stage('stretch') as stage:
+            self.stretched_audio_paths = batch_change_audio_speed(self._iter_stretch_jobs(), self.asset_cache, self.config.get('stretch_workers'))
+            stage['audios'] = len(self.stretched_audio_paths)
+
+    def _iter_clip_configs(self):
+        '''Yields the clip configs, reading a clips generator into self.clips_config on the way.'''
+        if self._clips_source is None:
+            yield from self.clips_config
+            return
+        for clip_config in self._clips_source:
+            self.clips_config.append(clip_config)
+            yield clip_config
+        self._clips_source = None
 
-    def _create_final_audio(self):
-        cur_start_time = 0
-        for clip_config in self.clips_config:
-            cur_clip_info_dict = {}
-            cur_clip_info_dict['audio_clip'] = self.create_audio_clip(clip_config)
-            cur_clip_info_dict['image_clip'] = self.create_image_clip(clip_config, cur_clip_info_dict['audio_clip'].duration)
-            cur_clip_info_dict['duration'] = cur_clip_info_dict['audio_clip'].duration
-            cur_clip_info_dict['subtitle_text'] = clip_config.get('subtitle_text', '')
-            cur_clip_info_dict['start_time'] = cur_start_time
-            cur_start_time += cur_clip_info_dict['duration']
-            self.clips_info_dicts.append(cur_clip_info_dict)
-
-        total_duration = sum(clip_info_dict['duration'] for clip_info_dict in self.clips_info_dicts)
+    def _iter_stretch_jobs(self):
+        for clip_config in self._iter_clip_configs():
+            audio_speed = clip_config.get('audio_speed', 1.0)
+            if clip_config.get('audio_path') and clip_config['audio_path'] != -1 and audio_speed != 1.0:
+                yield clip_config['audio_path'], audio_speed
 
-        audio_clips = [cur_clip_info_dict['audio_clip'] for cur_clip_info_dict in self.clips_info_dicts]
-        concatenated_audio = concatenate_audioclips(audio_clips)
+    def _create_final_audio(self):
+        self.prepare_stretched_audios()
+        self.clips_info_dicts = self.build_clip_records()
+        total_duration = sum(clip_record.duration for clip_record in self.clips_info_dicts)
+        concatenated_audio = self.create_lazy_audio(self.clips_info_dicts)
 
         if self.bgm_path and self.bgm_path != -1:
-            bgm_clip = AudioFileClip(self.bgm_path).volumex(self.bgm_volume)
-            bgm_clip = bgm_clip.subclip(0, total_duration).audio_fadeout(self.audio_fadeout_duration)
-            final_audio = CompositeAudioClip([concatenated_audio, bgm_clip])
+            final_audio = CompositeAudioClip([concatenated_audio, self.create_bgm_clip(total_duration)])
         else:
             final_audio = concatenated_audio
 
         return final_audio
+
+    def create_lazy_audio(self, clip_records):
+        '''The audio of the clips concatenated, the audio of a clip is opened through the media pool when it is played.'''
+        return concatenate_audioclips([
+            LazyAudioClip(self.media_pool, ('audio', clip_record.clip_index), clip_record.duration,
+                          self._timed_opener(clip_record, 'audio',
+                                             lambda clip_config=self.clips_config[clip_record.clip_index]: self.create_audio_clip(clip_config)))
+            for clip_record in clip_records])
+
+    def create_lazy_layer(self, clip_record, start_frame=0):
+        '''
+        The image layer of a clip for TimelineClip, on the clock of a video starting at frame start_frame, opened through the media pool.
+        The layer shows on the frames of the clip's first_frame_at span, in a segment as in the whole episode.
+        '''
+        start_time = clip_record.start_time - start_frame / self.fps
+        return LazyLayer(self.media_pool, ('image', clip_record.clip_index, start_time),
+                         frame_boundary(clip_record.start_time, self.fps, start_frame),
+                         frame_boundary(clip_record.start_time + clip_record.duration, self.fps, start_frame),
+                         self._timed_opener(clip_record, 'image', lambda: self.create_image_clip(self.clips_config[clip_record.clip_index],
+                                                                                                  clip_record.duration).set_start(start_time)))
+
+    def _timed_opener(self, clip_record, media, opener):
+        '''opener, recording how long opening the audio or image of the clip took in the slowest clips of the metrics.'''
+        def open_clip():
+            time_start = time.perf_counter()
+            clip = opener()
+            self.metrics.record_clip(clip_record.clip_index, time.perf_counter() - time_start, media=media,
+                                     audio_path=clip_record.audio_path, key_frame_path=clip_record.key_frame_path)
+            return clip
+        return open_clip
+
+    def create_bgm_clip(self, total_duration):
+        '''The BGM under the clips of clips_info_dicts, with the loudness stage normalized and ducked under their audio.'''
+        bgm_clip = self.load_audio_clip(self.bgm_path)
+        if self.loudness is None:
+            bgm_clip = bgm_clip.volumex(self.bgm_volume)
+        else:
+            bgm_clip = bgm_clip.volumex(self.loudness.bgm_gain(self.bgm_path, self.bgm_volume))
+        bgm_clip = bgm_clip.subclip(0, total_duration).audio_fadeout(self.audio_fadeout_duration)
+        if self.loudness is None:
+            return bgm_clip
+        # the clip audio without its pause, like the spans AudioMixer ducks under
+        speech_spans = [(clip_record.start_time, clip_record.start_time + clip_record.duration
+                         - int(self.clips_config[clip_record.clip_index].get('transition_pause_time', 0) * 44100) / 44100)
+                        for clip_record in self.clips_info_dicts if clip_record.audio_path]
+
+        def duck(get_frame, t):
+            gains = self.loudness.ducking_gains(np.atleast_1d(t), speech_spans)
+            return get_frame(t) * (gains[:, None] if np.ndim(t) else gains[0])
+        return bgm_clip.fl(duck)
     
-    def create_pure_audio(self):
-        audio_clip = self._create_final_audio()
-        audio_clip.write_audiofile(self.output_path, codec='mp3', fps=44100)
+    def mix_final_audio(self):
+        '''The final audio as a (samples, 2) float32 array at 44100 Hz, mixed by AudioMixer with the timing of _create_final_audio.'''
+        self.prepare_stretched_audios()
+        mixer_clips = [self.make_mixer_clip(clip_config) for clip_config in self.clips_config]
+        mixer = AudioMixer(fps=44100, nchannels=2, pcm_cache=self.pcm_cache, loudness=self.loudness)
+        bgm_path = self.bgm_path if self.bgm_path and self.bgm_path != -1 else None
+        with self.metrics.stage('audio_mix', clips=len(mixer_clips)):
+            return mixer.mix(mixer_clips, bgm_path, self.bgm_volume, self.audio_fadeout_duration)
+
+    def make_mixer_clip(self, clip_config):
+        '''The AudioMixer clip of a clip config, time-stretching it with ffmpeg first unless it was already.'''
+        audio_speed = clip_config.get('audio_speed', 1.0)
+        transition_pause_time = clip_config.get('transition_pause_time', 0)
+        if not clip_config.get('audio_path') or clip_config['audio_path'] == -1:
+            return {'audio_path': None, 'duration': clip_config.get('duration', 0), 'pause_duration': transition_pause_time}
+        use_numpy_stretch = self.config.get('time_stretch_engine', 'ffmpeg') == 'numpy'
+        audio_path = clip_config['audio_path']
+        if audio_speed != 1.0 and not use_numpy_stretch:
+            audio_path = (self.stretched_audio_paths or {}).get((audio_path, audio_speed)) or \
+                change_audio_speed_without_pitch(audio_path, audio_speed, cache=self.asset_cache)
+        return {'audio_path': audio_path, 'pause_duration': transition_pause_time,
+                'time_stretch': audio_speed if use_numpy_stretch else 1.0}
 
-    def create(self, use_fast_mode=True):
-        # check if the output_path is a pure audio file
-        if self.output_path.lower().endswith(('.mp3', '.wav', '.m4a')):
-            self.create_pure_audio()
+    def create_pure_audio(self):
+        time_start = time.time()
+        if self.config.get('audio_engine', 'numpy') == 'numpy':
+            final_audio = self.mix_final_audio()
+            with self.metrics.stage('audio_encode'):
+                encode_audio(final_audio, 44100, self.output_path)
         else:
-            if use_fast_mode:
-                self.create_video_fast()
+            audio_clip = self._create_final_audio()
+            try:
+                with self.metrics.stage('audio_write'):
+                    audio_clip.write_audiofile(self.output_path, codec='mp3', fps=44100)
+            finally:
+                self.media_pool.close()
+            self.metrics.set('media_pool', self.media_pool.stats())
+        print(f"Audio written to {self.output_path}, time used: {time.time() - time_start:.2f} seconds")
+
+    def create(self, use_fast_mode=True, preview=False):
+        '''
+        Creates the output, then sends the metrics report to the metrics hooks, also when creating fails.
+        preview renders a quick review copy of a video to <output>_preview.mp4 instead, see create_preview.
+        '''
+        self.metrics.set('output_path', self.output_path)
+        try:
+            # reads a clips generator to the end, stretching as the clips arrive
+            self.prepare_stretched_audios()
+            # check if the output_path is a pure audio file
+            if self.output_path.lower().endswith(('.mp3', '.wav', '.m4a')):
+                self.metrics.set('mode', 'pure_audio')
+                self.create_pure_audio()
+            elif preview:
+                self.metrics.set('mode', 'preview')
+                self.create_preview()
+            elif self.config.get('segments', 0) > 1 or self.config.get('incremental'):
+                self.metrics.set('mode', 'segmented')
+                self.create_video_segmented()
             else:
-                self.create_video()
+                if use_fast_mode and self.render_backend == 'native' and self.create_video_native():
+                    self.metrics.set('mode', 'native')
+                elif use_fast_mode:
+                    self.metrics.set('mode', 'fast')
+                    self.create_video_fast()
+                else:
+                    self.metrics.set('mode', 'classic')
+                    self.create_video()
+            if not self.output_path.lower().endswith(('.mp3', '.wav', '.m4a')) and not preview:
+                self.export_subtitles()
+            self.metrics.set('status', 'succeeded')
+        except BaseException:
+            self.metrics.set('status', 'failed')
+            raise
+        finally:
+            # the keys of this render are pinned, evicting cannot remove what it still reads
+            self.metrics.set('cache_freed_bytes', self.asset_cache.evict())
+            print(f"Asset cache: {self.asset_cache.hits} hits, {self.asset_cache.misses} misses")
+            self.metrics.add('cache_hits', self.asset_cache.hits)
+            self.metrics.add('cache_misses', self.asset_cache.misses)
+            self.metrics.set('clips', len(self.clips_config))
+            self.metrics.finish()
+
+    def get_preview_config(self):
+        '''
+        The config of the preview of this video: preview_height and preview_fps, the fastest encoder, and every size
+        given in pixels (fontsize, stroke, subtitle position, key frame sizes) scaled down with the frame.
+        The clips and their timing are unchanged.
+        '''
+        scale = self.config.get('preview_height', 360) / self.height
+        preview_config = dict(self.config)
+        preview_config.update({
+            'height': int(round(self.height * scale / 2)) * 2,
+            'width': int(round(self.width * scale / 2)) * 2,
+            'fps': self.config.get('preview_fps', 12),
+            'encoder_profile': self.config.get('preview_encoder_profile', 'x264_ultrafast'),
+            'output_path': os.path.splitext(self.output_path)[0] + '_preview.mp4',
+            # the background is scaled down once into the store, not every frame
+            'background_store': self.config.get('background_store', 'video') or 'video',
+        })
+        if self.config.get('subtitle_config'):
+            subtitle_config = dict(self.config['subtitle_config'])
+            for key in ('fontsize', 'stroke_width'):
+                if key in subtitle_config:
+                    subtitle_config[key] = max(int(round(subtitle_config[key] * scale)), 1 if key == 'fontsize' else 0)
+            if isinstance(subtitle_config.get('y_position'), int):
+                subtitle_config['y_position'] = int(round(subtitle_config['y_position'] * scale))
+            preview_config['subtitle_config'] = subtitle_config
+        preview_clips = []
+        for clip_config in self.clips_config:
+            frame_size = clip_config.get('frame_size')
+            if frame_size and frame_size.get('unit', '') != 'ratio':
+                frame_size = {key: int(round(value * scale)) if key in ('width', 'height') and value != -1 else value
+                              for key, value in frame_size.items()}
+                clip_config = dict(clip_config, frame_size=frame_size)
+            preview_clips.append(clip_config)
+        preview_config['clips'] = preview_clips
+        return preview_config
+
+    def create_preview(self):
+        '''
+        Renders the episode at preview size and fps with the fastest encoder, to review it in a fraction of the render time.
+        The timeline, the subtitle cues and the audio mix are resolved here once, exactly as for the final render,
+        and handed to the segmented renderer of the preview config, so cue timing and audio sync carry over to the final.
+        '''
+        time_start = time.time()
+        with self.metrics.stage('layout', clips=len(self.clips_config)):
+            timeline_layout = self.build_timeline_layout()
+        final_audio = self.mix_final_audio()
+        preview_crafter = VideoCrafter(self.get_preview_config(), metrics=self.metrics)
+        preview_crafter.stretched_audio_paths = self.stretched_audio_paths
+        print(f"Rendering a {preview_crafter.width}x{preview_crafter.height} {preview_crafter.fps} fps preview")
+        preview_crafter.create_video_segmented(timeline_layout, final_audio)
+        self.subtitle_cues = preview_crafter.subtitle_cues
+        self.metrics.set('preview_path', preview_crafter.output_path)
+        print(f"Preview saved to {preview_crafter.output_path}, time used: {time.time() - time_start:.2f} seconds")
+        return preview_crafter.output_path
 
     def create_video_fast(self):
         '''This implementation could be two times faster than the create_video method, if there are not many key frames.'''
-        cur_start_time = 0
-        for clip_config in self.clips_config:
-            cur_clip_info_dict = {}
-            cur_clip_info_dict['audio_clip'] = self.create_audio_clip(clip_config)
-            cur_clip_info_dict['image_clip'] = self.create_image_clip(clip_config, cur_clip_info_dict['audio_clip'].duration)
-            cur_clip_info_dict['duration'] = cur_clip_info_dict['audio_clip'].duration
-            cur_clip_info_dict['subtitle_text'] = clip_config.get('subtitle_text', '')
-            cur_clip_info_dict['start_time'] = cur_start_time
-            cur_start_time += cur_clip_info_dict['duration']
-            self.clips_info_dicts.append(cur_clip_info_dict)
-
-        total_duration = sum(clip_info_dict['duration'] for clip_info_dict in self.clips_info_dicts)
-
-        audio_clips = [cur_clip_info_dict['audio_clip'] for cur_clip_info_dict in self.clips_info_dicts]
-        concatenated_audio = concatenate_audioclips(audio_clips)
+        with self.metrics.stage('build', clips=len(self.clips_config)):
+            final_video = self.build_video_fast()
+        try:
+            self._write_video(final_video, timeline_layout=self.clips_info_dicts)
+        finally:
+            self.media_pool.close()
+        self.metrics.set('media_pool', self.media_pool.stats())
+
+    def create_video_native(self):
+        '''
+        Renders the timeline of create_video_fast as one ffmpeg filtergraph, see native_render.NativeRenderer.
+        Returns False without rendering if the config uses a feature the graph cannot express.
+        '''
+        native_renderer = NativeRenderer(self)
+        unsupported_reason = native_renderer.unsupported_reason()
+        if unsupported_reason:
+            print(f"Rendering with moviepy, the native render backend cannot render this config: {unsupported_reason}")
+            return False
+        native_renderer.render()
+        return True
+
+    def build_video_fast(self):
+        '''The final clip of create_video_fast, with audio and subtitles, not written yet.'''
+        self.prepare_stretched_audios()
+        # records only, no clip is opened until the render reaches it
+        self.clips_info_dicts = self.build_clip_records()
+        total_duration = sum(clip_record.duration for clip_record in self.clips_info_dicts)
+        concatenated_audio = self.create_lazy_audio(self.clips_info_dicts)
 
         if self.bgm_path and self.bgm_path != -1:
-            bgm_clip = AudioFileClip(self.bgm_path).volumex(self.bgm_volume)
-            bgm_clip = bgm_clip.subclip(0, total_duration).audio_fadeout(self.audio_fadeout_duration)
-            final_audio = CompositeAudioClip([concatenated_audio, bgm_clip])
+            final_audio = CompositeAudioClip([concatenated_audio, self.create_bgm_clip(total_duration)])
         else:
             final_audio = concatenated_audio
 
@@ -171,38 +475,238 @@ class VideoCrafter():
         else:
             background_clip = ColorClip(size=(self.width, self.height), color=(255, 255, 255)).set_duration(total_duration)
 
-        final_video = background_clip
-        for clip_info_dict in self.clips_info_dicts:
-            video_clip = clip_info_dict['image_clip']
-            if video_clip is not None:
-                video_clip = video_clip.set_start(clip_info_dict['start_time'])
-                # video_clip = video_clip.set_position(("center", "center"))
-                final_video = CompositeVideoClip([final_video, video_clip])
-            
+        # one flat timeline instead of one nested CompositeVideoClip per clip
+        image_layers = [self.create_lazy_layer(clip_record) for clip_record in self.clips_info_dicts if clip_record.has_image]
+        final_video = TimelineClip(background_clip, image_layers)
+
         final_video = final_video.set_audio(final_audio)
 
         if self.config.get('subtitle_config'):
             final_video = self.add_subtitle(final_video, self.clips_info_dicts, self.config.get('subtitle_config', {}))
+        return final_video
 
+    def build_timeline_layout(self):
+        '''The start time, duration and layer facts of every clip, as plain dicts that can be sent to other processes.'''
+        return [clip_record.layout() for clip_record in self.build_clip_records()]
+
+    def build_clip_records(self):
+        '''
+        A ClipRecord per clip, timed by get_clip_duration, no audio or image clip is kept open.
+        The clips are timed in the metrics when the media pool opens them, see _timed_opener.
+        '''
+        self.prepare_stretched_audios()
+        clip_records = []
+        cur_start_time = 0
+        for clip_index, clip_config in enumerate(self.clips_config):
+            clip_records.append(ClipRecord(clip_index, cur_start_time, self.get_clip_duration(clip_config), clip_config))
+            cur_start_time += clip_records[-1].duration
+        return clip_records
+
+    def get_clip_duration(self, clip_config):
+        '''
+        The duration of create_audio_clip(clip_config), from the container duration (the PCM cache keeps it) and the sample
+        counts alone: no reader stays open and nothing is stretched in memory.
+        '''
+        transition_pause_time = clip_config.get('transition_pause_time', 0)
+        if not clip_config.get('audio_path') or clip_config['audio_path'] == -1:
+            return int((clip_config.get('duration', 0) + transition_pause_time) * 44100) / 44100
+        audio_speed = clip_config.get('audio_speed', 1.0)
+        if audio_speed != 1.0 and self.config.get('time_stretch_engine', 'ffmpeg') == 'numpy':
+            if self.pcm_cache is not None:
+                n_samples = len(self.pcm_cache.load(clip_config['audio_path'])[0])
+            else:
+                n_samples = len(decode_audio(clip_config['audio_path'], 44100, 2))
+            # the length of wsola_time_stretch's output
+            duration = int(round(n_samples / audio_speed)) / 44100
+        else:
+            audio_path = self.make_mixer_clip(clip_config)['audio_path']
+            duration = self.pcm_cache.load(audio_path)[1] if self.pcm_cache is not None else probe_duration(audio_path)
+        if transition_pause_time > 0:
+            duration += int(transition_pause_time * 44100) / 44100
+        return duration
+
+    def create_video_segmented(self, timeline_layout=None, final_audio=None):
+        '''
+        Renders the video of each segment in its own process, joins the segments with a stream copy
+        and muxes the audio, mixed once for the whole episode so it is continuous across the joins.
+        A segment job is a plain dict, see render_segment_job.
+        With incremental set, the segments are kept next to the output with their fingerprints,
+        and a re-run only renders the segments whose clips, style or start frame changed.
+        timeline_layout (see build_timeline_layout) and final_audio (see mix_final_audio) can be given when already known.
+        '''
         time_start = time.time()
-        final_video.write_videofile(
-            self.output_path,
-            codec="h264_nvenc",
-            audio_codec='aac',
-            fps=24,
-            threads=8,
-            ffmpeg_params=[
-                "-b:v", "5M",
-                "-preset", "fast",
-                "-rc", "vbr",
-                "-gpu", "0"
-            ]
-        )
+        if timeline_layout is None:
+            with self.metrics.stage('layout', clips=len(self.clips_config)):
+                timeline_layout = self.build_timeline_layout()
+        total_duration = sum(clip_info['duration'] for clip_info in timeline_layout)
+        if self.config.get('subtitle_config'):
+            self.subtitle_cues = self.get_subtitle_cues(timeline_layout, self.config['subtitle_config'])
+        incremental = self.config.get('incremental', False)
+        if incremental:
+            segments = plan_fixed_segments(timeline_layout, total_duration, self.fps, self.config.get('segment_clips', 20))
+        else:
+            segments = plan_segments(timeline_layout, total_duration, self.fps, self.config.get('segments', 1))
+
+        with tempfile.TemporaryDirectory(dir=self.output_dir or None) as temp_dir:
+            segments_dir = self.get_segments_dir() if incremental else temp_dir
+            os.makedirs(segments_dir, exist_ok=True)
+            jobs = []
+            for segment_index, segment in enumerate(segments):
+                fingerprint = self.fingerprint_segment(segment, timeline_layout) if incremental else f'{segment_index:05d}'
+                jobs.append({
+                    'config': self.config,
+                    'video_codec': self.video_codec,
+                    'video_ffmpeg_params': self.video_ffmpeg_params,
+                    'timeline_layout': timeline_layout,
+                    'segment': segment,
+                    'output_path': os.path.join(segments_dir, f'segment_{fingerprint}.mp4'),
+                })
+            # a segment file only exists once it is complete, render_segment_job writes to a temp file first
+            pending_jobs = [job for job in jobs if not os.path.exists(job['output_path'])]
+            print(f"Rendering {len(pending_jobs)} of {len(jobs)} segments of {len(timeline_layout)} clips")
+            if pending_jobs:
+                self.prefetch_background()
+            pending_frames = sum(job['segment']['end_frame'] - job['segment']['start_frame'] for job in pending_jobs)
+            with self.metrics.stage('segments', frames=pending_frames, segments=len(jobs), reused_segments=len(jobs) - len(pending_jobs)):
+                encode_seconds = self._render_segment_jobs(pending_jobs)
+            if incremental:
+                print(f"Reused {len(jobs) - len(pending_jobs)} of {len(jobs)} segments from {segments_dir}")
+                self._save_segments_manifest(segments_dir, jobs)
+
+            video_path = os.path.join(temp_dir, 'video.mp4')
+            with self.metrics.stage('concat', segments=len(jobs)):
+                concat_videos([job['output_path'] for job in jobs], video_path)
+            audio_path = os.path.join(temp_dir, 'audio.m4a')
+            if final_audio is None:
+                final_audio = self.mix_final_audio()
+            with self.metrics.stage('mux'):
+                encode_audio(final_audio, 44100, audio_path)
+                mux_audio(video_path, audio_path, self.output_path)
+        log_render_speed(self.encoder.profile_name, sum(segment['end_frame'] - segment['start_frame'] for segment in segments), time.time() - time_start)
+        if pending_frames:
+            # the segments encode in parallel, so this is the encoder throughput of one segment process
+            print(f"Segments encoded {pending_frames} frames at {pending_frames / max(encode_seconds, 1e-6):.1f} fps per process")
+        print(f"Video created and saved to {self.output_path}, time used: {time.time() - time_start:.2f} seconds")
+
+    def _render_segment_jobs(self, jobs):
+        '''Renders the segment jobs across a process pool, returns the seconds the segments spent encoding, summed.'''
+        if not jobs:
+            return 0
+        encode_seconds = 0
+        max_workers = min(self.config.get('segment_workers') or os.cpu_count() or 1, len(jobs))
+        errors = []
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(render_segment_job, job): job for job in jobs}
+            for segments_done, future in enumerate(as_completed(futures), 1):
+                try:
+                    encode_seconds += future.result()
+                except Exception as e:
+                    errors.append(f"{futures[future]['output_path']}: {e}")
+                self.metrics.progress('segments', segments_done, len(jobs))
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(jobs)} segments failed:\n" + '\n'.join(errors))
+        return encode_seconds
+
+    def get_segments_dir(self):
+        return os.path.splitext(self.output_path)[0] + '_segments'
+
+    def _file_fingerprint(self, path):
+        if path and path != -1 and os.path.isfile(path):
+            return self.asset_cache.content_hash(path)
+        return path
+
+    def fingerprint_segment(self, segment, timeline_layout):
+        '''
+        Hash of everything the video of a segment depends on: the global style, its frame range and for each clip
+        the audio and key frame content, the clip fields (subtitle, timing, movement...) and the resulting layout.
+        '''
+        style = {
+            'width': self.width,
+            'height': self.height,
+            'fps': self.fps,
+            'background': self._file_fingerprint(self.config.get('background_video_path')),
+            'background_store': [self.config.get(key) for key in ('background_store', 'background_loop_seconds', 'background_loop_crossfade')],
+            'subtitle_config': self.config.get('subtitle_config'),
+            'video_codec': self.video_codec,
+            'video_ffmpeg_params': self.video_ffmpeg_params,
+        }
+        clip_fingerprints = []
+        for clip_index in range(segment['clip_start'], segment['clip_end']):
+            clip_config = self.clips_config[clip_index]
+            clip_fields = {key: value for key, value in clip_config.items() if key not in ('audio_path', 'key_frame_path')}
+            clip_fingerprints.append(AssetCache.make_key('clip', self._file_fingerprint(clip_config.get('audio_path')),
+                                                         key_frame=self._file_fingerprint(clip_config.get('key_frame_path')),
+                                                         fields=clip_fields, layout=timeline_layout[clip_index]))
+        return AssetCache.make_key('segment', clip_fingerprints, style=style,
+                                   start_frame=segment['start_frame'], end_frame=segment['end_frame'])[:32]
+
+    def _save_segments_manifest(self, segments_dir, jobs):
+        '''Records the segments of this render, segment files of earlier renders that are not used any more are removed.'''
+        segment_names = [os.path.basename(job['output_path']) for job in jobs]
+        for name in os.listdir(segments_dir):
+            if name.startswith('segment_') and name not in segment_names:
+                os.remove(os.path.join(segments_dir, name))
+        manifest = {'output_path': self.output_path, 'segments': [dict(job['segment'], file=name) for job, name in zip(jobs, segment_names)]}
+        with open(os.path.join(segments_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+    def render_segment(self, segment, timeline_layout, output_path):
+        '''
+        Writes the video of the frames segment['start_frame'] <= i < segment['end_frame'] of the episode, without audio.
+        The segment's own clock starts at its first frame, every layer, cue and the background are shifted by that offset.
+        Returns the seconds the write spent encoding, the frame composition excluded.
+        '''
+        start_frame, end_frame = segment['start_frame'], segment['end_frame']
+        time_offset = start_frame / self.fps
+        duration = (end_frame - start_frame) / self.fps
+        total_duration = sum(clip_info['duration'] for clip_info in timeline_layout)
+
+        background_path = self.config.get('background_video_path')
+        if background_path and not background_path.lower().endswith(IMAGE_EXTENSIONS):
+            if self.background_store is not None:
+                # the stored background loops, every time is valid
+                last_frame_time = math.inf
+            else:
+                with VideoFileClip(background_path, audio=False) as source:
+                    # a background shorter than the episode holds its last frame
+                    last_frame_time = max(source.duration - 1 / source.fps, 0)
+            background_clip = self.create_background(duration=total_duration)
+            background_clip = background_clip.fl_time(lambda t: min(t + time_offset, last_frame_time), keep_duration=False).set_duration(duration)
+        elif background_path:
+            background_clip = self.create_background(duration=duration)
+        else:
+            background_clip = ColorClip(size=(self.width, self.height), color=(255, 255, 255)).set_duration(duration)
 
-        time_end = time.time()
-        print(f"Video created and saved to {self.output_path}, time used: {time_end - time_start:.2f} seconds")
+        image_layers = []
+        for clip_index in range(segment['clip_start'], segment['clip_end']):
+            if timeline_layout[clip_index]['has_image']:
+                clip_record = ClipRecord(clip_index, timeline_layout[clip_index]['start_time'], timeline_layout[clip_index]['duration'], self.clips_config[clip_index])
+                image_layers.append(self.create_lazy_layer(clip_record, start_frame))
+        segment_video = TimelineClip(background_clip, image_layers)
+
+        if self.config.get('subtitle_config'):
+            subtitle_config = self.config['subtitle_config']
+            subs = frame_cues(self.get_subtitle_cues(timeline_layout, subtitle_config), self.fps, start_frame, end_frame)
+            segment_video = self.add_subtitle_cues(segment_video, subs, subtitle_config)
+
+        # the burnt in cues were shifted to the segment's clock above
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(output_path) or None) as temp_dir:
+            time_start = time.perf_counter()
+            try:
+                compose_seconds = write_frames(segment_video, 0, end_frame - start_frame, self.fps, output_path, self.video_codec,
+                                               self.video_ffmpeg_params + self._burn_in_params(temp_dir), workers=self.render_workers)
+            finally:
+                self.media_pool.close()
+            return time.perf_counter() - time_start - compose_seconds
 
     def create_video(self):
+        with self.metrics.stage('build', clips=len(self.clips_config)):
+            final_video = self.build_video()
+        self._write_video(final_video)
+
+    def build_video(self):
+        '''The final clip of create_video, not written yet.'''
+        self.prepare_stretched_audios()
         # create an empty video clip with the size of the output video
         canvas_clip = ColorClip(size=(self.width, self.height), color=(255, 255, 255, 0)).set_duration(self.config.get('duration', 0))
         
@@ -226,36 +730,124 @@ class VideoCrafter():
 
         if self.config.get('subtitle_config'):
             final_video = self.add_subtitle(final_video, clip_info_dicts, self.config.get('subtitle_config', {}))
+        return final_video
 
-        # Specify the fps when writing the video file
-        # final_video.write_videofile(self.output_path, codec="h264_nvenc", audio_codec='aac', fps=24, ffmpeg_params=["-b:v", "5M"])
+    def _write_video(self, final_video, timeline_layout=None):
+        '''timeline_layout is the list of clip info dicts of the fast path, it enables the static span planner.'''
         time_start = time.time()
-        final_video.write_videofile(
-            self.output_path, 
-            codec="h264_nvenc", 
-            audio_codec='aac', 
-            fps=24, 
-            threads=8,  # Use multiple threads for video processing
-            ffmpeg_params=[
-                "-b:v", "5M",  # Adjust the bitrate as needed
-                "-preset", "fast",  # Speed up encoding
-                "-rc", "vbr",  # Variable bitrate control for better performance
-                "-gpu", "0"  # Ensure the GPU is used if multiple are available
-            ]
-        )
+        compose_seconds_start = self.metrics.counters.get('frame_composition_seconds', 0)
+        total_frames = int(math.ceil(final_video.duration * self.fps - 1e-6))
+        with self.metrics.stage('write', frames=total_frames, encoder_profile=self.encoder.profile_name):
+            if timeline_layout is not None and self.config.get('plan_static_spans'):
+                self._write_video_planned(final_video, timeline_layout)
+            elif self.render_workers > 1 and can_render_in_parallel():
+                self._write_video_parallel(final_video)
+            else:
+                # frames are composed in this process, so their composition time is measured too
+                final_video = self.metrics.track_frames(final_video, 'write', total_frames)
+                with tempfile.TemporaryDirectory(dir=self.output_dir or None) as temp_dir:
+                    self.encoder.write_videofile(final_video, self.output_path, self.fps, extra_ffmpeg_params=self._burn_in_params(temp_dir))
         time_end = time.time()
+        # the audio written by write_videofile is counted as encoding
+        compose_seconds = self.metrics.counters.get('frame_composition_seconds', 0) - compose_seconds_start
+        log_render_speed(self.encoder.profile_name, total_frames, time_end - time_start, time_end - time_start - compose_seconds)
         print(f"Video created and saved to {self.output_path}, time used: {time_end - time_start:.2f} seconds")
 
+    def _write_video_planned(self, final_video, timeline_layout):
+        '''Encodes each static span from one composed still, only dynamic spans are composed frame by frame.'''
+        subtitle_cues = self.get_subtitle_cues(timeline_layout, self.config['subtitle_config']) if self.config.get('subtitle_config') else []
+        background_path = self.config.get('background_video_path')
+        has_dynamic_background = bool(background_path) and not background_path.lower().endswith(IMAGE_EXTENSIONS)
+        spans = plan_render_spans(timeline_layout, subtitle_cues, final_video.duration, self.fps, has_dynamic_background)
+        static_frames = sum(span.n_frames for span in spans if span.is_static)
+        print(f"Render plan: {len(spans)} spans, {static_frames} of {sum(span.n_frames for span in spans)} frames are static")
+
+        total_frames = spans[-1].end_frame if spans else 0
+        with tempfile.TemporaryDirectory(dir=self.output_dir or None) as temp_dir:
+            span_paths = []
+            for span_index, span in enumerate(spans):
+                span_path = os.path.join(temp_dir, f'span_{span_index:05d}.mp4')
+                # every span file starts at time 0, the subtitles are burnt in from the span's start time
+                ffmpeg_params = self.video_ffmpeg_params + self._burn_in_params(temp_dir, span.start_frame / self.fps, span.n_frames / self.fps,
+                                                                                 f'span_{span_index:05d}.ass')
+                if span.is_static:
+                    span_paths.extend(self._encode_static_span(final_video, span, span_path, ffmpeg_params))
+                else:
+                    compose_seconds = write_frames(final_video, span.start_frame, span.end_frame, self.fps, span_path, self.video_codec,
+                                                   ffmpeg_params, workers=self.render_workers,
+                                                   progress_callback=lambda done, _, start_frame=span.start_frame: self.metrics.progress('write', start_frame + done, total_frames))
+                    self.metrics.add('frame_composition_seconds', compose_seconds)
+                    span_paths.append(span_path)
+                self.metrics.progress('write', span.end_frame, total_frames)
+
+            video_path = os.path.join(temp_dir, 'video.mp4')
+            concat_videos(span_paths, video_path)
+            self._mux_final_audio(final_video, video_path, temp_dir)
+
+    def _write_video_parallel(self, final_video):
+        '''Composes the frames across render_workers processes, the audio is written separately and muxed.'''
+        total_frames = int(math.ceil(final_video.duration * self.fps - 1e-6))
+        print(f"Rendering {total_frames} frames with {self.render_workers} workers")
+        with tempfile.TemporaryDirectory(dir=self.output_dir or None) as temp_dir:
+            video_path = os.path.join(temp_dir, 'video.mp4')
+            compose_seconds = write_frames(final_video, 0, total_frames, self.fps, video_path, self.video_codec, self.video_ffmpeg_params + self._burn_in_params(temp_dir),
+                                           workers=self.render_workers, progress_callback=lambda done, total: self.metrics.progress('write', done, total))
+            self.metrics.add('frame_composition_seconds', compose_seconds)
+            self._mux_final_audio(final_video, video_path, temp_dir)
+
+    def _mux_final_audio(self, final_video, video_path, temp_dir):
+        audio_path = os.path.join(temp_dir, 'audio.m4a')
+        final_video.audio.write_audiofile(audio_path, fps=44100, codec='aac')
+        mux_audio(video_path, audio_path, self.output_path)
+
+    def _encode_static_span(self, final_video, span, span_path, ffmpeg_params=None):
+        '''
+        Composes the span's frame once and lets ffmpeg hold it. A one second chunk is encoded once and repeated
+        in the concat list, so the encoding cost of a static span does not grow with its length.
+        Returns the list of chunk paths to concatenate.
+        '''
+        ffmpeg_params = self.video_ffmpeg_params if ffmpeg_params is None else ffmpeg_params
+        still_path = span_path.replace('.mp4', '.png')
+        time_start = time.perf_counter()
+        still = final_video.get_frame(span.start_frame / self.fps).astype('uint8')
+        self.metrics.add('frame_composition_seconds', time.perf_counter() - time_start)
+        Image.fromarray(still).save(still_path)
+        chunk_frames = int(math.ceil(self.fps))
+        full_chunks, remainder_frames = divmod(span.n_frames, chunk_frames)
+        chunk_paths = []
+        if full_chunks:
+            full_chunk_path = span_path.replace('.mp4', '_chunk.mp4')
+            encode_still(still_path, chunk_frames, self.fps, full_chunk_path, self.video_codec, ffmpeg_params)
+            chunk_paths.extend([full_chunk_path] * full_chunks)
+        if remainder_frames:
+            encode_still(still_path, remainder_frames, self.fps, span_path, self.video_codec, ffmpeg_params)
+            chunk_paths.append(span_path)
+        return chunk_paths
+
     def create_audio_clip(self, clip_config):
         audio_speed = clip_config.get('audio_speed', 1.0)
         transition_pause_time = clip_config.get('transition_pause_time', 0)
         if clip_config.get('audio_path') and clip_config['audio_path'] != -1:
+            # the file the loudness stage measures, the one AudioMixer reads
+            measured_audio_path = clip_config['audio_path']
             # Change audio speed without altering pitch
-            if audio_speed != 1.0:
-                modified_audio_path = change_audio_speed_without_pitch(clip_config['audio_path'], audio_speed)
-                audio_clip = AudioFileClip(modified_audio_path)
+            if audio_speed != 1.0 and self.config.get('time_stretch_engine', 'ffmpeg') == 'numpy':
+                if self.pcm_cache is not None:
+                    stretched_audio = wsola_time_stretch(self.pcm_cache.load(clip_config['audio_path'])[0], audio_speed, fps=44100)
+                else:
+                    stretched_audio = stretch_audio_file(clip_config['audio_path'], audio_speed, fps=44100)
+                audio_clip = AudioArrayClip(stretched_audio, fps=44100)
+            elif audio_speed != 1.0:
+                if self.stretched_audio_paths and (clip_config['audio_path'], audio_speed) in self.stretched_audio_paths:
+                    modified_audio_path = self.stretched_audio_paths[(clip_config['audio_path'], audio_speed)]
+                else:
+                    modified_audio_path = change_audio_speed_without_pitch(clip_config['audio_path'], audio_speed, cache=self.asset_cache)
+                audio_clip = self.load_audio_clip(modified_audio_path)
+                measured_audio_path = modified_audio_path
             else:
-                audio_clip = AudioFileClip(clip_config['audio_path'])
+                audio_clip = self.load_audio_clip(clip_config['audio_path'])
+            if self.loudness is not None:
+                audio_clip = audio_clip.volumex(self.loudness.clip_gain(measured_audio_path))
             # Apply fade-in and fade-out to reduce noise
             audio_clip = audio_clip.audio_fadein(0.5).audio_fadeout(0.5)
             # concatenate silence to the end of the audio clip
@@ -271,10 +863,44 @@ class VideoCrafter():
 
         return audio_clip
     
+    def load_audio_clip(self, audio_path):
+        '''
+        An audio clip of audio_path. With the PCM cache it reads the cached memory map, no ffmpeg reader is started,
+        and it lasts the container duration like an AudioFileClip (past the decoded samples it is silent).
+        '''
+        if self.pcm_cache is None:
+            return AudioFileClip(audio_path)
+        samples, duration = self.pcm_cache.load(audio_path)
+        return AudioArrayClip(samples, fps=44100).set_duration(duration)
+
     def create_image_clip(self, clip_config, image_clip_duration):
         if not clip_config.get('key_frame_path') or clip_config['key_frame_path'] == -1:
             return None
 
+        resized_image_path = self.get_key_frame(clip_config)
+        # Set the opacity of the image clip
+        image_clip = ImageClip(resized_image_path).set_duration(image_clip_duration).set_position(('center', 'center'))
+
+        # Add movement to the image clip
+        if clip_config.get('movement'):
+            movement = clip_config['movement']
+            if movement['type'] == 'pan':
+                image_clip = image_clip.set_position(make_pan_position(self.width, image_clip_duration, self.fps))
+            elif movement['type'] == 'zoom':
+                start_resize_ratio = movement.get('start_resize_ratio', 1)
+                end_resize_ratio = movement.get('end_resize_ratio', 1.5)
+                # the image is pre-scaled once, each frame is a single resample of the cached source
+                image_clip = make_zoom_clip(resized_image_path, image_clip_duration, start_resize_ratio, end_resize_ratio, fps=self.fps)
+
+        # Apply fade-out effect to the video clip
+        if clip_config.get('fadeout_duration'):
+            fadeout_duration = clip_config.get('fadeout_duration')
+            image_clip = image_clip.crossfadeout(fadeout_duration)
+        
+        return image_clip
+
+    def get_key_frame(self, clip_config):
+        '''The path of the clip's key frame resized according to its frame_size, the original if it already has that size.'''
         # Resize image according to frame_size
         frame_size = clip_config.get('frame_size', {'width': self.width, 'height': self.height})
         if frame_size.get('unit', '') == 'ratio':
@@ -301,37 +927,12 @@ class VideoCrafter():
             original_width, original_height = img.size
 
         if original_width != target_width or original_height != target_height:
-            image_name, image_extension = os.path.splitext(os.path.basename(clip_config['key_frame_path']))
-            resized_image_name = f"{image_name}_resized{image_extension}"
-            resized_image_path = os.path.join(self.output_dir, resized_image_name)
-            self.resize_image(clip_config['key_frame_path'], resized_image_path, (target_width, target_height), ensure_fit=True)
+            resized_image_path = self.get_resized_image(clip_config['key_frame_path'], (target_width, target_height), ensure_fit=True)
             print(f"Image resized and saved to {resized_image_path}")
         else:
             resized_image_path = clip_config['key_frame_path']
             print(f"Image does not need resizing. Using original image: {resized_image_path}")
-        # Set the opacity of the image clip
-        image_clip = ImageClip(resized_image_path).set_duration(image_clip_duration).set_position(('center', 'center'))
-
-        # Add movement to the image clip
-        if clip_config.get('movement'):
-            movement = clip_config['movement']
-            if movement['type'] == 'pan':
-                video_width = self.width
-                image_clip = image_clip.set_position(lambda t: (t * (video_width / image_clip_duration), 'center'))
-            elif movement['type'] == 'zoom':
-                start_resize_ratio = movement.get('start_resize_ratio', 1)
-                end_resize_ratio = movement.get('end_resize_ratio', 1.5)
-                zoom_ratio_per_second = (end_resize_ratio - start_resize_ratio) / image_clip_duration
-                # Determine the zoom type based on the start and end resize ratios
-                zoom_type = 'in' if start_resize_ratio < end_resize_ratio else 'out'
-                image_clip = zoom_effect(image_clip, zoom_ratio_per_second=zoom_ratio_per_second, zoom_type=zoom_type)
-
-        # Apply fade-out effect to the video clip
-        if clip_config.get('fadeout_duration'):
-            fadeout_duration = clip_config.get('fadeout_duration')
-            image_clip = image_clip.crossfadeout(fadeout_duration)
-        
-        return image_clip
+        return resized_image_path
     
     def create_clip(self, clip_config):
         # create audio clip
@@ -425,30 +1026,16 @@ class VideoCrafter():
                 final_result[i] = final_result[i][1:]
         return final_result
 
-    def add_subtitle(self, video_clip, clip_info_dicts, subtitle_config):
-        font_size = subtitle_config.get('fontsize', 50)
-        font_color = subtitle_config.get('color', 'white')
-        stroke_color = subtitle_config.get('stroke_color', None)
-        stroke_width = subtitle_config.get('stroke_width', 0)
-        background_color = subtitle_config.get('background_color', None)
+    def get_subtitle_cues(self, clip_info_dicts, subtitle_config):
+        '''Returns the subtitle cues as a list of ((start_time, end_time), text), long subtitles are split by split_long_subtitle.'''
         text_length_limit = subtitle_config.get('text_length_limit', 25)
-        
+
         def append_subtitle(subs, subtitle_text, duration, sub_start_time):
             if subtitle_text == '':
                 return subs
             subs.append(((sub_start_time, sub_start_time + duration), subtitle_text))
             return subs
 
-        # Define a text generator function for the subtitles
-        def subtitle_generator(txt):
-            txt_clip = TextClip(txt, font='Microsoft-YaHei-Bold-&-Microsoft-YaHei-UI-Bold',
-                                fontsize=font_size,
-                                color=font_color,
-                                stroke_color=stroke_color,
-                                stroke_width=stroke_width,
-                                bg_color=background_color)
-            return txt_clip
-
         def split_long_subtitle(subs, subtitle_text, duration, sub_start_time, text_length_limit):
             splited_subtitle_pieces = self.split_subtitle_text(subtitle_text, text_length_limit)
             total_length = len(subtitle_text)
@@ -472,25 +1059,121 @@ class VideoCrafter():
                 subs = append_subtitle(subs, subtitle_text, clip_info['duration'], sub_start_time)
                 # subs.append(((sub_start_time, sub_start_time + clip_info['duration']), subtitle_text))
                 sub_start_time += clip_info['duration']
-        # Create the SubtitlesClip
-        subtitles = SubtitlesClip(subs, subtitle_generator)
+        return subs
 
-        # Overlay the subtitles below the video
+    def add_subtitle(self, video_clip, clip_info_dicts, subtitle_config):
+        subs = self.get_subtitle_cues(clip_info_dicts, subtitle_config)
+        self.subtitle_cues = subs
+        # on the frame grid, like the cues of render_segment
+        return self.add_subtitle_cues(video_clip, frame_cues(subs, self.fps), subtitle_config)
+
+    def get_subtitle_y_position(self, subtitle_config):
         subtitle_y_position = subtitle_config.get('y_position', 'bottom')
         # if subtitle_y_position is a float and <1, then it is a percentage of the video height
         if isinstance(subtitle_y_position, float) and 0 < subtitle_y_position < 1:
             subtitle_y_position = int(subtitle_y_position * self.height)
+        return subtitle_y_position
+
+    def add_subtitle_cues(self, video_clip, subs, subtitle_config):
+        subtitle_y_position = self.get_subtitle_y_position(subtitle_config)
+
+        if subtitle_config.get('renderer', 'pil') == 'libass':
+            # burnt in by the encoder, see _burn_in_params
+            self.burn_in_cues = subs
+            self._burn_in_position = subtitle_y_position
+            return video_clip
+        if subtitle_config.get('renderer', 'pil') == 'pil':
+            subtitle_track = SubtitleTrack(subs, SubtitleRasterizer.from_subtitle_config(subtitle_config), ('center', subtitle_y_position))
+            return subtitle_track.apply_to(video_clip)
+        return self._add_subtitle_with_textclip(video_clip, subs, subtitle_config, subtitle_y_position)
+
+    def _add_subtitle_with_textclip(self, video_clip, subs, subtitle_config, subtitle_y_position):
+        font_size = subtitle_config.get('fontsize', 50)
+        font_color = subtitle_config.get('color', 'white')
+        stroke_color = subtitle_config.get('stroke_color', None)
+        stroke_width = subtitle_config.get('stroke_width', 0)
+        background_color = subtitle_config.get('background_color', None)
+
+        # Define a text generator function for the subtitles
+        def subtitle_generator(txt):
+            txt_clip = TextClip(txt, font=subtitle_config.get('font', 'Microsoft-YaHei-Bold-&-Microsoft-YaHei-UI-Bold'),
+                                fontsize=font_size,
+                                color=font_color,
+                                stroke_color=stroke_color,
+                                stroke_width=stroke_width,
+                                bg_color=background_color)
+            return txt_clip
+
+        # Create the SubtitlesClip
+        subtitles = SubtitlesClip(subs, subtitle_generator)
+
+        # Overlay the subtitles below the video
         video_with_subtitles = CompositeVideoClip([video_clip, subtitles.set_position(('center', subtitle_y_position))])
 
         return video_with_subtitles
 
+    def _burn_in_params(self, temp_dir, time_offset=0, duration=None, name='subtitles.ass'):
+        '''
+        The ffmpeg params burning the libass cues into a video of the episode from time_offset for duration seconds,
+        [] without such cues. The ASS script of the video's cues is written to temp_dir as name.
+        '''
+        if self.burn_in_cues is None:
+            return []
+        cues = shift_cues(self.burn_in_cues, time_offset, duration) if time_offset or duration is not None else self.burn_in_cues
+        ass_path = os.path.join(temp_dir, name)
+        font_dir = write_ass(cues, ass_path, self.config['subtitle_config'], self.width, self.height, self._burn_in_position)
+        return ['-vf', build_subtitles_filter(ass_path, font_dir)]
+
+    def export_subtitles(self, cues=None):
+        '''
+        Writes the subtitle_export sidecar files next to the output (<output>.srt, <output>.ass) and muxes the cues
+        into the output as a soft subtitle track if soft_subtitles is set. cues default to those of the last render.
+        '''
+        cues = self.subtitle_cues if cues is None else cues
+        formats = self.config.get('subtitle_export') or []
+        if formats is True:
+            formats = SUBTITLE_FORMATS
+        if cues is None or not (formats or self.config.get('soft_subtitles')):
+            return
+        output_base = os.path.splitext(self.output_path)[0]
+        subtitle_config = self.config.get('subtitle_config') or {}
+        for subtitle_format in formats:
+            if subtitle_format == 'srt':
+                write_srt(cues, output_base + '.srt')
+            elif subtitle_format == 'ass':
+                write_ass(cues, output_base + '.ass', subtitle_config, self.width, self.height, self.get_subtitle_y_position(subtitle_config))
+            else:
+                raise ValueError(f"Unknown subtitle_export format {subtitle_format}, use {SUBTITLE_FORMATS}")
+            print(f"Subtitles exported to {output_base}.{subtitle_format}")
+        if self.config.get('soft_subtitles'):
+            with tempfile.TemporaryDirectory(dir=self.output_dir or None) as temp_dir:
+                srt_path = os.path.join(temp_dir, 'subtitles.srt')
+                write_srt(cues, srt_path)
+                video_path = os.path.join(temp_dir, 'video' + os.path.splitext(self.output_path)[1])
+                add_subtitle_track(self.output_path, srt_path, video_path)
+                os.replace(video_path, self.output_path)
+
+    def prefetch_background(self):
+        '''
+        Puts the background at the render size into the asset cache from this process, so the segment processes all
+        read it instead of each building it, and never replace a cached file another one has open.
+        '''
+        background_path = self.config.get('background_video_path')
+        if not background_path:
+            return
+        if background_path.lower().endswith(IMAGE_EXTENSIONS):
+            with Image.open(background_path) as img:
+                if img.width != self.width or img.height != self.height:
+                    self.get_resized_image(background_path, (self.width, self.height))
+        elif self.background_store is not None:
+            self.background_store.fetch(background_path)
+
     def create_background(self, duration):
         background_path = self.config['background_video_path']
-        if background_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
+        if background_path.lower().endswith(IMAGE_EXTENSIONS):
             with Image.open(background_path) as img:
                 if img.width != self.width or img.height != self.height:
-                    resized_background_path = os.path.join(self.output_dir, os.path.splitext(os.path.basename(background_path))[0] + '_resized' + os.path.splitext(background_path)[1])
-                    self.resize_image(background_path, resized_background_path, (self.width, self.height))
+                    resized_background_path = self.get_resized_image(background_path, (self.width, self.height))
                     background_clip = (
                         ImageClip(resized_background_path)
                         .set_duration(duration)
@@ -500,6 +1183,8 @@ class VideoCrafter():
                         ImageClip(background_path)
                         .set_duration(duration)
                     )
+        elif self.background_store is not None:
+            background_clip = self.background_store.clip(background_path, duration)
         else:
             background_clip = VideoFileClip(background_path)
             if background_clip.size != (self.width, self.height):
@@ -509,7 +1194,7 @@ class VideoCrafter():
         return background_clip
 
     def add_bgm(self, video_clip):
-        bgm_clip = AudioFileClip(self.bgm_path).volumex(self.bgm_volume)
+        bgm_clip = self.load_audio_clip(self.bgm_path).volumex(self.bgm_volume)
         
         # If bgm is shorter than video, loop it
         if bgm_clip.duration < video_clip.duration:
@@ -530,6 +1215,12 @@ class VideoCrafter():
         final_video = video_clip.set_audio(final_audio)
         return final_video
 
+    def get_resized_image(self, input_path, target_size, ensure_fit=True):
+        '''Returns the path of the resized image in the shared asset cache.'''
+        key = AssetCache.make_key('resize', self.asset_cache.content_hash(input_path), target_size=list(target_size), ensure_fit=ensure_fit)
+        image_extension = os.path.splitext(input_path)[1]
+        return self.asset_cache.fetch(key, image_extension, lambda temp_path: self.resize_image(input_path, temp_path, target_size, ensure_fit))
+
     @staticmethod
     def resize_image(input_path, output_path, target_size, ensure_fit=True):
         if os.path.exists(output_path):
@@ -555,23 +1246,106 @@ class VideoCrafter():
             img.save(output_path)
 
 
-def change_audio_speed_without_pitch(audio_path, speed_factor, output_dir=None):
+def change_audio_speed_without_pitch(audio_path, speed_factor, output_dir=None, cache=None):
+    '''With a cache the stretched file is keyed by the audio content and speed_factor, otherwise it is written to output_dir.'''
     file_extension = os.path.splitext(audio_path)[1]
+    if cache is not None:
+        key = AssetCache.make_key('atempo', cache.content_hash(audio_path), atempo=speed_factor)
+        return cache.fetch(key, file_extension, lambda temp_path: _run_atempo(audio_path, speed_factor, temp_path))
+
     if output_dir is None:
         output_dir = os.path.join(os.path.dirname(audio_path), 'stretched_audios')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    output_path = os.path.join(output_dir, os.path.basename(audio_path).replace(file_extension, f'_stretched{file_extension}'))
+    output_path = os.path.join(output_dir, os.path.basename(audio_path).replace(file_extension, f'_stretched_x{speed_factor}{file_extension}'))
     if os.path.exists(output_path):
         print(f"File {output_path} already exists")
         return output_path
 
-    # Use ffmpeg to change audio speed without altering pitch
-    command = f'ffmpeg -i "{audio_path}" -filter:a "atempo={speed_factor}" -vn "{output_path}"'
-    os.system(command)
-    
+    _run_atempo(audio_path, speed_factor, output_path)
     return output_path
 
+def batch_change_audio_speed(stretch_jobs, cache, max_workers=None):
+    '''
+    stretch_jobs is an iterable of (audio_path, speed_factor), each cache miss is stretched by its own ffmpeg process,
+    max_workers at once. The pool is of threads that only wait on ffmpeg: forking this process could copy locks held
+    by the threads still downloading the clips.
+    The jobs are read lazily and each miss is submitted as soon as it is read, so a generator that is still
+    downloading or parsing the script keeps the pool busy.
+    Jobs with the same cache key (files with identical content at the same speed) are stretched once.
+    Returns a dict (audio_path, speed_factor) -> stretched audio path. A job that fails does not stop the others,
+    the failures are raised together once every stretch is done.
+    '''
+    stretched_audio_paths = {}
+    # (key, file_extension) -> [temp_path, jobs waiting for it]
+    pending_stretches = {}
+    futures = {}
+    errors = []
+    n_stretches = 0
+    executor = None
+    try:
+        for audio_path, speed_factor in stretch_jobs:
+            job = (audio_path, speed_factor)
+            if job in stretched_audio_paths:
+                continue
+            file_extension = os.path.splitext(audio_path)[1]
+            try:
+                key = AssetCache.make_key('atempo', cache.content_hash(audio_path), atempo=speed_factor)
+                if (key, file_extension) in pending_stretches:
+                    if job not in pending_stretches[(key, file_extension)][1]:
+                        pending_stretches[(key, file_extension)][1].append(job)
+                    continue
+                cached_path = cache.lookup(key, file_extension)
+                if cached_path is not None:
+                    stretched_audio_paths[job] = cached_path
+                    continue
+                n_stretches += 1
+                pending_stretches[(key, file_extension)] = [cache.temp_path(key, file_extension), [job]]
+            except Exception as e:
+                n_stretches += 1
+                errors.append(f"{audio_path} (x{speed_factor}): {e}")
+                continue
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1)
+            futures[executor.submit(_run_atempo, audio_path, speed_factor, pending_stretches[(key, file_extension)][0])] = (key, file_extension)
+
+        for future in as_completed(futures):
+            key, file_extension = futures[future]
+            temp_path, jobs = pending_stretches[(key, file_extension)]
+            try:
+                future.result()
+                stretched_path = cache.commit(key, file_extension, temp_path)
+                for job in jobs:
+                    stretched_audio_paths[job] = stretched_path
+            except Exception as e:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                errors.append(f"{jobs[0][0]} (x{jobs[0][1]}): {e}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if errors:
+        raise RuntimeError(f"Failed to stretch {len(errors)} of {n_stretches} audios:\n" + '\n'.join(errors))
+    return stretched_audio_paths
+
+def render_segment_job(job):
+    '''
+    Renders one segment of create_video_segmented. job is JSON-serializable (config, encoder, timeline_layout,
+    segment, output_path), so a segment can be rendered by any process or machine that sees the same files.
+    Returns the seconds spent encoding, see render_segment.
+    '''
+    video_crafter = VideoCrafter(job['config'])
+    video_crafter.video_codec = job['video_codec']
+    video_crafter.video_ffmpeg_params = job['video_ffmpeg_params']
+    temp_path = job['output_path'] + f'.{os.getpid()}.tmp.mp4'
+    encode_seconds = video_crafter.render_segment(job['segment'], job['timeline_layout'], temp_path)
+    os.replace(temp_path, job['output_path'])
+    return encode_seconds
+
+def _run_atempo(audio_path, speed_factor, output_path):
+    # Use ffmpeg to change audio speed without altering pitch
+    run_ffmpeg(['-i', audio_path, '-filter:a', build_atempo_filter(speed_factor), '-vn', output_path])
+
 def test_create_video_fast():
     config = {
         'height': 1080,
@@ -730,12 +1504,214 @@ def test_create_video():
     video_crafter = VideoCrafter(config)
     video_crafter.create_video()
 
+def _make_test_episode(temp_dir, clip_specs=((1.5, 1.1, '大家好，我是一朵。'), (1.2, 1.0, 'Short one'), (2.0, 1.25, '')), **config):
+    '''
+    Writes a synthetic episode into temp_dir: a sine tone per (duration, audio_speed, subtitle_text) of clip_specs, every
+    other clip with a key frame, and a BGM. Returns its 640x360 config, updated with config.
+    '''
+    key_frame_path = os.path.join(temp_dir, 'key_frame.png')
+    Image.new('RGB', (320, 240), (200, 120, 40)).save(key_frame_path)
+    bgm_path = os.path.join(temp_dir, 'bgm.mp3')
+    run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency=220:duration={sum(spec[0] for spec in clip_specs) + 10}', '-ac', 2, '-ar', 44100, bgm_path])
+    clips = []
+    for clip_index, (duration, audio_speed, subtitle_text) in enumerate(clip_specs):
+        audio_path = os.path.join(temp_dir, f'audio_{clip_index}.mp3')
+        run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency={440 + 110 * clip_index}:duration={duration}', '-ac', 2, '-ar', 44100, audio_path])
+        clips.append({'audio_path': audio_path, 'key_frame_path': key_frame_path if clip_index % 2 == 0 else -1, 'duration': -1,
+                      'transition_pause_time': 0.3, 'audio_speed': audio_speed, 'subtitle_text': subtitle_text})
+    episode_config = {
+        'height': 360,
+        'width': 640,
+        'bgm_path': bgm_path,
+        'output_path': os.path.join(temp_dir, 'output.mp4'),
+        'cache_dir': os.path.join(temp_dir, 'cache'),
+        'audio_fadeout_duration': 2,
+        'bgm_volume': 0.3,
+        'subtitle_config': {'fontsize': 20, 'y_position': 0.8, 'background_color': 'black'},
+        'clips': clips,
+    }
+    episode_config.update(config)
+    return episode_config
+
+def test_segmented_frames_match():
+    '''
+    A segmented render shows every layer and cue on the frames of the single-process render, around each clip boundary.
+    The last clip starts at 3.8000000000000003, the first frame of its segment is at 3.8 on the episode's clock.
+    '''
+    import numpy as np
+    from ffmpeg_utils import iter_video_frames
+    from render_planner import first_frame_at
+    with tempfile.TemporaryDirectory() as temp_dir:
+        durations = (0.8, 1.0, 1.1, 1.0)
+        config = _make_test_episode(temp_dir, [(duration, 1.0, f'Cue {clip_index}') for clip_index, duration in enumerate(durations)],
+                                    width=320, height=180, fps=25)
+        for clip_index, clip_config in enumerate(config['clips']):
+            # silent clips, timed by their duration alone
+            clip_config.update({'audio_path': -1, 'duration': durations[clip_index],
+                                'key_frame_path': os.path.join(temp_dir, 'key_frame.png') if clip_index % 2 else -1})
+        fast_crafter = VideoCrafter(dict(config, output_path=os.path.join(temp_dir, 'fast.mp4')))
+        fast_crafter.create()
+        segmented_crafter = VideoCrafter(dict(config, output_path=os.path.join(temp_dir, 'segmented.mp4'), segments=3))
+        segmented_crafter.create()
+        fast_frames = list(iter_video_frames(fast_crafter.output_path, (320, 180), 25))
+        segmented_frames = list(iter_video_frames(segmented_crafter.output_path, (320, 180), 25))
+        timeline_layout = segmented_crafter.build_timeline_layout()
+    assert len(fast_frames) == len(segmented_frames)
+    for clip_info in timeline_layout[1:]:
+        boundary_frame = first_frame_at(clip_info['start_time'], 25)
+        for frame_index in (boundary_frame - 1, boundary_frame, boundary_frame + 1):
+            # the encodes differ a little, a missing key frame or cue differs a lot
+            difference = np.abs(fast_frames[frame_index].astype(np.int16) - segmented_frames[frame_index]).mean()
+            assert difference < 2, f'frame {frame_index} differs by {difference:.1f}'
+    print('test_segmented_frames_match passed')
+
+def test_create_evicts_cache():
+    '''create() trims the asset cache to cache_max_bytes, the entries of its own render are kept.'''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = _make_test_episode(temp_dir, output_path=os.path.join(temp_dir, 'output.mp3'), cache_max_bytes=1)
+        asset_cache = AssetCache(config['cache_dir'])
+        key = asset_cache.make_key('test', 'stale')
+        temp_path = asset_cache.temp_path(key, '.bin')
+        with open(temp_path, 'wb') as f:
+            f.write(b'\0' * 1000)
+        stale_path = asset_cache.commit(key, '.bin', temp_path)
+        os.utime(stale_path, (time.time() - 7200, time.time() - 7200))
+        video_crafter = VideoCrafter(config)
+        video_crafter.create()
+        assert not os.path.exists(stale_path)
+        assert video_crafter.metrics.values['cache_freed_bytes'] == 1000
+        # the stretched audios of the render are pinned, the cache stays over its budget
+        assert AssetCache(config['cache_dir']).total_bytes() > 1
+    print('test_create_evicts_cache passed')
+
+def test_incremental_segments():
+    '''
+    An incremental re-run reuses every segment, and one with an edited subtitle only re-renders the segment of that clip.
+    The segment files of the earlier renders are removed, the manifest lists the segments of the last one.
+    '''
+    import copy
+
+    def render(config):
+        # a re-run reads its config afresh
+        video_crafter = VideoCrafter(copy.deepcopy(config))
+        video_crafter.create()
+        segments_stage = next(stage for stage in video_crafter.metrics.stages if stage['name'] == 'segments')
+        with open(os.path.join(video_crafter.get_segments_dir(), 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        return segments_stage['reused_segments'], [segment['file'] for segment in manifest['segments']], manifest
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = _make_test_episode(temp_dir, [(0.6, 1.0, f'Cue {clip_index}') for clip_index in range(6)], width=320, height=180,
+                                    incremental=True, segment_clips=2)
+        segments_dir = os.path.join(temp_dir, 'output_segments')
+        reused_segments, first_files, _ = render(config)
+        assert reused_segments == 0 and len(first_files) == 3
+        modified_times = [os.stat(os.path.join(segments_dir, name)).st_mtime_ns for name in first_files]
+
+        reused_segments, files, _ = render(config)
+        assert reused_segments == 3 and files == first_files
+        assert [os.stat(os.path.join(segments_dir, name)).st_mtime_ns for name in files] == modified_times
+
+        config['clips'][3]['subtitle_text'] = 'Edited cue'
+        reused_segments, files, manifest = render(config)
+        assert reused_segments == 2
+        assert files[0] == first_files[0] and files[1] != first_files[1] and files[2] == first_files[2]
+        assert sorted(name for name in os.listdir(segments_dir) if name.startswith('segment_')) == sorted(files)
+        assert manifest['output_path'] == config['output_path']
+        assert [(segment['clip_start'], segment['clip_end']) for segment in manifest['segments']] == [(0, 2), (2, 4), (4, 6)]
+        assert manifest['segments'][0]['start_frame'] == 0
+        assert all(a['end_frame'] == b['start_frame'] for a, b in zip(manifest['segments'][:-1], manifest['segments'][1:]))
+    print('test_incremental_segments passed')
+
+def test_create_preview():
+    '''
+    A synthetic episode rendered in full and as a preview: the preview has the preview size and fps, and the duration,
+    subtitle cues and audio mix of the final render.
+    '''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = _make_test_episode(temp_dir, preview_height=180)
+        final_crafter = VideoCrafter(config)
+        final_crafter.create()
+        preview_crafter = VideoCrafter(config)
+        preview_crafter.create(preview=True)
+        preview_path = os.path.join(temp_dir, 'output_preview.mp4')
+        final_video, preview_video = VideoFileClip(config['output_path']), VideoFileClip(preview_path)
+        try:
+            assert preview_video.size == [320, 180] and preview_video.fps == 12
+            # the final duration at preview fps, up to the last preview frame
+            assert abs(preview_video.duration - final_video.duration) <= 1 / 12, (preview_video.duration, final_video.duration)
+        finally:
+            final_video.close()
+            preview_video.close()
+        assert preview_crafter.subtitle_cues == final_crafter.subtitle_cues and len(final_crafter.subtitle_cues) == 2
+        # the muxed audio is the mix, up to the AAC encoding
+        mixed_audio = VideoCrafter(config).mix_final_audio()
+        preview_audio = decode_audio(preview_path)
+        n_samples = min(len(mixed_audio), len(preview_audio))
+        assert abs(len(mixed_audio) - len(preview_audio)) < 2048, (len(mixed_audio), len(preview_audio))
+        error = preview_audio[:n_samples] - mixed_audio[:n_samples]
+        assert np.sqrt(np.mean(error ** 2)) < 0.05 * np.sqrt(np.mean(mixed_audio ** 2)), np.sqrt(np.mean(error ** 2))
+    print('test_create_preview passed')
+
+def test_segmented_background_built_once():
+    '''The segment processes of a segmented render on a cold cache read the background loop the parent built, once.'''
+    import background_store
+    with tempfile.TemporaryDirectory() as temp_dir:
+        background_path = os.path.join(temp_dir, 'background.mp4')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=size=320x180:rate=24:duration=3', '-pix_fmt', 'yuv420p', background_path])
+        config = _make_test_episode(temp_dir, background_video_path=background_path, segments=3, subtitle_config=None)
+        builds_path = os.path.join(temp_dir, 'builds.txt')
+        iter_loop_frames = background_store.iter_loop_frames
+
+        def logged_iter_loop_frames(*args):
+            # the segment processes are forked, they run this too
+            with open(builds_path, 'a') as f:
+                f.write(f'{os.getpid()}\n')
+            return iter_loop_frames(*args)
+        background_store.iter_loop_frames = logged_iter_loop_frames
+        try:
+            VideoCrafter(config).create()
+        finally:
+            background_store.iter_loop_frames = iter_loop_frames
+        with open(builds_path) as f:
+            assert f.read().splitlines() == [str(os.getpid())]
+        assert os.path.exists(config['output_path'])
+    print('test_segmented_background_built_once passed')
+
 def test_resize_image():
     VideoCrafter.resize_image('D:\Study\AIAgent\AIEnglishLearning\static_materials\卡通女生图片.jpeg', 'D:\Study\AIAgent\AIPodcast\output\卡通女生图片_resized.jpeg', (1080, 1920))
 
 def test_change_audio_speed_without_pitch():
     change_audio_speed_without_pitch('D:\Study\AIAgent\AIPodcast\output\\test_input.mp3', 1.2, 'D:\Study\AIAgent\AIPodcast\output')
 
+def test_batch_change_audio_speed():
+    '''Byte-identical files at the same speed are stretched once and share the cached result.'''
+    import shutil
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path_a, path_b = os.path.join(temp_dir, 'a.mp3'), os.path.join(temp_dir, 'b.mp3')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=440:duration=1', '-ac', 2, '-ar', 44100, path_a])
+        shutil.copyfile(path_a, path_b)
+        cache = AssetCache(os.path.join(temp_dir, 'cache'))
+        stretched_audio_paths = batch_change_audio_speed([(path_a, 1.1), (path_b, 1.1), (path_a, 1.1), (path_b, 1.25)], cache, max_workers=2)
+        assert len(stretched_audio_paths) == 3
+        assert stretched_audio_paths[(path_a, 1.1)] == stretched_audio_paths[(path_b, 1.1)] != stretched_audio_paths[(path_b, 1.25)]
+        assert all(os.path.exists(path) for path in stretched_audio_paths.values())
+        assert not [name for name in os.listdir(os.path.dirname(stretched_audio_paths[(path_a, 1.1)])) if '.tmp' in name]
+
+        # a missing file and one ffmpeg cannot decode are both reported, the other jobs still run
+        path_c, broken_path = os.path.join(temp_dir, 'c.mp3'), os.path.join(temp_dir, 'broken.mp3')
+        run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=550:duration=1', '-ac', 2, '-ar', 44100, path_c])
+        with open(broken_path, 'wb') as f:
+            f.write(b'not an mp3')
+        try:
+            batch_change_audio_speed([(os.path.join(temp_dir, 'missing.mp3'), 1.1), (broken_path, 1.1), (path_c, 1.1)], cache, max_workers=2)
+            assert False, 'the failed stretches must be raised'
+        except RuntimeError as e:
+            assert 'Failed to stretch 2 of 3 audios' in str(e) and 'missing.mp3' in str(e) and 'broken.mp3' in str(e), e
+        assert cache.lookup(AssetCache.make_key('atempo', cache.content_hash(path_c), atempo=1.1), '.mp3') is not None
+        assert not [name for _, _, names in os.walk(cache.cache_dir) for name in names if '.tmp' in name]
+    print('test_batch_change_audio_speed passed')
+
 def test_subtitle_split():
     config = {
         'height': 1080,
@@ -789,6 +1765,9 @@ def test_subtitle_split():
 if __name__ == '__main__':
     test_subtitle_split()
 
+    # test_batch_change_audio_speed()
+    # test_create_preview()
+
     # test_create_video_fast()
 
     # test_movement()
@@ -797,6 +1776,14 @@ if __name__ == '__main__':
 
     # test_create_pure_audio()
 
+    # test_segmented_background_built_once()
+
+    # test_segmented_frames_match()
+
+    # test_create_evicts_cache()
+
+    # test_incremental_segments()
+
     # test_resize_image()
 
     # test_change_audio_speed_without_pitch()